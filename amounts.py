@@ -0,0 +1,59 @@
+from decimal import Decimal, ROUND_HALF_EVEN, localcontext
+
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+
+# Amounts are carried as integer base units (wei for ETH/ENS, 6-decimal units for USDC) from ingestion to export.
+# This keeps quarterly sums and interquarter balances exact; formatting into decimal strings happens only on export.
+DECIMALS = {
+    'ETH': 18,
+    'WETH': 18,
+    'ENS': 18,
+    'USDC': 6
+}
+
+def decimals_of(symbol):
+    return DECIMALS.get(symbol, 0)                           # Placeholders and unknown tokens are treated as plain integers.
+
+# Function converting a decimal string (e.g. "4,999,999.999999998618845952" from Etherscan) into integer base units
+def to_base_units(amount, decimals):
+    text = str(amount).replace(',', '').replace('$', '').strip()
+    if text in ('', 'nan', 'N/A'):
+        return 0
+    if 'e' in text or 'E' in text:                           # Scientific notation only appears in float-formatted ledgers.
+        with localcontext() as context:                      # Exact: the default context keeps only 28 digits
+            context.prec = len(text) + decimals + 400
+            return int(Decimal(text).scaleb(decimals).to_integral_value(ROUND_HALF_EVEN))
+    sign = -1 if text.startswith('-') else 1
+    whole, _, fraction = text.lstrip('+-').partition('.')
+    fraction, rest = (fraction + '0' * decimals)[:decimals], fraction[decimals:]
+    units = int(whole or 0) * 10 ** decimals + int(fraction or 0)
+    if rest.strip('0'):                                      # Float-derived values (e.g. 174520.48249999998 USDC) are rounded half-even, not cut
+        half = '5'.ljust(len(rest), '0')
+        units += rest > half or (rest == half and units % 2 == 1)
+    return sign * units
+
+# Function converting integer base units back into an exact decimal string. Only used at export time.
+def format_units(base_units, decimals):
+    base_units = int(base_units)
+    sign = '-' if base_units < 0 else ''
+    whole, fraction = divmod(abs(base_units), 10 ** decimals)
+    fraction = str(fraction).rjust(decimals, '0').rstrip('0') if decimals else ''
+    return f"{sign}{whole}.{fraction or '0'}"
+
+# Function converting base units into a float amount, e.g. to value them in USD
+def to_float(base_units, decimals):
+    return int(base_units) / 10 ** decimals
+
+# Vectorised helpers for dataframes, where the decimals depend on the Symbol of every row
+def parse_amounts(values, symbols):
+    return [to_base_units(value, decimals_of(symbol)) for value, symbol in zip(values, symbols)]
+
+# Function converting base units of one symbol into float amounts with one divide; for int64 overflowing wei the
+# conversion to float rounds first, which stays within the precision of a float amount.
+def to_floats(values, symbol):
+    return np.asarray(values, dtype=object).astype(np.float64) / 10 ** decimals_of(symbol)
+
+def format_amounts(values, symbols):
+    return [format_units(value, decimals_of(symbol)) for value, symbol in zip(values, symbols)]
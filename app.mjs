@@ -11,12 +11,40 @@ const app = express();
 const port = 3000;
 
 const csvFilePath = path.join(__dirname, 'public', 'data', 'd_ledgers.csv');
-let df;
+const flowsDir = path.join(__dirname, 'public', 'data', 'flows');
+
+// Flows precomputed by the merger (see flow_aggregates.py): one file of links per quarter plus the big picture.
+// Files are read on first request and kept in memory. Without them, the whole CSV is parsed once as before.
+let flowIndex = null;
 try {
-    const csvData = fs.readFileSync(csvFilePath, 'utf8');
-    df = csvParse(csvData);
+    flowIndex = JSON.parse(fs.readFileSync(path.join(flowsDir, 'index.json'), 'utf8'));
 } catch (error) {
-    console.error('Error reading CSV file:', error);
+    console.log('No precomputed flows, falling back to the CSV file.');
+}
+const flowCache = new Map();
+
+function loadFlows(name) {
+    if (!flowIndex || !flowIndex.files[name]) {
+        return null;
+    }
+    if (!flowCache.has(name)) {
+        const { columns, rows } = JSON.parse(fs.readFileSync(path.join(flowsDir, flowIndex.files[name].file), 'utf8'));
+        flowCache.set(name, rows.map(values => Object.fromEntries(columns.map((column, i) => [column, values[i]]))));
+    }
+    return flowCache.get(name);
+}
+
+let df;
+function loadLedger() {
+    if (!df) {
+        try {
+            const csvData = fs.readFileSync(csvFilePath, 'utf8');
+            df = csvParse(csvData);
+        } catch (error) {
+            console.error('Error reading CSV file:', error);
+        }
+    }
+    return df;
 }
 
 app.use(express.static(path.join(__dirname, 'public')));
@@ -3612,7 +3640,9 @@ function createSankeyData(df, bigPicture = false, quarter = null, walletFilter,
         const receiver = categoryMode ? row.To_category : row.To_name;
         const value = row.DOT_USD;
         const color = colorMap[row.Symbol] || 'gray';
-        const label = `Date: ${row.Date}<br>Receipt: ${row['Transaction Hash']}<br>Token Amount: ${row.Value} ${row.Symbol} <br>USD Amount: ${row.DOT_USD}`;
+        const label = row.Transactions > 1   // Links collapsed by flow_aggregates.py carry totals, not one transfer
+            ? `Dates: ${row.First_date} to ${row.Date}<br>Transactions: ${row.Transactions}<br>Total Token Amount: ${row.Value} ${row.Symbol} <br>Total USD Amount: ${row.DOT_USD}`
+            : `Date: ${row.Date}<br>Receipt: ${row['Transaction Hash']}<br>Token Amount: ${row.Value} ${row.Symbol} <br>USD Amount: ${row.DOT_USD}`;
         const qtr = row.Quarter;
 
         if (bigPicture) {
@@ -3695,7 +3725,8 @@ app.get('/', (req, res) => {
 });
 
 app.get('/quarters', (req, res) => {
-    const uniqueQuarters = Array.from(new Set(df.map(row => row.Quarter)))
+    const quarters = flowIndex ? flowIndex.quarters : loadLedger().map(row => row.Quarter);
+    const uniqueQuarters = Array.from(new Set(quarters))
         .filter(quarter => {
             const [year, q] = quarter.split('Q');
             return parseInt(year) > 2022 || (parseInt(year) === 2022 && parseInt(q) >= 2);
@@ -3707,7 +3738,7 @@ app.get('/data/big_picture', (req, res) => {
     try {
         const walletFilter = req.query.wallet;
         const categoryMode = req.query.category === 'true';
-        const sankeyData = createSankeyData(df, true, null, walletFilter, categoryMode);
+        const sankeyData = createSankeyData(loadFlows('big_picture') || loadLedger(), true, null, walletFilter, categoryMode);
         res.json(sankeyData);
     } catch (error) {
         console.error('Error creating Sankey data:', error);
@@ -3726,8 +3757,9 @@ app.get('/data/:quarter', (req, res) => {
         const walletFilter = req.query.wallet;
         const categoryMode = req.query.category === 'true';
 
-        let filteredDf = df.filter(row => row.Quarter === quarter && row['Transaction Hash'] !== 'Interquarter' && row['From_name'] !== 'New ETH Registrar Controller' && row['From_name'] !== 'Old ETH Registrar Controller');
-        
+        // Precomputed quarters are already filtered
+        let filteredDf = flowIndex ? (loadFlows(quarter) || []) : loadLedger().filter(row => row.Quarter === quarter && row['Transaction Hash'] !== 'Interquarter' && row['From_name'] !== 'New ETH Registrar Controller' && row['From_name'] !== 'Old ETH Registrar Controller');
+
         if (walletFilter) {
             if (categoryMode) {
                 filteredDf = filteredDf.filter(row => row.From_category === walletFilter || row.To_category === walletFilter || row['Transaction Hash'] === walletFilter);
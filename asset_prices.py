@@ -1,3 +1,5 @@
+assets = ('ENS', 'ETH')                                       # Price columns of every row, after the date
+
 prices = [ 
 # Date,        ENS,   ETH
 ("2024-04-24", 15.42, 3193.8),
@@ -0,0 +1,51 @@
+import os
+import stat
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+# Outputs are written to a temporary file and renamed over the old one, so readers never see a half-written file.
+# A file whose content did not change is not touched at all: closed quarters keep their files and modification times,
+# and whatever caches them (the dashboard, rsync, a CDN) does not have to reload them.
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path):
+    try:
+        with open(path, 'rb') as file:
+            return content_hash(file.read())
+    except OSError:
+        return None
+
+# Context manager yielding a temporary file next to path, which replaces path once the block finished. The temporary
+# file has a unique name, so processes writing the same output do not replace each other's half-written files, and it
+# is synced to disk before the rename.
+@contextmanager
+def atomic_write(path, mode='wb', **kwargs):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file = tempfile.NamedTemporaryFile(mode, dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False, **kwargs)
+    try:
+        with file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(file.name, stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644)   # Not the 0600 of temporary files
+        os.replace(file.name, path)
+    except BaseException:
+        try:
+            os.remove(file.name)
+        except OSError:
+            pass
+        raise
+
+# Function writing data (str or bytes) to path unless the file already has this content. Returns the sha256 and whether it was written.
+def write_if_changed(path, data):
+    data = data.encode('utf-8') if isinstance(data, str) else data
+    digest = content_hash(data)
+    if file_hash(path) == digest:
+        return digest, False
+
+    with atomic_write(path) as file:
+        file.write(data)
+    return digest, True
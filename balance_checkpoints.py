@@ -0,0 +1,196 @@
+import sqlite3
+import argparse
+from hashlib import blake2b
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+from quarter_aggregates import AGGREGATES_FILE
+from fiscal_calendar import quarter_labels
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Quarter-end balance checkpoints. The running balance of every (wallet, symbol) at the end of each quarter is stored in base
+# units and USD, next to the row count and a digest of the rows of the quarter. A run recomputes balances only from the first
+# quarter whose rows changed (a new quarter, or one that got a back-dated transfer), starting from the checkpoint of the
+# quarter before it; the balances of earlier quarters are read back. The checkpoints live in the quarter_aggregates database.
+# Validation does not read the history: closed quarters are compared by their row count and by the digest of their rows in the
+# local ledger, which the local stage records while writing it (see record_sources); only the last checkpointed quarter and
+# new ones are hashed. A context (the registries and code the rows were labelled with) invalidates all checkpoints of a
+# ledger when it changes; scoped merges invalidate the quarters they rebuild. Prices of closed quarters do not change,
+# since the price log rejects new prices for logged points (see price_log.validate).
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS checkpoints (
+        ledger TEXT, wallet TEXT, quarter TEXT, symbol TEXT,
+        position INTEGER NOT NULL,                           -- Order of the first row of the symbol in the ledger
+        value TEXT NOT NULL,                                 -- Balance in base units at the end of the quarter
+        dot_usd REAL NOT NULL,                               -- Sum of DOT_USD of the same rows
+        PRIMARY KEY (ledger, wallet, quarter, symbol)
+    )""",
+    """CREATE TABLE IF NOT EXISTS checkpoint_quarters (
+        ledger TEXT, wallet TEXT, quarter TEXT,
+        rows INTEGER NOT NULL, digest TEXT NOT NULL, context TEXT NOT NULL,
+        source TEXT NOT NULL,                                -- Digest of the local ledger rows of the quarter, see record_sources
+        PRIMARY KEY (ledger, wallet, quarter)
+    )""",
+    """CREATE TABLE IF NOT EXISTS source_quarters (
+        wallet TEXT, quarter TEXT, digest TEXT NOT NULL,
+        PRIMARY KEY (wallet, quarter)
+    )"""
+]
+FLOW_COLUMNS = ['Quarter', 'Symbol', 'Value', 'DOT_USD', 'Weight']
+SOURCE_COLUMNS = ['Date', 'From_category', 'To_category', 'Symbol', 'Value', 'DOT_USD']
+
+# Function returning the running balances of flows (FLOW_COLUMNS in ledger order; Weight is how often a row counts for the
+# wallet) at the end of every quarter, as [(quarter, {symbol: [value, dot_usd]})] in quarter order. Symbols are listed in
+# the order of their first row. opening holds the balances before the first quarter.
+def running_balances(flows, opening=None):
+    balances = {symbol: list(balance) for symbol, balance in (opening or {}).items()}
+    for symbol in pd.unique(flows['Symbol'].astype(str)):
+        balances.setdefault(symbol, [0, 0.0])
+    weights = flows['Weight'].to_numpy()
+    sums = pd.DataFrame({
+        'Quarter': flows['Quarter'].astype(str).to_numpy(),
+        'Symbol': flows['Symbol'].astype(str).to_numpy(),
+        'Value': pd.Series([value * weight for value, weight in zip(flows['Value'], weights.tolist())], dtype=object).to_numpy(),   # Python ints, wei sums overflow int64
+        'DOT_USD': flows['DOT_USD'].to_numpy(dtype=np.float64) * weights
+    }).groupby(['Quarter', 'Symbol'], sort=True)[['Value', 'DOT_USD']].sum()
+
+    result, seen = [], set(opening or {})
+    first_rows = flows.assign(Symbol=flows['Symbol'].astype(str)).drop_duplicates('Symbol')
+    first_quarter = dict(zip(first_rows['Symbol'], first_rows['Quarter'].astype(str)))
+    for quarter in sorted(pd.unique(flows['Quarter'].astype(str))):
+        seen.update(symbol for symbol, first in first_quarter.items() if first == quarter)
+        if quarter in sums.index.get_level_values(0):
+            for symbol, (value, dot_usd) in sums.loc[quarter].iterrows():
+                balances[symbol][0] += value
+                balances[symbol][1] += dot_usd
+        result.append((quarter, {symbol: list(balance) for symbol, balance in balances.items() if symbol in seen}))
+    return result
+
+# Order-sensitive digest of the rows of every quarter
+def quarter_digests(flows, columns=FLOW_COLUMNS[1:]):
+    hashes = pd.util.hash_pandas_object(flows[columns].astype(str), index=False).to_numpy()
+    quarters = flows['Quarter'].astype(str).to_numpy()
+    return {quarter: blake2b(hashes[quarters == quarter].tobytes(), digest_size=16).hexdigest() for quarter in pd.unique(quarters)}
+
+class BalanceCheckpoints:
+
+    def __init__(self, path=AGGREGATES_FILE, context=''):
+        self.path = path
+        self.context = context
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Transactions are explicit, see transaction()
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checkpoint_quarters)")]
+        if columns and 'source' not in columns:              # Checkpoints are a cache: an older layout is dropped
+            self.connection.execute("DROP TABLE checkpoint_quarters")
+            self.connection.execute("DROP TABLE IF EXISTS checkpoints")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    # Function recording the digests of the local ledger rows of a wallet by quarter. Called by the stage writing the ledger,
+    # which has all rows at hand; a closed quarter whose digest changed (e.g. a corrected amount) invalidates its checkpoints.
+    def record_sources(self, wallet, df):
+        frame = df.assign(Quarter=quarter_labels(df['Date']).astype(str))
+        digests = quarter_digests(frame, SOURCE_COLUMNS) if len(frame) else {}
+        with self.transaction():
+            self.connection.execute("DELETE FROM source_quarters WHERE wallet = ?", (wallet,))
+            self.connection.executemany("INSERT INTO source_quarters VALUES (?, ?, ?)", [(wallet, quarter, digest) for quarter, digest in digests.items()])
+
+    def _sources(self, wallet):
+        return dict(self.connection.execute("SELECT quarter, digest FROM source_quarters WHERE wallet = ?", (wallet,)).fetchall())
+
+    # Function returning the first quarter whose rows are not those of its checkpoint, or None if every checkpoint is current.
+    # quarters holds the quarter of every row. With hash_closed the closed quarters are hashed too, e.g. for grouped flows,
+    # where a back-dated transfer changes a sum without adding a row.
+    def first_changed(self, ledger, wallet, flows, quarters, hash_closed=False):
+        stored = {quarter: (rows, digest, context, source) for quarter, rows, digest, context, source in self.connection.execute(
+            "SELECT quarter, rows, digest, context, source FROM checkpoint_quarters WHERE ledger = ? AND wallet = ?", (ledger, wallet))}
+        labels, counts = np.unique(quarters, return_counts=True)
+        counts = dict(zip(labels.tolist(), counts.tolist()))
+        if any(context != self.context for _, _, context, _ in stored.values()):
+            return min(set(stored) | set(counts))
+        sources = self._sources(wallet)
+        changed = {quarter for quarter in set(stored) | set(counts)
+                   if quarter not in stored or stored[quarter][0] != counts.get(quarter) or stored[quarter][3] != sources.get(quarter, '')}
+        last = max(stored) if stored else None
+        verified = [quarter for quarter in counts if quarter not in changed and (hash_closed or quarter >= last)]
+        if verified:
+            digests = quarter_digests(flows[np.isin(quarters, verified)])
+            changed.update(quarter for quarter in verified if digests[quarter] != stored[quarter][1])
+        return min(changed) if changed else None
+
+    # Function dropping the checkpoints of a wallet from a quarter on, e.g. after a scoped merge rebuilt that quarter
+    def invalidate(self, wallet, quarter=''):
+        with self.transaction():
+            for table in ['checkpoints', 'checkpoint_quarters', 'source_quarters']:
+                self.connection.execute(f"DELETE FROM {table} WHERE wallet = ? AND quarter >= ?", (wallet, quarter))
+
+    def _read(self, ledger, wallet, before=None):
+        rows = self.connection.execute("SELECT quarter, symbol, value, dot_usd FROM checkpoints WHERE ledger = ? AND wallet = ? AND quarter < ? "
+                                       "ORDER BY quarter, position", (ledger, wallet, before or '9999')).fetchall()
+        balances = {}
+        for quarter, symbol, value, dot_usd in rows:
+            balances.setdefault(quarter, {})[symbol] = [int(value), dot_usd]
+        return balances
+
+    # Main Function. Same result as running_balances(flows), with the quarters before the first changed one read from the
+    # checkpoints and the others computed from the checkpoint before them. The checkpoints are then brought up to date.
+    def running_balances(self, ledger, wallet, flows, hash_closed=False):
+        quarters = flows['Quarter'].astype(str).to_numpy()
+        first = self.first_changed(ledger, wallet, flows, quarters, hash_closed)
+        stored = self._read(ledger, wallet, first)
+        if first is None:
+            return list(stored.items())
+
+        opening = stored[max(stored)] if stored else None
+        changed = flows[quarters >= first]
+        digests = quarter_digests(changed)
+        counts = changed['Quarter'].astype(str).value_counts()
+        computed = running_balances(changed, opening)
+        positions = {symbol: position for position, symbol in enumerate(computed[-1][1] if computed else opening or {})}
+        sources = self._sources(wallet)
+        with self.transaction():
+            self.connection.execute("DELETE FROM checkpoints WHERE ledger = ? AND wallet = ? AND quarter >= ?", (ledger, wallet, first))
+            self.connection.execute("DELETE FROM checkpoint_quarters WHERE ledger = ? AND wallet = ? AND quarter >= ?", (ledger, wallet, first))
+            self.connection.executemany("INSERT INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (ledger, wallet, quarter, symbol, positions[symbol], str(int(value)), float(dot_usd))
+                for quarter, balances in computed for symbol, (value, dot_usd) in balances.items()])
+            self.connection.executemany("INSERT INTO checkpoint_quarters VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (ledger, wallet, quarter, int(counts[quarter]), digests[quarter], self.context, sources.get(quarter, '')) for quarter, _ in computed])
+        return list(stored.items()) + computed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows the quarter-end balance checkpoints kept by the merger.')
+    parser.add_argument('--aggregates', default=AGGREGATES_FILE)
+    parser.add_argument('--wallet')
+    parser.add_argument('--clear', action='store_true', help='drop the checkpoints (of --wallet), e.g. after editing closed quarters by hand')
+    args = parser.parse_args()
+
+    with BalanceCheckpoints(args.aggregates) as checkpoints:
+        if args.clear:
+            for wallet in [args.wallet] if args.wallet else [row[0] for row in checkpoints.connection.execute("SELECT DISTINCT wallet FROM checkpoint_quarters")]:
+                checkpoints.invalidate(wallet)
+        rows = checkpoints.connection.execute("SELECT ledger, wallet, COUNT(DISTINCT quarter), MAX(quarter) FROM checkpoints "
+                                              "WHERE ? IS NULL OR wallet = ? GROUP BY ledger, wallet ORDER BY ledger, wallet",
+                                              (args.wallet, args.wallet)).fetchall()
+    for ledger, wallet, quarters, last in rows:
+        print(f"{ledger:<14}{wallet:<24}{quarters:>4} quarters, last {last}")
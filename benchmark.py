@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import subprocess
+
+# Scaling benchmark for merger.py on synthetic ledgers (see synthetic_ledgers.py).
+# Every size is generated and merged in separate processes, so that the peak RSS of a run is not affected by
+# the generator or by previous sizes. Stage times come from the run metrics of process_directories.
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+MIN_SECONDS = 0.1                                            # Shorter stages are too noisy to be compared with a baseline
+MIN_GROWTH_MB = 16                                           # Smaller memory growth is interpreter and allocator noise
+
+# Child process: runs the full merger on an already generated directory and prints its metrics as JSON
+def run_merger(work_dir):
+    from merger import process_directories
+
+    metrics = process_directories(raw_data_dir=os.path.join(work_dir, 'raw_txs'),
+                                  local_ledgers_dir=os.path.join(work_dir, 'local_ledgers'),
+                                  quarter_dir=os.path.join(work_dir, 'quarterly_ledgers'),
+                                  combined_file=os.path.join(work_dir, 'd_ledgers.csv'),
+                                  flows_dir=os.path.join(work_dir, 'flows'),
+                                  ledgers_dir=os.path.join(work_dir, 'ledgers'),
+                                  deltas_dir=os.path.join(work_dir, 'deltas'),
+                                  store_file=os.path.join(work_dir, 'ledgers.sqlite'),
+                                  aggregates_file=os.path.join(work_dir, 'quarter_aggregates.sqlite'),
+                                  state_file=os.path.join(work_dir, '.pipeline_state.json'))   # Keeps the state of the repository's own runs
+    report = metrics.report()
+    print(json.dumps({
+        'wall_s': report['wall_s'],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,   # Linux reports kilobytes
+        'stages': {stage: {'wall_s': total['wall_s'], 'rows_in': total['rows_in'], 'rows_out': total['rows_out']}
+                   for stage, total in report['totals'].items()}
+    }))
+
+def benchmark_size(size, args):
+    with tempfile.TemporaryDirectory(prefix=f'ens_ledger_{size}_') as work_dir:
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_ledgers.py'), os.path.join(work_dir, 'raw_txs'), '--rows', str(size),
+                        '--wallets', str(args.wallets), '--quarters', str(args.quarters), '--seed', str(args.seed)],
+                       check=True, stdout=subprocess.DEVNULL)
+        merger_run = subprocess.run([sys.executable, __file__, '--child', work_dir], check=True, capture_output=True, text=True)
+        return json.loads(merger_run.stdout.strip().splitlines()[-1])
+
+def print_results(results):
+    stages = list(dict.fromkeys(stage for result in results.values() for stage in result['stages']))
+    sizes = list(results)
+    print(f"{'Stage':<34}" + ''.join(f"{size:>14,}" for size in sizes))
+    for stage in stages:
+        print(f"{stage:<34}" + ''.join(f"{results[size]['stages'].get(stage, {}).get('wall_s', 0):>13.3f}s" for size in sizes))
+    print(f"{'process_directories':<34}" + ''.join(f"{results[size]['wall_s']:>13.3f}s" for size in sizes))
+    print(f"{'Peak RSS, MB':<34}" + ''.join(f"{results[size]['peak_rss_mb']:>14.1f}" for size in sizes))
+
+# Function comparing results with a saved baseline. Every slowdown above the tolerance, or peak RSS growth above the memory
+# tolerance and MIN_GROWTH_MB, is a regression.
+def find_regressions(results, baseline, tolerance, memory_tolerance):
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get(str(size))
+        if not base:
+            continue
+        checks = [('process_directories', result['wall_s'], base['wall_s'])]
+        checks += [(stage, total['wall_s'], base['stages'][stage]['wall_s'])
+                   for stage, total in result['stages'].items() if stage in base['stages']]
+        for name, current, previous in checks:
+            if max(current, previous) >= MIN_SECONDS and current > previous * (1 + tolerance):
+                regressions.append(f"{size:,} rows, {name}: {previous:.3f}s -> {current:.3f}s")
+        current, previous = result['peak_rss_mb'], base['peak_rss_mb']
+        if current - previous >= MIN_GROWTH_MB and current > previous * (1 + memory_tolerance):
+            regressions.append(f"{size:,} rows, peak RSS: {previous:.1f} MB -> {current:.1f} MB")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures how merger.py scales with the number of raw rows.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='total raw rows per run')
+    parser.add_argument('--wallets', type=int, default=7)
+    parser.add_argument('--quarters', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this path')
+    parser.add_argument('--baseline', help='JSON results of a previous run; regressions make the benchmark fail')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown relative to the baseline')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='allowed peak RSS growth relative to the baseline')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_merger(args.child)
+        sys.exit(0)
+
+    results = {}
+    for size in args.sizes:
+        print(f"Benchmarking {size:,} rows...", flush=True)
+        results[size] = benchmark_size(size, args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({str(size): result for size, result in results.items()}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance, args.memory_tolerance)
+        if regressions:
+            print('Regressions against the baseline:')
+            print('\n'.join(f"  {regression}" for regression in regressions))
+            sys.exit(1)
+        print('No regressions against the baseline.')
@@ -0,0 +1,78 @@
+from datetime import date
+from functools import lru_cache
+
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+
+# Fiscal calendar shared by the merger and stream_grouper.
+# Every day is mapped once to its quarter label, quarter end and quarter index, so quarter assignment
+# for a whole column is a single array lookup by day ordinal (days since 1970-01-01). The table is built on first use.
+FIRST_YEAR = 2015
+LAST_YEAR = 2040
+
+# Days moved to another quarter. The sole purpose of the 2022 override is to move the very first working group
+# funding from 2022Q1 to 2022Q2. The transaction was made on March 31 and this fact would have a negative impact
+# on the visualization.
+OVERRIDES = {
+    date(2022, 3, 31): '2022Q2'
+}
+
+def _ordinal(day):
+    return int(np.datetime64(day, 'D').astype(np.int64))
+
+def _label_index(label):                                     # '2024Q1' -> 2024 * 4 + 0
+    return int(label[:4]) * 4 + int(label[5]) - 1
+
+@lru_cache(maxsize=None)
+def _table():
+    days = np.arange(np.datetime64(f'{FIRST_YEAR}-01-01'), np.datetime64(f'{LAST_YEAR + 1}-01-01'), dtype='datetime64[D]')
+    months = days.astype('datetime64[M]').astype(np.int64)   # Months since 1970-01
+    day_index = (months // 12 + 1970) * 4 + (months % 12) // 3
+
+    for day, label in OVERRIDES.items():
+        day_index[_ordinal(day) - _ordinal(days[0])] = _label_index(label)
+
+    first_quarter = int(day_index.min())
+    quarter_count = int(day_index.max()) - first_quarter + 1
+    labels = np.array([f'{i // 4}Q{i % 4 + 1}' for i in range(first_quarter, first_quarter + quarter_count)], dtype=object)
+    ends = np.full(quarter_count, days[0])
+    np.maximum.at(ends, day_index - first_quarter, days)     # The last day assigned to every quarter
+
+    return _ordinal(days[0]), day_index, first_quarter, labels, ends
+
+# Function converting a column of dates (datetime64 or datetime.date) into positions in the table
+def _positions(dates):
+    first_ordinal, day_index, *_ = _table()
+    positions = np.asarray(dates, dtype='datetime64[D]').astype(np.int64) - first_ordinal
+    if positions.size and (positions.min() < 0 or positions.max() >= len(day_index)):
+        raise ValueError(f"Dates outside of the fiscal calendar ({FIRST_YEAR}-{LAST_YEAR})")
+    return positions
+
+def quarter_indices(dates):
+    return _table()[1][_positions(dates)]
+
+def quarter_labels(dates):
+    _, _, first_quarter, labels, _ = _table()
+    return labels[quarter_indices(dates) - first_quarter]
+
+def quarter_ends(dates):
+    _, _, first_quarter, _, ends = _table()
+    return ends[quarter_indices(dates) - first_quarter]
+
+# Function returning the last day of a quarter given its label, e.g. '2024Q1'
+def quarter_end_of(label):
+    _, _, first_quarter, _, ends = _table()
+    return ends[_label_index(label) - first_quarter].astype(date)
+
+# Function returning the quarters overlapping [first_day, last_day] as labels with their first and last days
+def quarter_spans(first_day, last_day):
+    first_ordinal, _, first_quarter, labels, ends = _table()
+    first, last = quarter_indices([first_day, last_day]) - first_quarter
+    starts = np.concatenate([[np.datetime64(first_ordinal, 'D')], ends[:-1] + 1])
+    return labels[first:last + 1], starts[first:last + 1], ends[first:last + 1]
+
+# Function returning the calendar end of a quarter (ignoring OVERRIDES). Interquarter balances are valued at this date.
+def calendar_end_of(label):
+    next_quarter = _label_index(label) + 1
+    return (np.datetime64(f'{next_quarter // 4}-{next_quarter % 4 * 3 + 1:02d}-01') - np.timedelta64(1, 'D')).astype(date)
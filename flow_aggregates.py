@@ -0,0 +1,91 @@
+import os
+import json
+import argparse
+
+from lazy_imports import lazy_import
+from amounts import parse_amounts, format_amounts
+from atomic_files import write_if_changed
+
+pd = lazy_import('pandas')
+
+# Sankey flows precomputed for the dashboard (app.mjs). Transfers between the same two wallets (and categories) in the same
+# quarter and asset are one link, so the server loads a few hundred links per quarter instead of parsing the whole d_ledgers.csv.
+# Interquarter balances, placeholders and named receipts keep their own link; only on-chain hashes are collapsed. A collapsed
+# link has the number of its transactions and the dates of the first and last one instead of a receipt and a date.
+FLOWS_DIR = os.path.join('public', 'data', 'flows')
+LEDGER_FILE = os.path.join('public', 'data', 'd_ledgers.csv')
+INDEX_FILE = 'index.json'
+BIG_PICTURE = 'big_picture'
+VERSION = 2
+
+LINK_COLUMNS = ['Quarter', 'Link', 'From_name', 'From_category', 'To_name', 'To_category', 'Symbol']
+FLOW_COLUMNS = ['Transaction Hash', 'Date', 'From_name', 'From_category', 'To_name', 'To_category', 'Value', 'DOT_USD', 'Symbol',
+                'Quarter', 'Transactions', 'First_date']
+HIDDEN_SENDERS = ['New ETH Registrar Controller', 'Old ETH Registrar Controller']   # Not shown in quarterly views
+
+# Function collapsing the rows of the combined ledger into links. Links keep the order of their first row (sort=False),
+# since the dashboard places the nodes in that order.
+def aggregate_links(df):
+    hashes = df['Transaction Hash'].astype(str)
+    on_chain = hashes.str.startswith('0x')
+    keyed = pd.DataFrame({
+        'Link': hashes.where(~on_chain, ''),
+        'Transaction Hash': hashes,
+        'Date': df['Date'].astype(str).str[:10],
+        'Value': df['Value'],
+        'DOT_USD': df['DOT_USD'].astype(float),
+        **{column: df[column].astype(str) for column in LINK_COLUMNS if column != 'Link'}
+    })
+    links = keyed.groupby(LINK_COLUMNS, sort=False, as_index=False).agg(**{
+        'Transaction Hash': ('Transaction Hash', 'first'),
+        'Date': ('Date', 'max'),
+        'First_date': ('Date', 'min'),
+        'Value': ('Value', 'sum'),
+        'DOT_USD': ('DOT_USD', 'sum'),
+        'Transactions': ('Date', 'size')
+    })
+    collapsed = (links['Link'] == '') & (links['Transactions'] > 1)
+    links.loc[collapsed, 'Transaction Hash'] = links.loc[collapsed, 'Transactions'].astype(str) + ' transactions'
+    links['Value'] = format_amounts(links['Value'], links['Symbol'])
+    return links[FLOW_COLUMNS]
+
+# The rows of a quarterly view, filtered as the dashboard did on every request
+def quarter_rows(df, quarter):
+    return df[(df['Quarter'] == quarter) & (df['Transaction Hash'] != 'Interquarter') & ~df['From_name'].isin(HIDDEN_SENDERS)]
+
+# Links are stored column by column: {"columns": [...], "rows": [[...], ...]}. Unchanged quarters are not rewritten.
+def write_links(links, path):
+    write_if_changed(path, json.dumps({'columns': FLOW_COLUMNS, 'rows': links.to_numpy().tolist()}, separators=(',', ':')))
+
+# Main Function. Takes the combined ledger (amounts in base units) and writes one file per quarter, the big picture and the index.
+def write_flows(combined_df, flows_dir=FLOWS_DIR):
+    os.makedirs(flows_dir, exist_ok=True)
+    quarters = combined_df['Quarter'].astype(str).unique().tolist()   # In ledger order
+    index = {'version': VERSION, 'rows': len(combined_df), 'quarters': quarters, 'files': {}}
+
+    for quarter in quarters:
+        links = aggregate_links(quarter_rows(combined_df, quarter))
+        write_links(links, os.path.join(flows_dir, f'{quarter}.json'))
+        index['files'][quarter] = {'file': f'{quarter}.json', 'links': len(links)}
+
+    links = aggregate_links(combined_df)
+    write_links(links, os.path.join(flows_dir, f'{BIG_PICTURE}.json'))
+    index['files'][BIG_PICTURE] = {'file': f'{BIG_PICTURE}.json', 'links': len(links)}
+
+    write_if_changed(os.path.join(flows_dir, INDEX_FILE), json.dumps(index, indent=2))
+    return index
+
+# Function reading an exported combined ledger back into base units
+def read_combined_ledger(ledger_file=LEDGER_FILE):
+    df = pd.read_csv(ledger_file, dtype=str, keep_default_na=False)
+    df['Value'] = pd.Series(parse_amounts(df['Value'], df['Symbol']), index=df.index, dtype=object)
+    return df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precomputes the Sankey flows of the dashboard from a combined ledger.')
+    parser.add_argument('--ledger', default=LEDGER_FILE)
+    parser.add_argument('--flows-dir', default=FLOWS_DIR)
+    args = parser.parse_args()
+
+    index = write_flows(read_combined_ledger(args.ledger), args.flows_dir)
+    print(f"{index['rows']} rows -> {sum(entry['links'] for entry in index['files'].values())} links in {len(index['files'])} files")
@@ -0,0 +1,68 @@
+import threading
+
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Addresses and transaction hashes are interned into dense integer ids when the data is ingested.
+# Joins, masks and dedupes in the merger then run on int columns, and strings are restored only on export.
+class Interner:
+
+    def __init__(self, values=()):
+        self.ids = {}
+        self.values = []
+        self._lookup = None
+        self._lock = threading.RLock()                       # Wallets may be ingested on several threads
+        self.encode_values(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value):
+        with self._lock:
+            if value not in self.ids:
+                self.ids[value] = len(self.values)
+                self.values.append(value)
+                self._lookup = None
+            return self.ids[value]
+
+    def encode_values(self, values):
+        with self._lock:
+            return [self.intern(value) for value in values]
+
+    # Function interning a whole column. Only the unique values of the column go through the dictionary.
+    def encode(self, series):
+        codes, uniques = pd.factorize(series.fillna(''))
+        ids = np.array(self.encode_values(uniques), dtype=np.int64)
+        return pd.Series(ids[codes], index=series.index, dtype=np.int64)
+
+    def decode(self, ids):
+        with self._lock:
+            if self._lookup is None:
+                self._lookup = np.array(self.values, dtype=object)
+            lookup = self._lookup
+        return lookup[np.asarray(ids, dtype=np.int64)]
+
+    # Function building a lookup array aligned with the ids, e.g. the category of every interned address
+    def table(self, function):
+        return np.array([function(value) for value in self.values], dtype=object)
+
+# The shared table is seeded with the known wallets and annotated transactions, so their ids are stable between runs
+def build_interner(addresses, tx_hashes):
+    return Interner(list(addresses) + list(tx_hashes))
+
+# Columns holding interned values in ingested and combined ledgers
+INTERNED_COLUMNS = ['Transaction Hash', 'From', 'To']
+
+def encode_columns(df, interner):
+    for column in INTERNED_COLUMNS:
+        if column in df.columns:
+            df[column] = interner.encode(df[column])
+    return df
+
+def decode_columns(df, interner):
+    for column in INTERNED_COLUMNS:
+        if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = interner.decode(df[column])
+    return df
@@ -0,0 +1,17 @@
+import sys
+import importlib.util
+
+# Heavy dependencies (pandas, numpy, web3) are imported on first attribute access instead of at import time,
+# so that merger and miner can be imported for a single helper without paying seconds of startup.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
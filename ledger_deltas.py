@@ -0,0 +1,119 @@
+import os
+import json
+import argparse
+from glob import glob
+from hashlib import blake2b
+
+from lazy_imports import lazy_import
+from atomic_files import write_if_changed
+from run_metrics import count_rows_in
+
+pd = lazy_import('pandas')
+
+# Row-level changes of the exported ledgers between runs. Every row gets a stable key from its identity columns
+# (transaction hash, quarter, parties, asset and the occurrence among rows with the same identity) and a hash of its content.
+# The keys and hashes of the previous run are kept in a snapshot; a run that changes anything writes deltas/<version>.json
+# with the inserted, updated and removed rows and increments the version. The first version inserts every row.
+DELTAS_DIR = os.path.join('public', 'data', 'deltas')
+INDEX_FILE = 'index.json'
+SNAPSHOT_FILE = 'snapshot.csv'
+KEEP_DELTAS = 100                                            # Older deltas are removed; consumers behind them reload everything
+KEY_COLUMNS = ['Transaction Hash', 'Quarter', 'From', 'To', 'Symbol']
+
+def _digests(texts):
+    return [blake2b(text.encode('utf-8'), digest_size=8).hexdigest() for text in texts]
+
+def _joined(df, columns):
+    return df[columns[0]].str.cat([df[column] for column in columns[1:]], sep='|') if len(columns) > 1 else df[columns[0]]
+
+# Function returning the key and content hash of every row of a ledger read as strings
+def row_keys(df):
+    columns = [column for column in KEY_COLUMNS if column in df.columns]
+    occurrence = df.groupby(columns, sort=False).cumcount().astype(str)   # Repeated transfers keep their order
+    keys = _digests(_joined(df, columns) + '|' + occurrence)
+    hashes = _digests(_joined(df, list(df.columns)))
+    return pd.Series(hashes, index=pd.Index(keys, name='Key'), name='Hash')
+
+def read_index(deltas_dir):
+    try:
+        with open(os.path.join(deltas_dir, INDEX_FILE), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {'version': 0, 'deltas': []}
+
+def read_snapshot(deltas_dir):
+    path = os.path.join(deltas_dir, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['Ledger', 'Key', 'Hash'], dtype=str)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+# Function comparing one ledger with its previous keys and hashes
+def diff_ledger(df, previous):
+    current = row_keys(df)
+    previous = previous.set_index('Key')['Hash']
+    rows = df.set_axis(current.index)
+    inserted = ~current.index.isin(previous.index)
+    updated = ~inserted & (current != previous.reindex(current.index)).to_numpy()
+    return {
+        'columns': ['Key'] + list(df.columns),
+        'inserted': rows[inserted].reset_index().to_numpy().tolist(),
+        'updated': rows[updated].reset_index().to_numpy().tolist(),
+        'removed': previous.index[~previous.index.isin(current.index)].tolist()
+    }, current
+
+# Main Function. ledgers is {name: path of an exported CSV}. Returns the new delta, or None if no row changed.
+def export_deltas(ledgers, deltas_dir=DELTAS_DIR):
+    index, snapshot = read_index(deltas_dir), read_snapshot(deltas_dir)
+    previous = dict(tuple(snapshot.groupby('Ledger', sort=False)))
+    changes, keys = {}, []
+
+    for name, path in ledgers.items():
+        df = count_rows_in(pd.read_csv(path, dtype=str, keep_default_na=False))
+        change, current = diff_ledger(df, previous.pop(name, snapshot.iloc[:0]))
+        keys.append(current.reset_index().assign(Ledger=name))
+        if change['inserted'] or change['updated'] or change['removed']:
+            changes[name] = change
+    for name, rows in previous.items():                      # Ledgers that are no longer exported
+        changes[name] = {'columns': [], 'inserted': [], 'updated': [], 'removed': rows['Key'].tolist()}
+
+    if not changes:
+        return None
+
+    version = index['version'] + 1
+    delta = {'version': version, 'previous': index['version'], 'ledgers': changes}
+    file_name = f'{version:06d}.json'
+    write_if_changed(os.path.join(deltas_dir, file_name), json.dumps(delta, separators=(',', ':')))
+    snapshot = pd.concat(keys) if keys else snapshot.iloc[:0]
+    write_if_changed(os.path.join(deltas_dir, SNAPSHOT_FILE), snapshot[['Ledger', 'Key', 'Hash']].to_csv(index=False))
+
+    deltas = index['deltas'] + [file_name]
+    for old_file in deltas[:-KEEP_DELTAS]:
+        try:
+            os.remove(os.path.join(deltas_dir, old_file))
+        except OSError:
+            pass
+    write_if_changed(os.path.join(deltas_dir, INDEX_FILE), json.dumps({'version': version, 'deltas': deltas[-KEEP_DELTAS:]}, indent=2))
+    return delta
+
+def local_ledger_files(local_ledgers_dir='local_ledgers'):
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in sorted(glob(os.path.join(local_ledgers_dir, '*.csv')))}
+
+# Ledgers tracked by the merger: the combined ledger and every local ledger
+def ledger_files(combined_file='d_ledgers.csv', local_ledgers_dir='local_ledgers'):
+    files = {'d_ledgers': combined_file}
+    files.update({f'local/{wallet}': path for wallet, path in local_ledger_files(local_ledgers_dir).items()})
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the row-level changes of the exported ledgers since the last run.')
+    parser.add_argument('--combined-file', default='d_ledgers.csv')
+    parser.add_argument('--local-ledgers-dir', default='local_ledgers')
+    parser.add_argument('--deltas-dir', default=DELTAS_DIR)
+    args = parser.parse_args()
+
+    delta = export_deltas(ledger_files(args.combined_file, args.local_ledgers_dir), args.deltas_dir)
+    if delta is None:
+        print('No changes since the last version')
+    else:
+        counts = [sum(len(change[kind]) for change in delta['ledgers'].values()) for kind in ('inserted', 'updated', 'removed')]
+        print(f"Version {delta['version']}: {counts[0]} inserted, {counts[1]} updated, {counts[2]} removed")
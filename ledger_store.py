@@ -0,0 +1,231 @@
+import os
+import sqlite3
+import argparse
+import importlib.util
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+from atomic_files import file_hash
+from run_metrics import count_rows_in
+from fiscal_calendar import quarter_labels
+from amounts import to_base_units, to_float, decimals_of
+
+pd = lazy_import('pandas')
+
+# Embedded database of the local ledgers: one normalized transfer table plus the wallet and transaction category dimensions.
+# SQLite (standard library) is used unless DuckDB is installed. The merger refreshes a ledger only when its file changed,
+# so queries such as "Metagov ENS outflows to X in 2023" are answered from indexes instead of reading every CSV.
+STORE_FILES = {
+    'sqlite': 'ledgers.sqlite',
+    'duckdb': 'ledgers.duckdb'
+}
+BACKENDS = ['auto', 'sqlite', 'duckdb']
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS transfers (
+        wallet TEXT NOT NULL,                                -- Local ledger the row comes from
+        tx_hash TEXT NOT NULL,
+        date TEXT NOT NULL,                                  -- YYYY-MM-DD
+        quarter TEXT NOT NULL,                               -- Fiscal quarter, e.g. 2024Q1
+        from_address TEXT, from_name TEXT, from_category TEXT,
+        to_address TEXT, to_name TEXT, to_category TEXT,
+        value TEXT NOT NULL,                                 -- Exact decimal amount as exported
+        amount DOUBLE NOT NULL,                              -- The same amount as a float, for sums
+        dot_usd DOUBLE,
+        symbol TEXT NOT NULL,
+        acquainted INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS transfers_wallet_quarter ON transfers (wallet, quarter)",
+    "CREATE INDEX IF NOT EXISTS transfers_from_category ON transfers (from_category)",
+    "CREATE INDEX IF NOT EXISTS transfers_to_category ON transfers (to_category)",
+    "CREATE INDEX IF NOT EXISTS transfers_tx_hash ON transfers (tx_hash)",
+    "CREATE INDEX IF NOT EXISTS transfers_date ON transfers (date)",
+    "CREATE TABLE IF NOT EXISTS wallets (address TEXT PRIMARY KEY, name TEXT NOT NULL, category TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS tx_categories (tx_hash TEXT PRIMARY KEY, category TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS ledgers (wallet TEXT PRIMARY KEY, sha256 TEXT NOT NULL, rows INTEGER NOT NULL)"
+]
+TRANSFER_COLUMNS = ['wallet', 'tx_hash', 'date', 'quarter', 'from_address', 'from_name', 'from_category', 'to_address', 'to_name',
+                    'to_category', 'value', 'amount', 'dot_usd', 'symbol', 'acquainted']
+
+def resolve_backend(backend='auto'):
+    if backend == 'auto':
+        return 'duckdb' if importlib.util.find_spec('duckdb') else 'sqlite'
+    return backend
+
+# Function converting an exported local ledger into rows of the transfer table
+def normalize_ledger(df, wallet):
+    decimals = [decimals_of(symbol) for symbol in df['Symbol']]
+    return pd.DataFrame({
+        'wallet': wallet,
+        'tx_hash': df['Transaction Hash'],
+        'date': df['Date'],
+        'quarter': quarter_labels(df['Date'].to_numpy().astype('datetime64[D]')),
+        'from_address': df['From'],
+        'from_name': df['From_name'],
+        'from_category': df['From_category'],
+        'to_address': df['To'],
+        'to_name': df['To_name'],
+        'to_category': df['To_category'],
+        'value': df['Value'],
+        'amount': [to_float(to_base_units(value, decimal), decimal) for value, decimal in zip(df['Value'], decimals)],
+        'dot_usd': pd.to_numeric(df['DOT_USD'], errors='coerce'),
+        'symbol': df['Symbol'],
+        'acquainted': pd.to_numeric(df['Acquainted?'], errors='coerce').fillna(0).astype(int)
+    }, columns=TRANSFER_COLUMNS)
+
+class LedgerStore:
+
+    def __init__(self, path=None, backend='auto'):
+        self.backend = resolve_backend(backend)
+        self.path = path or STORE_FILES[self.backend]
+        if self.backend == 'duckdb':
+            duckdb = lazy_import('duckdb')
+            self.connection = duckdb.connect(self.path)
+        else:
+            self.connection = sqlite3.connect(self.path, isolation_level=None)   # Transactions are explicit, see transaction()
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _insert(self, table, df):
+        if df.empty:
+            return
+        if self.backend == 'duckdb':                         # DuckDB scans the frame directly; executemany is slow there
+            self.connection.register('_rows', df)
+            self.connection.execute(f"INSERT INTO {table} SELECT * FROM _rows")
+            self.connection.unregister('_rows')
+        else:
+            placeholders = ', '.join('?' * len(df.columns))
+            self.connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", df.itertuples(index=False, name=None))
+
+    def _replace(self, table, df, where='', params=()):
+        self.connection.execute(f"DELETE FROM {table} {where}", params)
+        self._insert(table, df)
+
+    # Function replacing the dimensions with the hand made databases (wallets_dict and txs_dict of merger.build_lookups)
+    def update_dimensions(self, wallets_dict, txs_dict):
+        with self.transaction():
+            self._replace('wallets', pd.DataFrame([(address, name, category) for address, (name, category) in wallets_dict.items()],
+                                                  columns=['address', 'name', 'category']))
+            self._replace('tx_categories', pd.DataFrame(list(txs_dict.items()), columns=['tx_hash', 'category']))
+
+    # Main Function. ledgers is {wallet: path of its local ledger}. Ledgers whose sha256 did not change are skipped,
+    # ledgers that are gone are removed. Every ledger is replaced in one transaction. Returns the refreshed wallets.
+    def update_ledgers(self, ledgers):
+        stored = dict(self.connection.execute("SELECT wallet, sha256 FROM ledgers").fetchall())
+        refreshed = []
+        for wallet, path in ledgers.items():
+            digest = file_hash(path)
+            if stored.get(wallet) == digest:
+                continue
+            rows = normalize_ledger(count_rows_in(pd.read_csv(path, dtype=str, keep_default_na=False)), wallet)
+            with self.transaction():
+                self._replace('transfers', rows, "WHERE wallet = ?", (wallet,))
+                self._replace('ledgers', pd.DataFrame([(wallet, digest, len(rows))], columns=['wallet', 'sha256', 'rows']),
+                              "WHERE wallet = ?", (wallet,))
+            refreshed.append(wallet)
+
+        for wallet in set(stored) - set(ledgers):
+            with self.transaction():
+                self.connection.execute("DELETE FROM transfers WHERE wallet = ?", (wallet,))
+                self.connection.execute("DELETE FROM ledgers WHERE wallet = ?", (wallet,))
+        return refreshed
+
+    def query(self, statement, params=()):
+        cursor = self.connection.execute(statement, params)
+        return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+    # Function returning transfers matching every given filter. direction is 'in' or 'out' relative to the category of
+    # the wallet; counterparty matches the name or category on the other side (or on either side without a direction).
+    def transfers(self, wallet=None, quarter=None, category=None, tx_hash=None, symbol=None, direction=None, counterparty=None,
+                  start=None, end=None, limit=None):
+        conditions, params = [], []
+        def where(condition, *values):
+            conditions.append(condition)
+            params.extend(values)
+
+        if wallet:
+            where("wallet = ?", wallet)
+        if quarter:
+            where("quarter = ?", quarter)
+        if category:
+            where("(from_category = ? OR to_category = ?)", category, category)
+        if tx_hash:
+            where("tx_hash = ?", tx_hash)
+        if symbol:
+            where("symbol = ?", symbol)
+        if direction == 'out':
+            where("from_category = wallet")
+        elif direction == 'in':
+            where("to_category = wallet")
+        if counterparty:
+            sides = {'out': ['to'], 'in': ['from']}.get(direction, ['from', 'to'])
+            where('(' + ' OR '.join(f"{side}_name = ? OR {side}_category = ?" for side in sides) + ')', *[counterparty] * 2 * len(sides))
+        if start:
+            where("date >= ?", str(start))
+        if end:
+            where("date <= ?", str(end))
+
+        statement = "SELECT * FROM transfers" + (" WHERE " + " AND ".join(conditions) if conditions else '') + " ORDER BY date, wallet"
+        if limit:
+            statement += f" LIMIT {int(limit)}"
+        return self.query(statement, params)
+
+# Function called by the merger after the local ledgers are exported
+def update_store(ledgers, wallets_dict, txs_dict, path=None, backend='auto'):
+    with LedgerStore(path, backend) as store:
+        store.update_dimensions(wallets_dict, txs_dict)
+        return store.update_ledgers(ledgers)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Queries the ledger database maintained by the merger.')
+    parser.add_argument('--store', help='database file, ledgers.sqlite or ledgers.duckdb by default')
+    parser.add_argument('--backend', choices=BACKENDS, default='auto')
+    parser.add_argument('--wallet', help='local ledger, e.g. Metagov')
+    parser.add_argument('--quarter', help='e.g. 2023Q4')
+    parser.add_argument('--category', help='category on either side')
+    parser.add_argument('--tx-hash')
+    parser.add_argument('--symbol')
+    parser.add_argument('--direction', choices=['in', 'out'], help='relative to the wallet')
+    parser.add_argument('--counterparty', help='name or category of the other side')
+    parser.add_argument('--start', help='first date (YYYY-MM-DD)')
+    parser.add_argument('--end', help='last date (YYYY-MM-DD)')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--sql', help='run this statement instead of the filters')
+    parser.add_argument('--output', help='write the result to this CSV instead of printing it')
+    args = parser.parse_args(argv)
+
+    store_path = args.store or STORE_FILES[resolve_backend(args.backend)]
+    if not os.path.exists(store_path):
+        parser.error(f"{store_path} does not exist; it is created by merger.py")
+    with LedgerStore(store_path, args.backend) as store:
+        if args.sql:
+            result = store.query(args.sql)
+        else:
+            result = store.transfers(args.wallet, args.quarter, args.category, args.tx_hash, args.symbol, args.direction,
+                                     args.counterparty, args.start, args.end, args.limit)
+    if args.output:
+        result.to_csv(args.output, index=False)
+    else:
+        print(result.to_string(index=False) if len(result) else 'No transfers')
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,86 @@
 import os
-import pandas as pd
+import json
+import argparse
+import threading
 from glob import glob
+from datetime import date
+
+from amounts import decimals_of, to_base_units, to_float, to_floats, parse_amounts, format_amounts
+from interning import build_interner, encode_columns, decode_columns
+from fiscal_calendar import quarter_labels, quarter_end_of, calendar_end_of
+from run_metrics import RunMetrics, count_rows_in
+from table_cache import load_tables, compile_table, source_path
+from price_log import load_price_store, load_price_series, DAY, PRICE_DIR
+from flow_aggregates import write_flows, FLOWS_DIR
+from stream_grouper import update_streams, RATES_FILE, SENDER as STREAM_SENDER
+from atomic_files import write_if_changed, content_hash
+from ledger_deltas import export_deltas, ledger_files, local_ledger_files, DELTAS_DIR
+from ledger_store import update_store, resolve_backend, STORE_FILES
+from raw_store import RawStore, with_export
+from quarter_aggregates import QuarterAggregates, AGGREGATES_FILE
+from balance_checkpoints import BalanceCheckpoints, running_balances
+from pipeline import Pipeline, Stage, path_hash, STATE_FILE as PIPELINE_STATE
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')                                    # Heavy imports are loaded on first use, so importing
+pd = lazy_import('pandas')                                   # a single helper from merger stays cheap
+
+VALUATIONS = ['daily', 'asof']                               # 'asof' values ETH and ENS at the last price point before each transfer
+MAX_PRICE_AGE = DAY                                          # Older price points are not used; the daily valuation is kept
+
+# Function returning the as-of price of every row: the last price point of its symbol at or before its timestamp.
+# One sorted merge for the whole frame; rows without a recent enough price point get NaN.
+def asof_prices(symbols, timestamps, price_series, max_age=MAX_PRICE_AGE):
+    rows = pd.DataFrame({'timestamp': np.asarray(timestamps, dtype=np.int64), 'asset': np.asarray(symbols, dtype=object).astype(str),
+                         'row': np.arange(len(symbols))}).sort_values('timestamp', kind='stable')
+    matched = pd.merge_asof(rows, price_series, on='timestamp', by='asset', direction='backward', tolerance=max_age)
+    prices = np.full(len(symbols), np.nan)
+    prices[matched['row'].to_numpy()] = matched['price'].to_numpy()
+    return prices
+
+def revalue_asof(df, timestamps, price_series):
+    volatile = df['Symbol'].isin(['ETH', 'ENS']).to_numpy()  # USDC keeps its fixed price
+    prices = asof_prices(df['Symbol'].to_numpy()[volatile], timestamps[volatile], price_series)
+    priced = np.flatnonzero(volatile)[~np.isnan(prices)]
+    values, symbols = df['Value'].to_numpy()[priced], df['Symbol'].to_numpy()[priced]
+    amounts = np.empty(len(priced))
+    for symbol in pd.unique(symbols):                        # One divide per symbol, since the decimals depend on it
+        rows = symbols == symbol
+        amounts[rows] = to_floats(values[rows], symbol)
+    df.iloc[priced, df.columns.get_loc('DOT_USD')] = amounts * prices[~np.isnan(prices)]
+    return df
+
+def unix_timestamps(datetimes):
+    return datetimes.to_numpy().astype('datetime64[s]').astype(np.int64)
+
+# Ingested rows carry the int64 Unix timestamp provided by Etherscan; dates and quarters are derived from it arithmetically.
+# Rows appended by the miner have '|' instead of a timestamp, so only those fall back to parsing the date string.
+def ingest_timestamps(df):
+    timestamps = pd.to_numeric(df['Timestamp'], errors='coerce')
+    missing = timestamps.isna()
+    if missing.any():
+        timestamps[missing] = unix_timestamps(pd.to_datetime(df.loc[missing, 'Date']))
+    return timestamps.astype(np.int64)
+
+def timestamp_dates(timestamps):
+    return pd.Series((timestamps.to_numpy() // DAY).astype('datetime64[D]').astype('datetime64[s]'), index=timestamps.index)
 
-from ens_wallets import ens_wallets
-from transactions import various_txs
-from asset_prices import prices
+# Raw transfers are read from a token.csv / internal.csv export, or given as a frame in the same layout (see raw_store.py)
+def read_raw(source, dtype):
+    return source.copy() if isinstance(source, pd.DataFrame) else count_rows_in(pd.read_csv(source, dtype=dtype))
+
+TOKEN_DTYPE = {'TokenValue': str}
+INTERNAL_DTYPE = {'Value_IN(ETH)': str, 'Value_OUT(ETH)': str}
 
 # Function aimed at unifying data downloaded from etherscan for erc-20 transactions
-def process_erc20_txs(token_file, prices_dict):
-    df = pd.read_csv(token_file)
+def process_erc20_txs(token_file, price_store, interner, price_series=None):
+    df = read_raw(token_file, TOKEN_DTYPE)
 
-    col_to_remove = ['Blockno', 'UnixTimestamp', 'ContractAddress', 'TokenName']
+    col_to_remove = ['Blockno', 'ContractAddress', 'TokenName']
     df.drop(columns=col_to_remove, inplace=True)
 
     col_to_rename = {
+        'UnixTimestamp': 'Timestamp',
         'DateTime (UTC)': 'Date',
         'TokenValue': 'Value',
         'USDValueDayOfTx': 'DOT_USD',                        #DOT_USD - "DayOfTx", Reflects the amount in USD at the time of the transaction.
@@ -26,28 +93,26 @@ def process_erc20_txs(token_file, prices_dict):
     df['Original_WETH'] = df['Symbol'] == 'WETH'
     df['Symbol'] = df['Symbol'].replace({'WETH': 'ETH'})     # It is easier to combine those transactions quarterly.
 
-    df['Value'] = pd.to_numeric(df['Value'].astype(str).replace(r'[\$,]', '', regex=True), errors='coerce')
+    df['Value'] = pd.Series(parse_amounts(df['Value'], df['Symbol']), index=df.index, dtype=object)
     df['DOT_USD'] = pd.to_numeric(df['DOT_USD'].astype(str).replace(r'[\$,]', '', regex=True), errors='coerce')
-    df['Date'] = pd.to_datetime(df['Date']).dt.date
-
-    for index, row in df.iterrows():
-        if pd.isna(row['DOT_USD']):
-            date = row['Date']                               # Typically Etherscan provides information about the amount at the time of transfer
-            value = row['Value']                             # However, this does not always happen; for example, in cases with multisends, DayOfTx has no value.
-            symbol = row['Symbol']                           # To solve that, prices_dict was introduced, which stores asset prices.
-            if symbol == 'USDC':
-                df.at[index, 'DOT_USD'] = value
-            elif symbol in ['ETH', 'ENS']:
-                price = prices_dict.get(date, (0, 0))[0 if symbol == 'ENS' else 1]
-                df.at[index, 'DOT_USD'] = value * price
+    df['Timestamp'] = ingest_timestamps(df)
+    df['Date'] = timestamp_dates(df['Timestamp'])
 
-    return df
+    missing = df['DOT_USD'].isna()                           # Typically Etherscan provides information about the amount at the time of transfer
+    for symbol in df.loc[missing, 'Symbol'].unique():        # However, this does not always happen; for example, in cases with multisends, DayOfTx has no value.
+        rows = missing & (df['Symbol'] == symbol)            # To solve that, the price store was introduced, which stores asset prices.
+        amounts = to_floats(df.loc[rows, 'Value'].to_numpy(), symbol)
+        df.loc[rows, 'DOT_USD'] = amounts * price_store.price(symbol, df.loc[rows, 'Date'])
+    if price_series is not None:
+        revalue_asof(df, df['Timestamp'].to_numpy(), price_series)
+
+    return encode_columns(df, interner)                      # Addresses and hashes are interned into integer ids
 
 # Function aimed at unifying data downloaded from etherscan for internal transactions
-def process_internal_txs(internal_file):
-    df = pd.read_csv(internal_file)
+def process_internal_txs(internal_file, interner, price_series=None):
+    df = read_raw(internal_file, INTERNAL_DTYPE)
 
-    col_to_remove = ['Blockno', 'UnixTimestamp', 'ParentTxFrom', 'ParentTxTo', 
+    col_to_remove = ['Blockno', 'ParentTxFrom', 'ParentTxTo', 
                          'ParentTxETH_Value', 'ContractAddress', 'ErrCode', 'Type', 'PrivateNote']
     df.drop(columns=col_to_remove, inplace=True)
     df.drop(columns=[col for col in df if col.startswith('CurrentValue @')], inplace=True)
@@ -55,72 +120,91 @@ def process_internal_txs(internal_file):
 
     numeric_columns = [                                      # The sign in front of the transfer value in ETH is set using the original Value_IN and Value_OUT columns.
         'Value_IN(ETH)', 'Value_OUT(ETH)', 'Historical $Price/Eth']
-    for column in numeric_columns:                                                    
-        df[column] = pd.to_numeric(df[column], errors='coerce')
-    df['Value'] = df.apply(lambda x: x['Value_IN(ETH)'] if x['Value_OUT(ETH)'] == 0 else -x['Value_OUT(ETH)']
-                             if x['Value_IN(ETH)'] == 0 else max(x['Value_IN(ETH)'], -x['Value_OUT(ETH)']), axis=1) 
-    df['DOT_USD'] = df['Value'] * df['Historical $Price/Eth'] # Calculating DOT_USD for ETH transactions
+    df['Historical $Price/Eth'] = pd.to_numeric(df['Historical $Price/Eth'], errors='coerce')
+    value_in = [to_base_units(value, decimals_of('ETH')) for value in df['Value_IN(ETH)']]
+    value_out = [to_base_units(value, decimals_of('ETH')) for value in df['Value_OUT(ETH)']]
+    df['Value'] = pd.Series([value_in if value_out == 0 else -value_out if value_in == 0 else max(value_in, -value_out)
+                             for value_in, value_out in zip(value_in, value_out)], index=df.index, dtype=object)
+    df['DOT_USD'] = to_floats(df['Value'].to_numpy(), 'ETH') * df['Historical $Price/Eth'] # Calculating DOT_USD for ETH transactions
     df.drop(columns=numeric_columns, inplace=True)
 
     col_to_rename = {
+        'UnixTimestamp': 'Timestamp',
         'DateTime (UTC)': 'Date', 
         'TxTo': 'To'
     }
     df.rename(columns=col_to_rename, inplace=True)
 
-    df['Date'] = pd.to_datetime(df['Date']).dt.date
+    df['Timestamp'] = ingest_timestamps(df)
+    df['Date'] = timestamp_dates(df['Timestamp'])
     df['Symbol'] = 'ETH'
+    if price_series is not None:
+        revalue_asof(df, df['Timestamp'].to_numpy(), price_series)
 
-    return df
+    return encode_columns(df, interner)
 
 # Function to merge erc20 and internal txs
 def merge_txs(df1, df2):
     merged_df = pd.concat([df1, df2])
-    merged_df['Date'] = pd.to_datetime(merged_df['Date'])
     merged_df.sort_values(by='Date', inplace=True)
 
     merged_df = merged_df[
         (merged_df['Value'] != 0) &                          # Removing Nulls
         ~((merged_df['Symbol'] == 'USDC') & 
-        (merged_df['Value'] == 1)) &                         # Removing Tests
+        (merged_df['Value'] == 10 ** decimals_of('USDC'))) & # Removing Tests
         (merged_df['From'] != merged_df['To'])               # Removing Self Txs
     ]
 
     return merged_df
 
-# Function assigning names to wallets
-def identify_wallets(df, wallets_dict, txs_dict, folder_name):
+# Name, category and symbol columns share one categorical dictionary across all wallets,
+# so that concatenating per-wallet frames keeps the categorical dtype and groupbys run on integer codes.
+LABEL_COLUMNS = ['From_name', 'From_category', 'To_name', 'To_category', 'Symbol']
+
+def build_label_dtype(wallets_dict, txs_dict, labels=()):
+    known_labels = {label for pair in wallets_dict.values() for label in pair} | set(txs_dict.values())
+    known_labels |= {'ETH', 'USDC', 'ENS', 'Plchld', 'Community SG'}
+    return pd.CategoricalDtype(sorted(known_labels | set(labels)))
+
+def apply_labels(df, label_dtype):
+    for column in LABEL_COLUMNS:
+        if column in df.columns:
+            labels = df[column].astype(label_dtype)
+            if labels.isna().sum() != df[column].isna().sum():
+                raise ValueError(f"'{column}' has values outside of the shared label dictionary")
+            df[column] = labels
+    return df
 
-    def replace_on_match(to, from_address, txhash):          # Replacement based on the location of the wallet
-        if txhash in txs_dict:                               # in the hand made 'transactions' database. Read more: readme
-            if folder_name == from_address:
-                return txs_dict[txhash], from_address
-            else:
-                return to, txs_dict[txhash]
-        return to, from_address
-    
-    def check_acquaintance(row):                             # Flag for further deleting unknown transactions in a grouped dataframe
-        from_known = any(row['From_category'] == wallet_category for wallet_category, _ in wallets_dict.values()) or row['From_category'] in txs_dict.values()
-        to_known = any(row['To_category'] == wallet_category for wallet_category, _ in wallets_dict.values()) or row['To_category'] in txs_dict.values()
-        return 1 if from_known and to_known else 0
-    
-    df['From_category'] = df['From'].apply(lambda address: 
-                    wallets_dict.get(address, (address, address))[0])     # Replacement based on the location of the wallet
-    df['To_category'] = df['To'].apply(lambda address:                    # in the 'ens_wallets' category. Read more: readme
-                    wallets_dict.get(address, (address, address))[0])
-    df['From_name'] = df['From'].apply(lambda address:
-                    wallets_dict.get(address, (address, address))[1])
-    df['To_name'] = df['To'].apply(lambda address: 
-                    wallets_dict.get(address, (address, address))[1])
-
-    df[['To_category', 'From_category']] = df.apply(lambda row: replace_on_match
-                                  (row['To_category'], row['From_category'], row.get('Transaction Hash', '')), axis=1, result_type='expand')
-
-    df['From_name'] = df.apply(lambda row: 
-                    row['From_category'] if row['From_name'] == row['From'] else row['From_name'], axis=1)
-    df['To_name'] = df.apply(lambda row: 
-                    row['To_category'] if row['To_name'] == row['To'] else row['To_name'], axis=1)
-    df['Acquainted?'] = df.apply(check_acquaintance, axis=1)
+# Function assigning names to wallets
+def identify_wallets(df, wallets_dict, txs_dict, folder_name, interner, label_dtype):
+    category_of = interner.table(lambda value: wallets_dict.get(value, (value, value))[0])  # Lookup tables aligned with the interned ids.
+    name_of = interner.table(lambda value: wallets_dict.get(value, (value, value))[1])      # Unknown addresses keep the address itself.
+    is_wallet = interner.table(lambda value: value in wallets_dict).astype(bool)
+    annotation_of = interner.table(txs_dict.get)
+
+    from_ids = df['From'].to_numpy()
+    to_ids = df['To'].to_numpy()
+    annotation = annotation_of[df['Transaction Hash'].to_numpy()]
+
+    from_category = category_of[from_ids]                    # Replacement based on the location of the wallet
+    to_category = category_of[to_ids]                        # in the 'ens_wallets' category. Read more: readme
+
+    annotated = pd.notna(annotation)                         # Replacement based on the location of the wallet
+    outgoing = from_category == folder_name                  # in the hand made 'transactions' database. Read more: readme
+    to_category = np.where(annotated & outgoing, annotation, to_category)
+    from_category = np.where(annotated & ~outgoing, annotation, from_category)
+
+    df['From_category'] = from_category
+    df['To_category'] = to_category
+    df['From_name'] = np.where(is_wallet[from_ids], name_of[from_ids], from_category)
+    df['To_name'] = np.where(is_wallet[to_ids], name_of[to_ids], to_category)
+
+    known_categories = {category for category, _ in wallets_dict.values()} | set(txs_dict.values())
+    df['Acquainted?'] = (df['From_category'].isin(known_categories) &      # Flag for further deleting unknown transactions
+                         df['To_category'].isin(known_categories)).astype(int) # in a grouped dataframe
+    for column in LABEL_COLUMNS[:4]:                         # Unknown counterparties are left out of the dictionary: their label
+        df[column] = df[column].where(df[column].isin(label_dtype.categories))   # is their address, restored on export (see decode_ledger)
+    apply_labels(df, label_dtype)
 
     mask = (                                                 # The sign before the value for erc20 transactions
         (df['From_category'] == folder_name) &               # is assigned using the folder_name membership.
@@ -129,136 +213,73 @@ def identify_wallets(df, wallets_dict, txs_dict, folder_name):
     )                                                        # and the Ecosystem ledger will have 100 USDC.
     df.loc[mask, ['Value', 'DOT_USD']] *= -1
 
-    df = df.reindex(columns=['Transaction Hash', 'Date', 'From', 'From_name','From_category', 'To', 'To_name', 'To_category', 'Value', 'DOT_USD', 'Symbol', 'Acquainted?'])
+    df = df.reindex(columns=['Transaction Hash', 'Timestamp', 'Date', 'From', 'From_name','From_category', 'To', 'To_name', 'To_category', 'Value', 'DOT_USD', 'Symbol', 'Acquainted?'])
 
     return df
 
-def add_quarter(date):         
-    year, month, day = date.year, date.month, date.day       # The sole purpose of this feature is to move the very first
-    if year == 2022:                                         # working group funding from 2022Q1 to 2022Q2.
-        if (month < 3) or (month == 3 and day < 31):
-            return f'{year}Q1'
-        elif (month == 3 and day == 31) or (month > 3 and month < 7):
-            return f'{year}Q2'
-        elif (month > 6 and month < 10):                     
-            return f'{year}Q3'                               # The transaction was made on March 31 and this fact would
-        else:                                                # have a negative impact on the visualization.
-            return f'{year}Q4'
-    else:
-        if month in (1, 2, 3):
-            return f'{year}Q1'
-        elif month in (4, 5, 6):
-            return f'{year}Q2'
-        elif month in (7, 8, 9):
-            return f'{year}Q3'
-        else:
-            return f'{year}Q4'
-        
-def get_quarter_end_date(date):
-    if not pd.isna(date):
-        year, month, day = date.year, date.month, date.day
-        if year == 2022:
-            if month <= 3:
-                return pd.Timestamp(f'{year}-03-30')
-            elif month <= 6:
-                return pd.Timestamp(f'{year}-06-30')
-            elif month <= 9:
-                return pd.Timestamp(f'{year}-09-30')
-            else:
-                return pd.Timestamp(f'{year}-12-31')
-        else:
-            if month <= 3:
-                return pd.Timestamp(f'{year}-03-31')
-            elif month <= 6:
-                return pd.Timestamp(f'{year}-06-30')
-            elif month <= 9:
-                return pd.Timestamp(f'{year}-09-30')
-            else:
-                return pd.Timestamp(f'{year}-12-31')
-    return None
-
 # Grouping by quarter
 def group_by_quarter(df):
-    df['Quarter'] = df['Date'].apply(add_quarter)
-    grouped_df = df.groupby(['Quarter', 'From_category', 'To_category', 'Symbol'], as_index=False).agg({'Value': 'sum', 'DOT_USD': 'sum'})
+    df['Quarter'] = quarter_labels(df['Date'])               # Quarters come from the shared fiscal calendar, see fiscal_calendar.py
+    grouped_df = df.groupby(['Quarter', 'From_category', 'To_category', 'Symbol'], as_index=False, observed=True).agg({'Value': 'sum', 'DOT_USD': 'sum'})
     return grouped_df
 
-# The function adds interquarter balances for the benefit of future visualization
-def add_unspent_balances(grouped_df, prices_dict, folder_name):
-    unspent_df = pd.DataFrame()
-    quarters = sorted(grouped_df['Quarter'].unique())
-    symbols = grouped_df['Symbol'].unique()
-    cumulative_unspent = {symbol: 0 for symbol in symbols}   # The balances are summed up and transferred to the next interquarter balance
+QUARTERLY_COLUMNS = ['Quarter', 'From_category', 'To_category', 'Symbol', 'Value', 'DOT_USD']
+
+# The function adds interquarter balances for the benefit of future visualization.
+# opening ({symbol: balance}) starts the balances of a scoped run at those stored for the previous quarter, see scoped_merge.py.
+# With checkpoints the balances of unchanged quarters are read back instead of summed again, see balance_checkpoints.py.
+def add_unspent_balances(grouped_df, price_store, folder_name, opening=None, checkpoints=None):
+    if grouped_df.empty:                                     # E.g. a scoped run over quarters without transfers
+        return pd.DataFrame({column: pd.Series(dtype=np.float64 if column == 'DOT_USD' else object) for column in QUARTERLY_COLUMNS})
+    opening = opening or {}
+    symbols = list(opening) + [symbol for symbol in grouped_df['Symbol'].astype(str).unique() if symbol not in opening]
+    flows = pd.DataFrame({'Quarter': grouped_df['Quarter'], 'Symbol': grouped_df['Symbol'], 'Value': grouped_df['Value'], 'DOT_USD': 0.0, 'Weight': 1})
+    if checkpoints is not None and not opening:              # The balances are summed up and transferred to the next interquarter balance
+        balances = checkpoints.running_balances('unspent', folder_name, flows, hash_closed=True)   # Grouped sums change without new rows
+    else:
+        balances = running_balances(flows, {symbol: [value, 0.0] for symbol, value in opening.items()})   # The USD of Unspent rows comes from the price
 
-    for quarter in quarters:
+    rows = []
+    for quarter, quarter_balances in balances:
         for symbol in symbols:
-            quarter_data = grouped_df[(grouped_df['Quarter'] == quarter) & (grouped_df['Symbol'] == symbol)]
-            current_unspent_value = quarter_data['Value'].sum() + cumulative_unspent[symbol]
-            cumulative_unspent[symbol] = current_unspent_value
-
-            if symbol == 'USDC':                             # DOT_USD of inter-quarter balances
-                unspent_dot_usd = current_unspent_value      # are calculated exactly at the end of the quarter
-            else:
-                unspent_date = get_unspent_date(quarter, prices_dict)
-                if unspent_date is None:
-                    continue
+            current_unspent_value = quarter_balances.get(symbol, [0])[0]
+            price = price_store.price_on(symbol, calendar_end_of(quarter), backfill=True)   # DOT_USD of inter-quarter balances are calculated
+            unspent_dot_usd = to_float(current_unspent_value, decimals_of(symbol)) * price  # exactly at the end of the quarter (or the first known price)
 
-                price_index = 0 if symbol == 'ENS' else 1
-                unspent_dot_usd = current_unspent_value * prices_dict[unspent_date][price_index]
-
-            unspent_row = {
+            rows.append({
                 'Quarter': f"{quarter} Unspent",
                 'From_category': folder_name,
                 'To_category': folder_name if folder_name != "Community WG" else "Community SG",
                 'Symbol': symbol,
                 'Value': current_unspent_value,              # The balances transferring inside the wallet itself
                 'DOT_USD': unspent_dot_usd                   # Except Community WG, since it was dissolved after one Q
-            }
-            unspent_df = pd.concat([unspent_df, pd.DataFrame([unspent_row])], ignore_index=True)
+            })
+    unspent_df = pd.DataFrame(rows)
+    unspent_df['Value'] = unspent_df['Value'].astype(object)
 
+    if isinstance(grouped_df['Symbol'].dtype, pd.CategoricalDtype):
+        apply_labels(unspent_df, grouped_df['Symbol'].dtype) # Keeps the shared dictionary when concatenated with grouped_df
     return unspent_df
 
-# Interquarter balances have a clear date - the last day of the quarter.
-def get_unspent_date(quarter, prices_dict):
-    year, q = quarter[:4], quarter[-1]
-    quarter_ends = {
-        '1': pd.Timestamp(f'{year}-03-31').date(),
-        '2': pd.Timestamp(f'{year}-06-30').date(),
-        '3': pd.Timestamp(f'{year}-09-30').date(),
-        '4': pd.Timestamp(f'{year}-12-31').date()
-    }
-    target_date = quarter_ends[q]
-    available_dates = [pd.to_datetime(date).date() for date in prices_dict.keys()]
-    available_dates.sort()
-
-    closest_date = None
-    for date in available_dates:
-        if date <= target_date:
-            closest_date = date
-        else:
-            break
-
-    if closest_date is None and available_dates:
-        closest_date = available_dates[0]
-
-    return closest_date
-
-def calculate_interquarter_balances(df, wallet):
-    df['Date'] = pd.to_datetime(df['Date'])
-    quarters = df['Date'].apply(get_quarter_end_date).unique()
+# Balances of every symbol at the end of every quarter, rows from and to the wallet counted once each.
+# Every row takes part, so that symbols keep the order of their first transfer.
+def calculate_interquarter_balances(df, wallet, checkpoints=None):
+    flows = pd.DataFrame({
+        'Quarter': quarter_labels(df['Date']),
+        'Symbol': df['Symbol'].to_numpy(),
+        'Value': df['Value'].to_numpy(),
+        'DOT_USD': df['DOT_USD'].to_numpy(),
+        'Weight': (df['From_category'] == wallet).to_numpy(dtype=int) + (df['To_category'] == wallet).to_numpy(dtype=int)
+    })
+    if checkpoints is not None:
+        balances = checkpoints.running_balances('interquarter', wallet, flows)
+    else:
+        balances = running_balances(flows)
     interquarter_balances = []
 
-    for quarter_end in quarters:
-        quarter_df = df[df['Date'] <= quarter_end]
-        for symbol in quarter_df['Symbol'].unique():
-            from_balance = quarter_df[(quarter_df['Symbol'] == symbol) & (quarter_df['From_category'] == wallet)]['Value'].sum()
-            to_balance = quarter_df[(quarter_df['Symbol'] == symbol) & (quarter_df['To_category'] == wallet)]['Value'].sum()
-            net_balance = to_balance + from_balance
-
-            from_usd = quarter_df[(quarter_df['Symbol'] == symbol) & (quarter_df['From_category'] == wallet)]['DOT_USD'].sum()
-            to_usd = quarter_df[(quarter_df['Symbol'] == symbol) & (quarter_df['To_category'] == wallet)]['DOT_USD'].sum()
-            net_usd = to_usd + from_usd
-
+    for quarter, quarter_balances in balances:
+        quarter_end = pd.Timestamp(quarter_end_of(quarter))
+        for symbol, (net_balance, net_usd) in quarter_balances.items():
             if net_balance != 0:
                 interquarter_balances.append({
                     'Transaction Hash': 'Interquarter',
@@ -277,29 +298,104 @@ def calculate_interquarter_balances(df, wallet):
 
     return pd.DataFrame(interquarter_balances)
 
+# Function reading a ledger written by export_ledger. Values are parsed back into integer base units
+# and dates are parsed once here, with the fixed export format.
+def read_ledger(file):
+    df = count_rows_in(pd.read_csv(file, dtype={'Value': str}))   # Rows in of the stage reading it, see run_metrics.py
+    if 'Value' in df.columns and 'Symbol' in df.columns:
+        df['Value'] = pd.Series(parse_amounts(df['Value'], df['Symbol']), index=df.index, dtype=object)
+    if 'Date' in df.columns:
+        df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d')
+    return df
+
+# Columns used only inside a run; exported ledgers keep their original layout
+INTERNAL_COLUMNS = ['Timestamp', 'Original_WETH']
+
+# Function mapping interned ids back to strings. Names and categories missing from the label dictionary are those of
+# unknown counterparties, which are named by their address.
+def decode_ledger(df, interner):
+    decode_columns(df, interner)
+    for side in ['From', 'To']:
+        for column in [f'{side}_name', f'{side}_category']:
+            if column in df.columns and side in df.columns and df[column].isna().any():
+                df[column] = df[column].astype(object).where(df[column].notna(), df[side])
+    return df
+
+# Amounts are formatted into decimal strings and interned ids are mapped back to strings only when the ledgers are exported.
+def ledger_csv(df, interner=None, **kwargs):
+    export_df = df.drop(columns=[column for column in INTERNAL_COLUMNS if column in df.columns])
+    if interner is not None:
+        decode_ledger(export_df, interner)
+    export_df['Value'] = format_amounts(export_df['Value'], export_df['Symbol'])
+    return export_df.to_csv(index=False, **kwargs)
+
+# Files are replaced atomically and only if their content changed (see atomic_files.py). Returns the sha256 of the file.
+def export_ledger(df, file, interner=None, **kwargs):
+    digest, _ = write_if_changed(file, ledger_csv(df, interner, **kwargs))
+    return digest
+
+# Directory of the combined ledger split by quarter, with an index.json of the files and their sha256
+LEDGERS_DIR = os.path.join('public', 'data', 'ledgers')
+PARTITIONS_INDEX = 'index.json'
+
+# Function writing one file per quarter of the combined ledger. Closed quarters produce the same bytes on every run,
+# so only the files of quarters that got new rows are replaced. Files of quarters that are gone are removed.
+def export_partitions(combined_df, ledgers_dir=LEDGERS_DIR):
+    index_file = os.path.join(ledgers_dir, PARTITIONS_INDEX)
+    try:
+        with open(index_file, encoding='utf-8') as file:
+            previous = json.load(file)['quarters']
+    except (OSError, ValueError, KeyError):
+        previous = {}
+
+    quarters = {}
+    for quarter, quarter_df in combined_df.groupby('Quarter', sort=False, observed=True):
+        file_name = f'{quarter}.csv'
+        digest = export_ledger(quarter_df, os.path.join(ledgers_dir, file_name))
+        quarters[str(quarter)] = {'file': file_name, 'rows': len(quarter_df), 'sha256': digest}
+
+    for quarter in set(previous) - set(quarters):
+        try:
+            os.remove(os.path.join(ledgers_dir, previous[quarter]['file']))
+        except OSError:
+            pass
+    write_if_changed(index_file, json.dumps({'version': 1, 'quarters': quarters}, indent=2))
+    return quarters
+
 # Function to combine local ledgers, remove duplicates and add interquarter balances
-def combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict):
-    all_files = glob(os.path.join(local_ledgers_dir, '*.csv'))
+# With checkpoints the interquarter balances of unchanged quarters are read back, see balance_checkpoints.py.
+def combine_local_ledgers(local_ledgers_dir, price_store, wallets_dict, txs_dict, interner, metrics=None, combined_file='d_ledgers.csv', checkpoints=None):
+    metrics = metrics or RunMetrics()
+    all_files = sorted(glob(os.path.join(local_ledgers_dir, '*.csv')))   # Sorted, so the output does not depend on the file system
     combined_df = pd.DataFrame()
 
-    for file in all_files:
-        df = pd.read_csv(file)
-        if 'From_category' not in df.columns or 'To_category' not in df.columns:
-            continue 
-        df['Date'] = pd.to_datetime(df['Date'])
+    ledgers = {file: read_ledger(file) for file in all_files}
+    ledgers = {file: df for file, df in ledgers.items() if 'From_category' in df.columns and 'To_category' in df.columns}
+    labels = {os.path.splitext(os.path.basename(file))[0] for file in all_files}
+    for df in ledgers.values():
+        labels.update(*(df[column].dropna().unique() for column in LABEL_COLUMNS if column in df.columns))
+    label_dtype = build_label_dtype(wallets_dict, txs_dict, labels)
+
+    for file, df in ledgers.items():
+        apply_labels(df, label_dtype)
         df = df[(df['From_category'] != 'WETH Contract') & (df['To_category'] != 'WETH Contract')].copy()
         
         wallet_name = os.path.splitext(os.path.basename(file))[0]
-        interquarter_df = calculate_interquarter_balances(df, wallet_name)
+        interquarter_df = apply_labels(metrics.call('calculate_interquarter_balances', wallet_name, calculate_interquarter_balances, df, wallet_name, checkpoints), label_dtype)
         df = pd.concat([df, interquarter_df])
         combined_df = pd.concat([combined_df, df])
 
     combined_df['Value'] = combined_df['Value'].abs()
     combined_df['DOT_USD'] = combined_df['DOT_USD'].abs()
 
+    encode_columns(combined_df, interner)                    # Masks and dedupes below run on interned ids
+    interquarter_id = interner.intern('Interquarter')
+    stream_id = interner.intern('Stream')
+
     combined_df = combined_df[combined_df['Acquainted?'] == 1]
 
-    swap_wallets = {name for name, type_, address, *_ in ens_wallets if type_ == 'Swap'}
+    wallets = load_tables()['wallets']
+    swap_wallets = set(wallets['name'][wallets['type'] == 'Swap'].tolist())
     combined_df = combined_df[~(combined_df['To_name'].isin(swap_wallets) | combined_df['From_name'].isin(swap_wallets))]
 
     combined_df = combined_df[~(
@@ -310,11 +406,11 @@ def combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict):
     names_to_remove = ['Token Timelock', 'slobo.eth', 'capitulation.eth', 'Disperse.app', 'ETHGlobal']
     combined_df = combined_df[~combined_df['From_name'].isin(names_to_remove)]
 
-    combined_df = combined_df[~((combined_df['Transaction Hash'] != 'Interquarter') & 
-                           (combined_df['Transaction Hash'] != 'Stream') & 
+    combined_df = combined_df[~((combined_df['Transaction Hash'] != interquarter_id) & 
+                           (combined_df['Transaction Hash'] != stream_id) & 
                            combined_df.duplicated(subset=['Transaction Hash', 'From', 'To', 'Value'], keep='first'))]
 
-    combined_df['Quarter'] = combined_df['Date'].apply(add_quarter)
+    combined_df['Quarter'] = quarter_labels(combined_df['Date'])
 
     combined_df.reset_index(drop=True, inplace=True)
 
@@ -326,7 +422,7 @@ def combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict):
             interquarter_mask = (
                 (combined_df['From_category'] == wallet) &
                 (combined_df['To_category'] == wallet) &
-                (combined_df['Transaction Hash'] == 'Interquarter') &
+                (combined_df['Transaction Hash'] == interquarter_id) &
                 (combined_df['Quarter'] == quarter)
             )
             if interquarter_mask.any():
@@ -349,7 +445,8 @@ def combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict):
                     'Quarter': last_interquarter_row['Quarter']
                 })
 
-    combined_df = pd.concat([combined_df, pd.DataFrame(rows_to_add)], ignore_index=True)
+    decode_columns(combined_df, interner)
+    combined_df = pd.concat([combined_df, apply_labels(pd.DataFrame(rows_to_add), label_dtype)], ignore_index=True)
 
     def sort_key(row):
         from_name = row['From_name']
@@ -419,7 +516,8 @@ def combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict):
 
     combined_df.drop(columns=['sort_key'], inplace=True)
 
-    combined_df.to_csv('d_ledgers.csv', index=False)
+    export_ledger(combined_df, combined_file)
+    return combined_df
 
 # Function for sorting quarterly costs. They are not presented in order of date of execution, but in In descending order of amounts.
 def finalize_and_sort_df(grouped_with_unspent_df, folder_name):
@@ -440,45 +538,200 @@ def finalize_and_sort_df(grouped_with_unspent_df, folder_name):
 
     return sorted_df
 
-# Main Function. Specifies the rules for working with directories and libraries as well as the order in which functions are performed.
-def process_directories(ens_wallets, various_txs):
+# Dictionaries built from the hand made databases, shared by all stages. The databases are read from the compiled
+# table cache (see table_cache.py) unless literal lists in the ens_wallets / various_txs format are given.
+def build_lookups(ens_wallets=None, various_txs=None):
+    tables = load_tables()
+    wallets = tables['wallets'] if ens_wallets is None else compile_table('wallets', ens_wallets)
+    txs = tables['txs'] if various_txs is None else compile_table('txs', various_txs)
+
+    names, addresses, categories = wallets['name'].tolist(), wallets['address'].tolist(), wallets['category'].tolist()
+    wallets_dict = {address: (name, category or name) for name, address, category in zip(names, addresses, categories)}
+    txs_dict = dict(zip(txs['hash'].tolist(), txs['category'].tolist()))
+    price_store = load_price_store(tables=tables)            # Dense day x asset prices, see price_store.py and price_log.py
+    interner = build_interner(addresses, txs['hash'].tolist())   # Shared table of interned addresses and transaction hashes
+    return wallets_dict, txs_dict, price_store, interner
+
+# Only acquainted transfers go to the quarterly ledgers; WETH wrapping is not an expense
+def acquainted_transfers(named_df):
+    acquainted_df = named_df[named_df['Acquainted?'] == 1].copy()
+    return acquainted_df[(acquainted_df['From_category'] != 'WETH Contract') & (acquainted_df['To_category'] != 'WETH Contract')].copy()
+
+# Source files whose changes invalidate the ledgers built by the stages below
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_FILES = [os.path.join(SOURCE_DIR, file) for file in ['merger.py', 'amounts.py', 'fiscal_calendar.py', 'interning.py', 'price_store.py', 'balance_checkpoints.py']]
+
+# Function building the stage graph of a run (see pipeline.py). Per wallet, 'local:<wallet>' ingests, merges and names its
+# transfers and 'quarterly:<wallet>' groups them with the interquarter balances; 'combined' and the exports after it
+# read all local ledgers. With streams, stream_grouper writes the Service Providers ledgers first.
+def build_pipeline(ens_wallets=None, various_txs=None, metrics=None, raw_data_dir='raw_txs', local_ledgers_dir='local_ledgers',
+                   quarter_dir='quarterly_ledgers', combined_file='d_ledgers.csv', valuation='daily', flows_dir=FLOWS_DIR,
+                   ledgers_dir=LEDGERS_DIR, deltas_dir=DELTAS_DIR, store_file=None, raw_store_file=None, aggregates_file=AGGREGATES_FILE,
+                   streams=False, state_file=PIPELINE_STATE):
+    metrics = metrics or RunMetrics()                        # Stage timings, rows and memory. See run_metrics.py
+    if valuation not in VALUATIONS:
+        raise ValueError(f"Unknown valuation '{valuation}', expected one of {VALUATIONS}")
 
-    raw_data_dir = 'raw_txs'
-    local_ledgers_dir = 'local_ledgers'
     os.makedirs(local_ledgers_dir, exist_ok=True)
-    quarter_dir = 'quarterly_ledgers'
     os.makedirs(quarter_dir, exist_ok=True)
 
-    wallets_dict = {address: (name, details[0] if len(details) == 1 else name) for name, _, address, *details in ens_wallets}
-    txs_dict = {tx[1]: tx[0] for tx in various_txs}
-    prices_dict = {pd.to_datetime(date).date(): (ens_price, eth_price) for date, ens_price, eth_price in prices}
-
-    for folder in glob(os.path.join(raw_data_dir, '$*')):
-        folder_name = os.path.basename(folder).strip('$')
-
+    lookups, results, lock = {}, {}, threading.Lock()
+    def lookup():                                            # The hand made databases are read once, by the first stage needing them
+        with lock:
+            if not lookups:
+                np.ndarray, pd.DataFrame                     # Lazy modules are loaded here: loading them is not thread-safe before Python 3.12
+                lookups['tables'] = build_lookups(ens_wallets, various_txs)
+                lookups['price_series'] = load_price_series() if valuation == 'asof' else None   # Intraday price points, see price_log.py
+                lookups['label_dtype'] = build_label_dtype(*lookups['tables'][:2], folders)   # One label dictionary per run: registries and wallets
+        return lookups['tables']
+
+    folders = {os.path.basename(folder).strip('$'): folder for folder in glob(os.path.join(raw_data_dir, '$*'))}
+    last_block = None
+    if raw_store_file:                                       # Transfers upserted by the miner, see raw_store.py
+        with RawStore(raw_store_file, read_only=True) as raw_store:
+            folders.update({wallet: os.path.join(raw_data_dir, f'${wallet}') for wallet in raw_store.wallets() if wallet not in folders})
+            last_block = raw_store.last_block()              # Blocks after it are applied by quarter_aggregates.py
+
+    registries = [source_path('wallets'), source_path('txs')] if ens_wallets is None and various_txs is None else []
+    prices = [source_path('prices'), PRICE_DIR]
+    params = {'valuation': valuation, 'raw_store_block': last_block}
+    if ens_wallets is not None or various_txs is not None:
+        params['registries'] = content_hash(repr((ens_wallets, various_txs)).encode('utf-8'))
+    context = [valuation, params.get('registries')] + [path_hash(path) for path in registries + [source_path('prices')] + CODE_FILES]
+    checkpoint_context = content_hash(json.dumps(context).encode('utf-8'))   # Checkpoints of other labels or code are invalid, see balance_checkpoints.py
+
+    def local_file(folder_name):
+        return os.path.join(local_ledgers_dir, f'{folder_name}.csv')
+
+    def build_local(folder_name, folder):
+        wallets_dict, txs_dict, price_store, interner = lookup()
         token_file = os.path.join(folder, 'token.csv')
         internal_file = os.path.join(folder, 'internal.csv')
-
-        token_df = process_erc20_txs(token_file, prices_dict).copy()
-        internal_df = process_internal_txs(internal_file).copy()
-
-        merged_df = merge_txs(token_df, internal_df)
-        named_df = identify_wallets(merged_df, wallets_dict, txs_dict, folder_name).copy()
-
-        local_ledgers_file = os.path.join(local_ledgers_dir, f'{folder_name}.csv')
-        named_df.to_csv(local_ledgers_file, index=False, columns=[col for col in named_df.columns if col != 'Original_WETH'])
-
-        acquainted_df = named_df[named_df['Acquainted?'] == 1].copy()
-        cleaned_df = acquainted_df[(acquainted_df['From_category'] != 'WETH Contract') & (acquainted_df['To_category'] != 'WETH Contract')].copy()
-        grouped_df = group_by_quarter(cleaned_df)
-
-        unspent_rows_df = add_unspent_balances(grouped_df, prices_dict, folder_name)
+        if raw_store_file:                                   # The stored rows are added to the exports as frames of the same layout
+            with RawStore(raw_store_file, read_only=True) as raw_store:
+                token_file = with_export(raw_store.token_frame(folder_name), token_file, TOKEN_DTYPE)
+                internal_file = with_export(raw_store.internal_frame(folder_name, price_store), internal_file, INTERNAL_DTYPE)
+
+        token_df = metrics.call('process_erc20_txs', folder_name, process_erc20_txs, token_file, price_store, interner, lookups['price_series']).copy()
+        internal_df = metrics.call('process_internal_txs', folder_name, process_internal_txs, internal_file, interner, lookups['price_series']).copy()
+        merged_df = metrics.call('merge_txs', folder_name, merge_txs, token_df, internal_df)
+
+        named_df = metrics.call('identify_wallets', folder_name, identify_wallets, merged_df, wallets_dict, txs_dict, folder_name, interner, lookups['label_dtype']).copy()
+        export_ledger(named_df, local_file(folder_name), interner)
+        with BalanceCheckpoints(aggregates_file, checkpoint_context) as checkpoints:   # Corrections of closed quarters invalidate their checkpoints
+            checkpoints.record_sources(folder_name, named_df)
+        results[f'local:{folder_name}'] = named_df
+
+    def build_quarterly(folder_name):
+        price_store = lookup()[2]
+        named_df = results.pop(f'local:{folder_name}', None)
+        if named_df is None:                                 # The local ledger did not change in this run
+            named_df = read_ledger(local_file(folder_name))
+
+        cleaned_df = acquainted_transfers(named_df)
+        grouped_df = metrics.call('group_by_quarter', folder_name, group_by_quarter, cleaned_df)
+
+        with BalanceCheckpoints(aggregates_file, checkpoint_context) as checkpoints:   # Quarter-end balances of earlier runs, see balance_checkpoints.py
+            unspent_rows_df = metrics.call('add_unspent_balances', folder_name, add_unspent_balances, grouped_df, price_store, folder_name, None, checkpoints)
+        with QuarterAggregates(aggregates_file) as aggregates:   # Seeded with the sums and balances of this run, see quarter_aggregates.py
+            aggregates.load(folder_name, grouped_df, unspent_rows_df)
         grouped_with_unspent_df = pd.concat([grouped_df, unspent_rows_df]).sort_values(by='Quarter')
-        final_df = finalize_and_sort_df(grouped_with_unspent_df, folder_name)
-
-        grouped_file = os.path.join(quarter_dir, f'{folder_name}_q.csv')
-        final_df.to_csv(grouped_file, index=False)
-
-    combine_local_ledgers(local_ledgers_dir, prices_dict, wallets_dict)
-
-process_directories(ens_wallets, various_txs)
+        final_df = metrics.call('finalize_and_sort_df', folder_name, finalize_and_sort_df, grouped_with_unspent_df, folder_name)
+        export_ledger(final_df, os.path.join(quarter_dir, f'{folder_name}_q.csv'))
+
+    def set_last_block():
+        with QuarterAggregates(aggregates_file) as aggregates, aggregates.transaction():
+            aggregates.set('last_block', -1 if last_block is None else last_block)
+
+    def combine():
+        wallets_dict, txs_dict, price_store, interner = lookup()
+        with BalanceCheckpoints(aggregates_file, checkpoint_context) as checkpoints:
+            results['combined'] = metrics.call('combine_local_ledgers', None, combine_local_ledgers, local_ledgers_dir, price_store, wallets_dict,
+                                               txs_dict, interner, metrics, combined_file, checkpoints)
+
+    def combined_df():
+        return results['combined'] if 'combined' in results else read_ledger(combined_file)
+
+    stages = []
+    if streams:
+        stages.append(Stage('streams', lambda: update_streams(local_file=local_file(STREAM_SENDER),
+                                                              quarterly_file=os.path.join(quarter_dir, f'{STREAM_SENDER}_q.csv')),
+                            [RATES_FILE, os.path.join(SOURCE_DIR, 'stream_grouper.py')],
+                            [local_file(STREAM_SENDER), os.path.join(quarter_dir, f'{STREAM_SENDER}_q.csv')],
+                            {'until': str(date.today())}))   # Streams accrue up to today
+    for folder_name, folder in sorted(folders.items()):
+        stages.append(Stage(f'local:{folder_name}', lambda folder_name=folder_name, folder=folder: build_local(folder_name, folder),
+                            [os.path.join(folder, 'token.csv'), os.path.join(folder, 'internal.csv')] + registries + prices + CODE_FILES,
+                            [local_file(folder_name)], params))
+        stages.append(Stage(f'quarterly:{folder_name}', lambda folder_name=folder_name: build_quarterly(folder_name),
+                            [local_file(folder_name)] + prices + CODE_FILES, [os.path.join(quarter_dir, f'{folder_name}_q.csv')]))
+    stages += [
+        Stage('aggregates', set_last_block, [os.path.join(quarter_dir, f'{folder_name}_q.csv') for folder_name in folders],
+              params={'last_block': last_block, 'file': os.path.abspath(aggregates_file)}),
+        Stage('combined', combine, [local_ledgers_dir] + registries + prices + CODE_FILES, [combined_file], params),
+        Stage('partitions', lambda: metrics.call('export_partitions', None, export_partitions, combined_df(), ledgers_dir),
+              [combined_file] + CODE_FILES, [os.path.join(ledgers_dir, PARTITIONS_INDEX)]),
+        Stage('flows', lambda: metrics.call('write_flows', None, write_flows, combined_df(), flows_dir),   # Precomputed dashboard flows, see flow_aggregates.py
+              [combined_file, os.path.join(SOURCE_DIR, 'flow_aggregates.py')], [os.path.join(flows_dir, 'index.json')]),
+        Stage('deltas', lambda: metrics.call('export_deltas', None, export_deltas, ledger_files(combined_file, local_ledgers_dir), deltas_dir),
+              [combined_file, local_ledgers_dir, os.path.join(SOURCE_DIR, 'ledger_deltas.py')], [os.path.join(deltas_dir, 'index.json')]),   # See ledger_deltas.py
+        Stage('store', lambda: metrics.call('update_store', None, update_store, local_ledger_files(local_ledgers_dir), *lookup()[:2], store_file),
+              [local_ledgers_dir, os.path.join(SOURCE_DIR, 'ledger_store.py')] + registries, [store_file or STORE_FILES[resolve_backend()]])   # See ledger_store.py
+    ]
+    return Pipeline(stages, state_file)
+
+# Main Function. Builds the ledgers of every wallet (or only the targets and the stages they need, e.g. 'quarterly:Ecosystem').
+# force rebuilds the selected stages even if their inputs did not change; workers stages run at the same time.
+def process_directories(ens_wallets=None, various_txs=None, metrics=None, raw_data_dir='raw_txs', local_ledgers_dir='local_ledgers',
+                        quarter_dir='quarterly_ledgers', combined_file='d_ledgers.csv', valuation='daily', flows_dir=FLOWS_DIR,
+                        ledgers_dir=LEDGERS_DIR, deltas_dir=DELTAS_DIR, store_file=None, raw_store_file=None, aggregates_file=AGGREGATES_FILE,
+                        streams=False, targets=None, force=True, workers=1, state_file=PIPELINE_STATE):
+    metrics = metrics or RunMetrics()
+    pipeline = build_pipeline(ens_wallets, various_txs, metrics, raw_data_dir, local_ledgers_dir, quarter_dir, combined_file, valuation, flows_dir,
+                              ledgers_dir, deltas_dir, store_file, raw_store_file, aggregates_file, streams, state_file)
+    pipeline.run(targets, force, workers)
+    return metrics
+
+# Command line entry point. Importing merger does no work; the full rebuild only runs from here.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds local, quarterly and combined ledgers from raw_txs.')
+    parser.add_argument('--report', help='write a JSON run report with per-wallet, per-stage metrics to this path')
+    parser.add_argument('--summary', action='store_true', help='print a per-stage summary table')
+    parser.add_argument('--profile-dir', help='dump a cProfile file per stage into this directory')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak memory (tracemalloc slows the run down)')
+    parser.add_argument('--raw-store', help='also read the transfers upserted by the miner into this database (miner.py --store)')
+    parser.add_argument('--valuation', choices=VALUATIONS, default='daily',
+                        help="'asof' values ETH/ENS transfers at the last logged price point before their timestamp")
+    parser.add_argument('--target', action='append', help="build only this stage and what it needs, e.g. 'quarterly:Ecosystem' or 'local:*'")
+    parser.add_argument('--changed-only', action='store_true', help='skip stages whose inputs and outputs did not change since their last run')
+    parser.add_argument('--workers', type=int, default=1, help='stages running at the same time')
+    parser.add_argument('--streams', action='store_true', help='accrue the Service Provider streams (stream_grouper.py) first')
+    parser.add_argument('--list', action='store_true', help='print the stages and their dependencies and exit')
+    parser.add_argument('--wallet', action='append', help='rebuild only this wallet (repeatable) and splice it into the outputs')
+    parser.add_argument('--quarters', help="rebuild only these quarters, e.g. '2024Q2' or '2024Q1:2024Q3' (see scoped_merge.py)")
+    parser.add_argument('--dates', help="rebuild only the quarters overlapping these dates, e.g. '2024-04-01:2024-05-15'")
+    args = parser.parse_args(argv)
+
+    metrics = RunMetrics(trace_memory=bool(args.report or args.summary) and not args.no_memory, profile_dir=args.profile_dir)
+    if args.wallet or args.quarters or args.dates:
+        from scoped_merge import merge_scope, parse_quarters, parse_dates
+        quarters = parse_quarters(args.quarters) if args.quarters else parse_dates(args.dates) if args.dates else None
+        merge_scope(args.wallet, quarters, metrics, raw_store_file=args.raw_store, valuation=args.valuation)
+    else:
+        pipeline = build_pipeline(metrics=metrics, valuation=args.valuation, raw_store_file=args.raw_store, streams=args.streams)
+        if args.list:
+            for stage, dependencies in pipeline.describe():
+                print(f"{stage:<30}{', '.join(dependencies)}")
+            return metrics
+        statuses = pipeline.run(args.target, force=not args.changed_only, workers=args.workers)
+        if args.target or args.changed_only:
+            ran = [stage for stage, status in statuses.items() if status == 'ran']
+            print(f"{len(ran)} stages run, {len(statuses) - len(ran)} unchanged: {', '.join(ran) or 'nothing to do'}")
+    if args.report:
+        metrics.write_report(args.report)
+    if args.summary:
+        metrics.print_summary()
+    return metrics
+
+if __name__ == '__main__':
+    main()
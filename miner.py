@@ -1,12 +1,11 @@
 import csv
 import os
-from web3 import Web3
+import argparse
 from datetime import datetime
 
-from keys import node_address
 from ens_wallets import ens_wallets
-
-w3 = Web3(Web3.HTTPProvider(node_address))
+from amounts import format_units
+from raw_store import RawStore
 
 contract_addresses = { # Address: (Asset, Decimals)
     "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48": ("USDC", 6),
@@ -23,16 +22,21 @@ wallet_folders = { # Only Main ENS Wallets needed
     for wallet in ens_wallets
     if wallet[1] in ["Treasury Consolidator", "Payment Account"]}
 
-# A block is processed in 10 seconds, which is two seconds faster than creating a new one. If there is a lag, we can add async
-block_number = 'latest'
-block = w3.eth.get_block(block_number, full_transactions=True)
-date = datetime.utcfromtimestamp(block.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+EXEC_TRANSACTION_TOPIC = '0x442e715f626346e8c54381002da614f62bee8d27386535b2521ec8540898556e'
+SAFE_RECEIVED_TOPIC = '0x3d0ce9bfc3ed7d6862dbb28b2dea94561fe714a1b4d019aa8af39730d1ad7c3d'
 
-transfers = []
+# Function connecting to the node. web3 is imported here, so the handlers can be used without it installed.
+# The node address is read from keys.py unless given explicitly.
+def connect(node_address=None):
+    from web3 import Web3
+    if node_address is None:
+        from keys import node_address
+    return Web3(Web3.HTTPProvider(node_address))
 
 # All txs are added to raw directories in accordance with the wallet that participated in the transfer
-def add_to_csv(folder_name, file_name, row_data):
-    directory = os.path.join('raw_txs', folder_name)
+def add_to_csv(folder_name, file_name, row_data, raw_data_dir='raw_txs'):
+    directory = os.path.join(raw_data_dir, folder_name)
     os.makedirs(directory, exist_ok=True)
     file_path = os.path.join(directory, file_name)
     with open(file_path, 'a', newline='', encoding='utf-8') as csvfile:
@@ -40,11 +44,22 @@ def add_to_csv(folder_name, file_name, row_data):
         writer.writerow(row_data)
     print(f"{row_data[0]} added to {file_name} file in {folder_name} folder.")
 
-# Transactions are added to the token file if they relate to erc20, and to Internal if they refer to ETH transfers
-def transfer_data(tx_hash, from_address, to_address, contract_address, symbol, value, date, tx_type):
+# Transactions are added to the token file if they relate to erc20, and to Internal if they refer to ETH transfers.
+# With a sink (a list collecting the transfers of a block for the store, see raw_store.py) nothing is written to raw_txs.
+def transfer_data(tx_hash, from_address, to_address, contract_address, symbol, value, date, tx_type, block_number, raw_data_dir='raw_txs',
+                  log_index=None, sink=None):
     from_folder = wallet_folders.get(from_address.lower())
     to_folder = wallet_folders.get(to_address.lower())
 
+    if sink is not None:
+        sink.append({
+            'tx_hash': tx_hash, 'log_index': log_index, 'kind': tx_type, 'from_address': from_address.lower(),
+            'to_address': to_address.lower(), 'from_wallet': from_folder and from_folder.lstrip('$'),
+            'to_wallet': to_folder and to_folder.lstrip('$'), 'contract_address': contract_address, 'symbol': symbol, 'value': value
+        })
+        print(f"{tx_hash} ({tx_type}) queued for the store")
+        return
+
     if tx_type == "token":
         row_data = [tx_hash, block_number, '|', date, from_address, to_address, value, 0, contract_address, '', symbol]
         file_name = 'token.csv'
@@ -55,64 +70,96 @@ def transfer_data(tx_hash, from_address, to_address, contract_address, symbol, v
 
     # Добавляем запись для отправителя
     if from_folder:
-        add_to_csv(from_folder, file_name, row_data_from if tx_type == "internal" else row_data)
+        add_to_csv(from_folder, file_name, row_data_from if tx_type == "internal" else row_data, raw_data_dir)
 
     # Добавляем запись для получателя, если он отличается от отправителя
     if to_folder and to_folder != from_folder:
-        add_to_csv(to_folder, file_name, row_data_to if tx_type == "internal" else row_data)
+        add_to_csv(to_folder, file_name, row_data_to if tx_type == "internal" else row_data, raw_data_dir)
 
 # Processing "Transfer" transactions
-def handle_erc20(log, tx, date):
+def handle_erc20(log, tx, date, block_number, raw_data_dir='raw_txs', sink=None):
     from_address = "0x" + log.topics[1].hex()[-40:]
     to_address = "0x" + log.topics[2].hex()[-40:]
     tx_hash = tx.hash.hex()
     contract_address = log.address.lower()
     symbol, decimals = contract_addresses.get(contract_address, ("Unknown", 0))
     value_raw = int(log.data.hex()[-64:], 16)
-    value_formatted = f"{value_raw / (10 ** decimals):.{decimals}f}"
-    transfer_data(tx_hash, from_address, to_address, contract_address, symbol, value_formatted, date, tx_type='token')
+    value_formatted = format_units(value_raw, decimals)     # Exact conversion from base units, without a float in between
+    transfer_data(tx_hash, from_address, to_address, contract_address, symbol, value_formatted, date, 'token', block_number, raw_data_dir,
+                  log.logIndex, sink)
 
 # Processing "ExecTransaction" transactions
-def handle_ExecTransaction(log, tx, date):
+def handle_ExecTransaction(log, tx, date, block_number, raw_data_dir='raw_txs', sink=None):
     tx_hash = tx.hash.hex()
     from_address = log.address.lower()
     to_address = "0x" + tx['input'].hex()[34:74] if len(tx['input']) >= 74 else None
     value_raw = int(tx['input'].hex()[74:138], 16) if len(tx['input']) >= 138 else 0
-    value_formatted = f"{value_raw / (10 ** 18):.18f}"
-    transfer_data(tx_hash, from_address, to_address, "0x0000000000000000000000000000000000000000", "ETH", value_formatted, date, tx_type='internal')
+    value_formatted = format_units(value_raw, 18)
+    transfer_data(tx_hash, from_address, to_address, "0x0000000000000000000000000000000000000000", "ETH", value_formatted, date, 'internal', block_number, raw_data_dir,
+                  log.logIndex, sink)
 
 # Processing "Safe Received" transactions
-def handle_SafeReceived(log, tx, date):
+def handle_SafeReceived(log, tx, date, block_number, raw_data_dir='raw_txs', sink=None):
     tx_hash = tx.hash.hex()
     from_address = "0x" + log.topics[1].hex()[-40:]
     to_address = log.address.lower()
     value_raw = int(log.data.hex()[-64:], 16)
-    value_formatted = f"{value_raw / (10 ** 18):.18f}"
-    transfer_data(tx_hash, from_address, to_address, "0x0000000000000000000000000000000000000000", "ETH", value_formatted, date, tx_type='internal')
-
-# Identification of transaction method and iterative search for those of interest
-for index, tx in enumerate(block.transactions):
-    receipt = w3.eth.get_transaction_receipt(tx.hash)
-    interesting_logs = 0
-
-    for log in receipt.logs:
-        from_address = "0x" + log.topics[1].hex()[-40:] if len(log.topics) > 1 else None
-        to_address = "0x" + log.topics[2].hex()[-40:] if len(log.topics) > 2 else log.address.lower()
-        topic_hex = log.topics[0].hex()
-        if from_address in wallets_of_interest or to_address in wallets_of_interest:
-            if topic_hex == '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef':
-                handle_erc20(log, tx, date)
-                interesting_logs += 1
-            elif topic_hex == '0x442e715f626346e8c54381002da614f62bee8d27386535b2521ec8540898556e':
-                handle_ExecTransaction(log, tx, date)
-                interesting_logs += 1
-            elif topic_hex == '0x3d0ce9bfc3ed7d6862dbb28b2dea94561fe714a1b4d019aa8af39730d1ad7c3d':
-                handle_SafeReceived(log, tx, date)
-                interesting_logs += 1
-
-    if interesting_logs > 0:
-        print(f"Block {block_number}: Transaction {index + 1} has {interesting_logs} interesting logs")
-    else:
-        print(f"Block {block_number}: Transaction {index + 1} has no interesting logs")
-
-print(f"Block {block_number} processed")
+    value_formatted = format_units(value_raw, 18)
+    transfer_data(tx_hash, from_address, to_address, "0x0000000000000000000000000000000000000000", "ETH", value_formatted, date, 'internal', block_number, raw_data_dir,
+                  log.logIndex, sink)
+
+# Identification of transaction method and iterative search for those of interest.
+# A block is processed in 10 seconds, which is two seconds faster than creating a new one. If there is a lag, we can add async
+# With a store (raw_store.RawStore), the transfers of the block are upserted in one transaction instead of appended to raw_txs.
+def process_block(w3, block_number='latest', raw_data_dir='raw_txs', store=None):
+    block = w3.eth.get_block(block_number, full_transactions=True)
+    block_number = block.number                              # 'latest' is resolved, so raw rows get the real block number
+    date = datetime.utcfromtimestamp(block.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    sink = [] if store is not None else None
+
+    for index, tx in enumerate(block.transactions):
+        receipt = w3.eth.get_transaction_receipt(tx.hash)
+        interesting_logs = 0
+
+        for log in receipt.logs:
+            from_address = "0x" + log.topics[1].hex()[-40:] if len(log.topics) > 1 else None
+            to_address = "0x" + log.topics[2].hex()[-40:] if len(log.topics) > 2 else log.address.lower()
+            topic_hex = log.topics[0].hex()
+            if from_address in wallets_of_interest or to_address in wallets_of_interest:
+                if topic_hex == TRANSFER_TOPIC:
+                    handle_erc20(log, tx, date, block_number, raw_data_dir, sink)
+                    interesting_logs += 1
+                elif topic_hex == EXEC_TRANSACTION_TOPIC:
+                    handle_ExecTransaction(log, tx, date, block_number, raw_data_dir, sink)
+                    interesting_logs += 1
+                elif topic_hex == SAFE_RECEIVED_TOPIC:
+                    handle_SafeReceived(log, tx, date, block_number, raw_data_dir, sink)
+                    interesting_logs += 1
+
+        if interesting_logs > 0:
+            print(f"Block {block_number}: Transaction {index + 1} has {interesting_logs} interesting logs")
+        else:
+            print(f"Block {block_number}: Transaction {index + 1} has no interesting logs")
+
+    if store is not None:
+        store.upsert_block(block_number, block.timestamp, sink)
+    print(f"Block {block_number} processed")
+    return block_number
+
+# Command line entry point. Importing miner neither connects to the node nor fetches a block.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Appends transfers of the main ENS wallets in a block to raw_txs.')
+    parser.add_argument('--block', default='latest', help="block number or tag, 'latest' by default")
+    parser.add_argument('--node', help='node address; keys.py is used by default')
+    parser.add_argument('--raw-dir', default='raw_txs')
+    parser.add_argument('--store', help='upsert into this raw_store database (e.g. raw_txs.sqlite) instead of appending to raw_txs')
+    args = parser.parse_args(argv)
+
+    block_number = int(args.block) if args.block.isdigit() else args.block
+    if args.store is None:
+        return process_block(connect(args.node), block_number, args.raw_dir)
+    with RawStore(args.store) as store:
+        return process_block(connect(args.node), block_number, args.raw_dir, store)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import tempfile
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+import merger
+from scoped_merge import merge_scope, parse_quarters
+
+# Golden-output parity and per-stage timing harness.
+# Every merger stage is run on the checked-in raw_txs folders and its output is compared with the stored golden
+# output (numbers with a float tolerance). Stage timings are repeated to get means with 95% confidence intervals.
+GOLDEN_DIR = 'golden'
+RTOL = 1e-9
+ATOL = 1e-6
+
+SCOPES = ['Ecosystem:2023Q4:2024Q1', '*:2024Q2', 'Community WG:2024Q2']   # Scoped merges checked by default; the last one has no transfers
+STAGES = ['process_erc20_txs', 'process_internal_txs', 'identify_wallets', 'group_by_quarter', 'add_unspent_balances', 'combine_local_ledgers']
+
+# Two-sided 95% Student t values by degrees of freedom; larger samples use the normal value
+T_VALUES = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+            15: 2.131, 20: 2.086, 30: 2.042}
+
+# Function running all stages once. Returns {stage: {wallet: dataframe}} and {stage: seconds}.
+def run_stages(raw_data_dir, local_ledgers_dir):
+    wallets_dict, txs_dict, price_store, interner = merger.build_lookups()
+    outputs = {stage: {} for stage in STAGES}
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    def timed(stage, function, *args):
+        args = [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args]   # Stages may modify their input
+        started = time.perf_counter()
+        result = function(*args)
+        timings[stage] += time.perf_counter() - started
+        return result
+
+    merged_dfs = {}
+    for folder in sorted(glob(os.path.join(raw_data_dir, '$*'))):
+        wallet = os.path.basename(folder).strip('$')
+        token_df = timed('process_erc20_txs', merger.process_erc20_txs, os.path.join(folder, 'token.csv'), price_store, interner)
+        internal_df = timed('process_internal_txs', merger.process_internal_txs, os.path.join(folder, 'internal.csv'), interner)
+        outputs['process_erc20_txs'][wallet] = token_df
+        outputs['process_internal_txs'][wallet] = internal_df
+        merged_dfs[wallet] = merger.merge_txs(token_df.copy(), internal_df.copy())
+
+    label_dtype = merger.build_label_dtype(wallets_dict, txs_dict, merged_dfs)
+    for wallet, merged_df in merged_dfs.items():
+        named_df = timed('identify_wallets', merger.identify_wallets, merged_df, wallets_dict, txs_dict, wallet, interner, label_dtype)
+        grouped_df = timed('group_by_quarter', merger.group_by_quarter, merger.acquainted_transfers(named_df))
+        unspent_df = timed('add_unspent_balances', merger.add_unspent_balances, grouped_df, price_store, wallet)
+        outputs['identify_wallets'][wallet] = named_df
+        outputs['group_by_quarter'][wallet] = grouped_df
+        outputs['add_unspent_balances'][wallet] = unspent_df
+        merger.export_ledger(named_df, os.path.join(local_ledgers_dir, f'{wallet}.csv'), interner)
+
+    combined_file = os.path.join(local_ledgers_dir, os.pardir, 'd_ledgers.csv')
+    outputs['combine_local_ledgers']['d_ledgers'] = timed('combine_local_ledgers', merger.combine_local_ledgers, local_ledgers_dir,
+                                                          price_store, wallets_dict, txs_dict, interner, None, combined_file)
+    for stage in STAGES:
+        outputs[stage] = {wallet: to_export_frame(df, interner) for wallet, df in outputs[stage].items()}
+    return outputs, timings
+
+# Stage outputs are compared in their export form: interned ids as strings, amounts as decimal strings.
+# The Timestamp column carried from ingestion is left out; the dates derived from it are compared.
+def to_export_frame(df, interner):
+    df = merger.decode_ledger(df.drop(columns=['Timestamp'], errors='ignore'), interner)
+    if 'Value' in df.columns and 'Symbol' in df.columns:
+        df['Value'] = merger.format_amounts(df['Value'], df['Symbol'])
+    if df.columns.empty:
+        return pd.DataFrame()
+    return pd.read_csv(io.StringIO(df.to_csv(index=False)), dtype=str, keep_default_na=False)
+
+def golden_path(golden_dir, stage, wallet):
+    return os.path.join(golden_dir, stage, f'{wallet}.csv')
+
+# Function comparing one output with its golden file. Returns a list of human readable differences.
+def compare(df, golden_file):
+    if not os.path.exists(golden_file):
+        return [f'{golden_file} does not exist']
+    return compare_frames(df, pd.read_csv(golden_file, dtype=str, keep_default_na=False), golden_file)
+
+def compare_frames(df, golden_df, golden_file):
+    if list(df.columns) != list(golden_df.columns):
+        return [f'{golden_file}: columns {list(df.columns)} != {list(golden_df.columns)}']
+    if len(df) != len(golden_df):
+        return [f'{golden_file}: {len(df)} rows != {len(golden_df)} rows']
+
+    differences = []
+    for column in df.columns:
+        current, golden = df[column].to_numpy(), golden_df[column].to_numpy()
+        current_numbers, golden_numbers = pd.to_numeric(df[column], errors='coerce'), pd.to_numeric(golden_df[column], errors='coerce')
+        numeric = current_numbers.notna().to_numpy() & golden_numbers.notna().to_numpy()
+        mismatch = ~numeric & (current != golden)
+        mismatch |= numeric & ~np.isclose(current_numbers.fillna(0), golden_numbers.fillna(0), rtol=RTOL, atol=ATOL)
+        if mismatch.any():
+            row = int(np.argmax(mismatch))
+            differences.append(f'{golden_file}: {column} differs in {int(mismatch.sum())} rows, first at row {row}: {current[row]!r} != {golden[row]!r}')
+    return differences
+
+# Function checking a scoped merge (see scoped_merge.py) against a full merge: the ledgers are merged fully in a work
+# directory, then the wallets (all with None) are merged again for the quarters only. Rows of the same day may be ordered
+# differently after a scoped merge, so the rows are compared sorted. Returns a list of differences.
+# Function returning the process_directories arguments of a run writing all its outputs into work_dir
+def run_kwargs(raw_dir, service_providers, work_dir):
+    paths = {name: os.path.join(work_dir, name) for name in ['local_ledgers', 'quarterly_ledgers', 'flows', 'ledgers', 'deltas']}
+    os.makedirs(paths['local_ledgers'])
+    if os.path.exists(service_providers):
+        shutil.copy(service_providers, paths['local_ledgers'])
+    return dict(raw_data_dir=raw_dir, local_ledgers_dir=paths['local_ledgers'], quarter_dir=paths['quarterly_ledgers'],
+                combined_file=os.path.join(work_dir, 'd_ledgers.csv'), flows_dir=paths['flows'], ledgers_dir=paths['ledgers'],
+                deltas_dir=paths['deltas'], store_file=os.path.join(work_dir, 'ledgers.sqlite'),
+                aggregates_file=os.path.join(work_dir, 'quarter_aggregates.sqlite'), state_file=os.path.join(work_dir, '.pipeline_state.json'))
+
+def read_outputs(kwargs):
+    outputs = glob(os.path.join(kwargs['local_ledgers_dir'], '*.csv')) + glob(os.path.join(kwargs['quarter_dir'], '*.csv')) + [kwargs['combined_file']]
+    return {os.path.relpath(path, os.path.dirname(kwargs['combined_file'])): pd.read_csv(path, dtype=str, keep_default_na=False) for path in sorted(outputs)}
+
+# Function comparing the outputs of two runs; rows of the same day may come in a different order
+def compare_outputs(outputs, expected, description):
+    differences = []
+    for path, expected_df in expected.items():
+        key = [column for column in expected_df.columns if column != 'DOT_USD']   # DOT_USD sums may differ in the last digit
+        df = outputs.get(path, expected_df.iloc[:0])
+        differences += compare_frames(df.sort_values(key, ignore_index=True), expected_df.sort_values(key, ignore_index=True), f"{path} {description}")
+    return differences
+
+def check_scoped(raw_dir, service_providers, work_dir, wallets, quarters):
+    kwargs = run_kwargs(raw_dir, service_providers, work_dir)
+    merger.process_directories(**kwargs)
+    full = read_outputs(kwargs)
+    merge_scope(wallets, quarters, **kwargs)
+    return compare_outputs(read_outputs(kwargs), full, f"after a scoped merge of {', '.join(wallets or ['all wallets'])} {quarters[0]}:{quarters[-1]}")
+
+# Function correcting an amount of the first quarter of a wallet without adding rows, as a fixed export would. A --changed-only
+# run, which reuses the balance checkpoints of the run before the correction, must match a full merge of the corrected exports.
+def check_closed_edit(raw_dir, service_providers, work_dir, wallet='Ecosystem'):
+    edited_dir = os.path.join(work_dir, 'raw_txs')
+    shutil.copytree(raw_dir, edited_dir)
+    kwargs = run_kwargs(edited_dir, service_providers, os.path.join(work_dir, 'incremental'))
+    merger.process_directories(**kwargs, force=False)
+
+    token_file = os.path.join(edited_dir, f'${wallet}', 'token.csv')
+    token_df = pd.read_csv(token_file, dtype=str, keep_default_na=False)
+    token_df.loc[0, 'TokenValue'] = '1' + token_df.loc[0, 'TokenValue']
+    token_df.to_csv(token_file, index=False)
+    merger.process_directories(**kwargs, force=False)
+
+    full_kwargs = run_kwargs(edited_dir, service_providers, os.path.join(work_dir, 'full'))
+    merger.process_directories(**full_kwargs)
+    return compare_outputs(read_outputs(kwargs), read_outputs(full_kwargs), f"after correcting a closed-quarter amount of {wallet}")
+
+def confidence_interval(samples):
+    mean = statistics.mean(samples)
+    if len(samples) < 2:
+        return mean, 0.0
+    degrees = len(samples) - 1
+    t_value = T_VALUES.get(degrees) or next((T_VALUES[d] for d in sorted(T_VALUES) if d >= degrees), 1.96)
+    return mean, t_value * statistics.stdev(samples) / len(samples) ** 0.5
+
+def print_timings(samples, baseline=None):
+    print(f"{'Stage':<26}{'Mean, ms':>12}{'95% CI, ms':>14}" + (f"{'Baseline, ms':>16}{'Speedup':>10}" if baseline else ''))
+    for stage in STAGES:
+        mean, half_width = confidence_interval(samples[stage])
+        line = f"{stage:<26}{mean * 1000:>12.1f}{'±':>4}{half_width * 1000:>10.1f}"
+        if baseline and stage in baseline:
+            base_mean, base_half_width = baseline[stage]['mean_s'], baseline[stage]['ci_s']
+            significant = mean + half_width < base_mean - base_half_width or mean - half_width > base_mean + base_half_width
+            line += f"{base_mean * 1000:>16.1f}{base_mean / mean:>9.2f}x" + ('' if significant else ' (not significant)')
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks merger stages against golden outputs and times them.')
+    parser.add_argument('--raw-dir', default='raw_txs')
+    parser.add_argument('--service-providers', default=os.path.join('local_ledgers', 'Service Providers.csv'),
+                        help='ledger written by stream_grouper, combined together with the merged wallets')
+    parser.add_argument('--golden-dir', default=GOLDEN_DIR)
+    parser.add_argument('--update', action='store_true', help='overwrite the golden outputs with the current ones')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs')
+    parser.add_argument('--timings', help='write the timings (mean and 95%% CI per stage) as JSON to this path')
+    parser.add_argument('--timings-baseline', help='timings JSON of a previous run to compare with')
+    parser.add_argument('--scoped', action='append', default=None, metavar='WALLET:QUARTERS',
+                        help="scoped merge to check against a full merge, e.g. 'Ecosystem:2024Q1' or '*:2024Q2' for all wallets")
+    args = parser.parse_args()
+
+    service_providers = os.path.join(args.golden_dir, 'inputs', 'Service Providers.csv')   # Fixed input, as stream_grouper
+    if args.update:                                                                      # rewrites the original every day
+        os.makedirs(os.path.dirname(service_providers), exist_ok=True)
+        shutil.copy(args.service_providers, service_providers)
+
+    samples = {stage: [] for stage in STAGES}
+    with tempfile.TemporaryDirectory(prefix='ens_ledger_parity_') as work_dir:
+        local_ledgers_dir = os.path.join(work_dir, 'local_ledgers')
+        for run in range(max(1, args.repeat)):
+            shutil.rmtree(local_ledgers_dir, ignore_errors=True)
+            os.makedirs(local_ledgers_dir)
+            if os.path.exists(service_providers):
+                shutil.copy(service_providers, local_ledgers_dir)
+            outputs, timings = run_stages(args.raw_dir, local_ledgers_dir)
+            for stage, seconds in timings.items():
+                samples[stage].append(seconds)
+
+    differences = []
+    for stage, wallets in outputs.items():
+        for wallet, df in wallets.items():
+            path = golden_path(args.golden_dir, stage, wallet)
+            if args.update:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                df.to_csv(path, index=False)
+            else:
+                differences += compare(df, path)
+
+    if not args.update:
+        for scope in args.scoped or SCOPES:
+            wallet, _, quarters = scope.partition(':')
+            with tempfile.TemporaryDirectory(prefix='ens_ledger_scoped_') as work_dir:
+                differences += check_scoped(args.raw_dir, service_providers, work_dir, None if wallet == '*' else [wallet], parse_quarters(quarters))
+        with tempfile.TemporaryDirectory(prefix='ens_ledger_edited_') as work_dir:
+            differences += check_closed_edit(args.raw_dir, service_providers, work_dir)
+
+    baseline = None
+    if args.timings_baseline:
+        with open(args.timings_baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_timings(samples, baseline)
+    if args.timings:
+        with open(args.timings, 'w', encoding='utf-8') as file:
+            json.dump({stage: dict(zip(['mean_s', 'ci_s'], confidence_interval(values)), samples_s=values)
+                       for stage, values in samples.items()}, file, indent=2)
+
+    if args.update:
+        print(f'Golden outputs updated in {args.golden_dir}')
+    elif differences:
+        print('\n'.join(differences))
+        sys.exit(1)
+    else:
+        print('All stage outputs match the golden outputs.')
@@ -0,0 +1,148 @@
+import os
+import json
+import threading
+from fnmatch import fnmatch
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from atomic_files import file_hash, write_if_changed
+
+# Stage graph of a run. Every stage declares the files (or directories) it reads and the files it writes; a stage depends on
+# the stages writing its inputs. Independent stages run concurrently on a thread pool. After a stage ran, the sha256 of its
+# inputs, its parameters and the sha256 of its outputs are kept in a state file; the stage is skipped while all of them are
+# unchanged. Since outputs are only rewritten when their content changes (see atomic_files.py), a stage whose upstream
+# produced the same bytes again is skipped too.
+STATE_FILE = '.pipeline_state.json'
+
+class Stage:
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.run = run                                       # Called without arguments
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.outputs = [os.path.abspath(path) for path in outputs]
+        self.params = params or {}                           # Other things the result depends on, e.g. the day streams accrue to
+
+def _covers(path, output):
+    return output == path or output.startswith(path.rstrip(os.sep) + os.sep)
+
+# Directories are hashed over the paths and contents of all their files
+def path_hash(path):
+    if not os.path.isdir(path):
+        return file_hash(path)
+    digest = sha256()
+    for directory, directories, names in sorted(os.walk(path)):
+        directories.sort()
+        for name in sorted(names):
+            file = os.path.join(directory, name)
+            digest.update(f'{os.path.relpath(file, path)}\0{file_hash(file)}\0'.encode('utf-8'))
+    return digest.hexdigest()
+
+class Pipeline:
+
+    def __init__(self, stages, state_file=STATE_FILE):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        self.dependencies = {name: sorted({producer.name for producer in stages if producer.name != name and
+                                           any(_covers(path, output) for path in stage.inputs for output in producer.outputs)})
+                             for name, stage in self.stages.items()}
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order, visiting, done = [], set(), set()
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage '{name}' depends on itself")
+            visiting.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+        for name in self.stages:
+            visit(name)
+        return order
+
+    # Function returning the stages matching the targets (names or patterns such as 'quarterly:*') and, with upstream,
+    # everything upstream of them
+    def select(self, targets=None, upstream=True):
+        if not targets:
+            return list(self.order)
+        selected = set()
+        for target in targets:
+            matches = [name for name in self.stages if fnmatch(name, target)]
+            if not matches:
+                raise ValueError(f"No stage matches '{target}', expected one of {list(self.order)}")
+            pending = list(matches)
+            while pending:
+                name = pending.pop()
+                if name not in selected:
+                    selected.add(name)
+                    if upstream:
+                        pending.extend(self.dependencies[name])
+        return [name for name in self.order if name in selected]
+
+    def read_state(self):
+        try:
+            with open(self.state_file, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def fingerprint(self, stage):
+        return {'params': stage.params, 'inputs': {path: path_hash(path) for path in stage.inputs}}
+
+    def is_current(self, stage, recorded, fingerprint):
+        return (recorded is not None and recorded['fingerprint'] == fingerprint and
+                all(file_hash(path) == recorded['outputs'].get(path) for path in stage.outputs))
+
+    # Main Function. Runs the selected stages in dependency order, at most workers at a time; with force nothing is skipped.
+    # Without upstream only the targets run, on whatever their inputs are now.
+    # Returns {stage: 'ran' or 'skipped'}. A failing stage stops the run after the running stages finished and is raised.
+    def run(self, targets=None, force=False, workers=1, upstream=True):
+        selected = self.select(targets, upstream)
+        state = self.read_state()
+        lock = threading.Lock()
+        waiting = {name: {dependency for dependency in self.dependencies[name] if dependency in selected} for name in selected}
+        statuses = {}
+
+        def execute(name):
+            stage = self.stages[name]
+            fingerprint = self.fingerprint(stage)            # Hashed now, after the upstream stages wrote their outputs
+            if not force and self.is_current(stage, state.get(name), fingerprint):
+                return 'skipped'
+            stage.run()
+            with lock:
+                state[name] = {'fingerprint': fingerprint, 'outputs': {path: file_hash(path) for path in stage.outputs}}
+            return 'ran'
+
+        failure = None
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                running = {}
+                while waiting or running:
+                    if failure is None:
+                        for name in [name for name in selected if name in waiting and not waiting[name]]:
+                            del waiting[name]
+                            running[pool.submit(execute, name)] = name
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        if future.exception() is not None:
+                            failure = failure or future.exception()
+                            continue
+                        statuses[name] = future.result()
+                        for dependencies in waiting.values():
+                            dependencies.discard(name)
+        finally:
+            write_if_changed(self.state_file, json.dumps(state, indent=1, sort_keys=True))
+        if failure is not None:
+            raise failure
+        return statuses
+
+    def describe(self):
+        return [(name, self.dependencies[name]) for name in self.order]
@@ -0,0 +1,258 @@
+import os
+import json
+import argparse
+from functools import lru_cache
+
+from lazy_imports import lazy_import
+from price_store import PriceStore
+from atomic_files import atomic_write
+from table_cache import read_literal, load_tables
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Append-only binary price log with a daily index.
+# New prices are ingested from local CSV/JSON files and appended as fixed-size records (timestamp, asset, price) to
+# prices.bin; daily.npy is the dense (days x assets) table of daily closes used by the price store. Only the tail of
+# the index starting at the earliest new day is rebuilt, and index.json records how many log records it covers,
+# so an interrupted ingestion is completed on the next load.
+PRICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_log')
+LOG_FILE = 'prices.bin'
+INDEX_FILE = 'daily.npy'
+META_FILE = 'index.json'
+DAY = 86400
+
+TIME_COLUMNS = ['timestamp', 'datetime', 'date']             # Accepted names of the time column, case-insensitive
+
+@lru_cache(maxsize=None)
+def record_dtype():
+    return np.dtype([('timestamp', '<i8'), ('asset', 'S8'), ('price', '<f8')])
+
+def read_log(price_dir=PRICE_DIR):
+    path = os.path.join(price_dir, LOG_FILE)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty(0, dtype=record_dtype())
+    return np.memmap(path, dtype=record_dtype(), mode='r')
+
+def read_meta(price_dir=PRICE_DIR):
+    try:
+        with open(os.path.join(price_dir, META_FILE), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {'records': 0, 'first_day': None, 'assets': [], 'last': {}}
+
+def write_meta(price_dir, meta):
+    path = os.path.join(price_dir, META_FILE)
+    with atomic_write(path, 'w', encoding='utf-8') as file:
+        json.dump(meta, file, indent=2)
+
+# Function converting a price table into log records. Two layouts are accepted:
+# long (time, asset, price) and wide (time, then one column per asset, as in asset_prices).
+# The time column holds Unix timestamps (seconds or milliseconds) or dates/datetimes in UTC.
+def to_records(df):
+    columns = {column.lower(): column for column in df.columns}
+    time_column = next((columns[name] for name in TIME_COLUMNS if name in columns), None)
+    if time_column is None:
+        raise ValueError(f"A price file needs one of the columns {TIME_COLUMNS}")
+
+    if time_column.lower() == 'timestamp':
+        timestamps = pd.to_numeric(df[time_column]).astype(np.int64).to_numpy()
+        timestamps = np.where(timestamps > 10 ** 11, timestamps // 1000, timestamps)   # Milliseconds
+    else:
+        times = pd.to_datetime(df[time_column], utc=True).dt.tz_convert(None)
+        timestamps = times.to_numpy().astype('datetime64[s]').astype(np.int64)
+
+    if 'asset' in columns and 'price' in columns:
+        long_df = pd.DataFrame({'timestamp': timestamps, 'asset': df[columns['asset']].astype(str).to_numpy(),
+                                'price': pd.to_numeric(df[columns['price']]).to_numpy()})
+    else:
+        assets = [column for column in df.columns if column != time_column]
+        long_df = pd.DataFrame({'timestamp': np.repeat(timestamps, len(assets)), 'asset': np.tile(assets, len(timestamps)),
+                                'price': df[assets].apply(pd.to_numeric).to_numpy().ravel()})
+    long_df = long_df.dropna(subset=['price'])
+
+    if long_df['asset'].str.len().max() > record_dtype()['asset'].itemsize:
+        raise ValueError(f"Asset names are limited to {record_dtype()['asset'].itemsize} characters")
+    records = np.empty(len(long_df), dtype=record_dtype())
+    records['timestamp'] = long_df['timestamp'].to_numpy()
+    records['asset'] = long_df['asset'].to_numpy().astype('S8')
+    records['price'] = long_df['price'].to_numpy()
+    return records[np.lexsort((records['asset'], records['timestamp']))]
+
+def read_prices(path):
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+        return to_records(pd.DataFrame(data['prices'] if isinstance(data, dict) else data))
+    return to_records(pd.read_csv(path))
+
+def records_frame(records):
+    return pd.DataFrame({'timestamp': records['timestamp'], 'asset': records['asset'].astype(str), 'price': records['price']})
+
+def format_day(day):
+    return str(np.datetime64(int(day), 'D'))
+
+def format_time(timestamp):
+    return str(np.datetime64(int(timestamp), 's')).replace('T', ' ')
+
+# Function checking new records against each other and against the log.
+# Records already in the log with the same price are skipped; anything else that is not newer than the last
+# logged price of its asset, and every missing day between prices, is reported. Returns the records to append.
+def validate(records, price_dir=PRICE_DIR, allow_gaps=False):
+    meta = read_meta(price_dir)
+    df = records_frame(records)
+    problems = []
+
+    duplicated = df.duplicated(['asset', 'timestamp'], keep=False)
+    for (asset, timestamp), rows in df[duplicated].groupby(['asset', 'timestamp']):
+        if rows['price'].nunique() > 1:
+            problems.append(f"{asset}: conflicting prices {sorted(rows['price'])} at {format_time(timestamp)}")
+    df = df.drop_duplicates(['asset', 'timestamp'])
+
+    last = df['asset'].map(meta['last']).fillna(-1).astype(np.int64)
+    old = df['timestamp'] <= last
+    if old.any():
+        logged = records_frame(read_log(price_dir))
+        matched = df[old].merge(logged, on=['asset', 'timestamp'], how='left', suffixes=('', '_logged'))
+        for row in matched[matched['price_logged'].isna()].itertuples():
+            problems.append(f"{row.asset}: {format_time(row.timestamp)} is older than the last logged price; the log is append-only")
+        for row in matched[matched['price_logged'].notna() & (matched['price'] != matched['price_logged'])].itertuples():
+            problems.append(f"{row.asset}: {format_time(row.timestamp)} is already logged with price {row.price_logged}, not {row.price}")
+    df = df[~old]
+
+    if not allow_gaps:
+        for asset, rows in df.groupby('asset'):
+            days = np.unique(rows['timestamp'].to_numpy() // DAY)
+            if asset in meta['last']:
+                days = np.unique(np.append(days, meta['last'][asset] // DAY))
+            for before, after in zip(days[:-1][np.diff(days) > 1], days[1:][np.diff(days) > 1]):
+                problems.append(f"{asset}: no prices from {format_day(before + 1)} to {format_day(after - 1)}")
+
+    if problems:
+        raise ValueError('Prices were not ingested:\n' + '\n'.join(problems))
+    return records[np.isin(np.arange(len(records)), df.index.to_numpy())]
+
+def append(records, price_dir=PRICE_DIR):
+    os.makedirs(price_dir, exist_ok=True)
+    with open(os.path.join(price_dir, LOG_FILE), 'ab') as file:
+        file.write(np.ascontiguousarray(records).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+
+# Function bringing the daily index up to date with the log. Rows before the earliest unindexed day are kept as they are;
+# the tail is recomputed from the log records starting at that day (daily close = the last price of the day, forward-filled).
+def update_index(price_dir=PRICE_DIR, full=False):
+    meta = read_meta(price_dir)
+    log = read_log(price_dir)
+    new = log[0 if full else meta['records']:]
+    if not len(new):
+        return meta
+
+    assets = meta['assets'] + sorted({asset.decode() for asset in np.unique(new['asset'])} - set(meta['assets']))
+    index_path = os.path.join(price_dir, INDEX_FILE)
+    daily = np.load(index_path) if meta['first_day'] is not None and not full else np.empty((0, len(meta['assets'])))
+    daily = np.hstack([daily, np.full((len(daily), len(assets) - daily.shape[1]), np.nan)])
+
+    first_day = meta['first_day']
+    start_day = int(new['timestamp'].min() // DAY)
+    if first_day is None or full or start_day < first_day:   # Prices older than the index start rebuild it completely
+        start_day = first_day = int(log['timestamp'].min() // DAY)
+        daily = daily[:0]
+    start_day = min(start_day, first_day + len(daily))       # Days missing between the index and the new prices are forward-filled too
+    tail = log[log['timestamp'] >= start_day * DAY]
+    end_day = max(first_day + len(daily) - 1, int(tail['timestamp'].max() // DAY))
+
+    tail = tail[np.argsort(tail['timestamp'], kind='stable')]
+    column_of = {asset.encode(): column for column, asset in enumerate(assets)}
+    keys = (tail['timestamp'] // DAY - start_day) * len(assets) + np.array([column_of[asset] for asset in tail['asset']], dtype=np.int64)
+    _, last = np.unique(keys[::-1], return_index=True)      # The last record of every (day, asset)
+    closes = tail[::-1][last]
+    rows = np.full((end_day - start_day + 1, len(assets)), np.nan)
+    rows[closes['timestamp'] // DAY - start_day, [column_of[asset] for asset in closes['asset']]] = closes['price']
+
+    kept = daily[:start_day - first_day]
+    previous = kept[-1:] if len(kept) else np.full((1, len(assets)), np.nan)
+    rows = pd.DataFrame(np.vstack([previous, rows])).ffill().to_numpy()[1:]
+    daily = np.vstack([kept, rows])
+
+    os.makedirs(price_dir, exist_ok=True)
+    with atomic_write(index_path) as file:
+        np.save(file, daily)
+
+    last_timestamps = dict(meta['last'])
+    for asset in assets:
+        timestamps = new['timestamp'][new['asset'] == asset.encode()]
+        if len(timestamps):
+            last_timestamps[asset] = max(int(timestamps.max()), last_timestamps.get(asset, -1))
+    meta = {'records': len(log), 'first_day': first_day, 'assets': assets, 'last': last_timestamps}
+    write_meta(price_dir, meta)                              # Written last: the index counts only after this point
+    return meta
+
+# Main Function. Returns the number of appended and skipped records.
+def ingest(paths, price_dir=PRICE_DIR, allow_gaps=False):
+    records = np.concatenate([read_prices(path) for path in paths]) if paths else np.empty(0, dtype=record_dtype())
+    return ingest_records(records, price_dir, allow_gaps)
+
+def ingest_records(records, price_dir=PRICE_DIR, allow_gaps=False):
+    records = records[np.lexsort((records['asset'], records['timestamp']))]
+    update_index(price_dir)                                  # Completes an interrupted ingestion before validating
+    new = validate(records, price_dir, allow_gaps)
+    if len(new):
+        append(new, price_dir)
+        update_index(price_dir)
+    return len(new), len(records) - len(new)
+
+# The log is seeded with the daily history of asset_prices.py
+def seed(price_dir=PRICE_DIR):
+    assets = list(read_literal('prices', 'assets'))
+    prices = pd.DataFrame(read_literal('prices'), columns=['date'] + assets)
+    return ingest_records(to_records(prices), price_dir)
+
+# Every logged price point (timestamp, asset, price) in time order, for as-of valuation of transfers.
+# Without a log, the daily prices of the table cache are used as points at midnight.
+def load_price_series(price_dir=PRICE_DIR, tables=None):
+    series = records_frame(read_log(price_dir))
+    if series.empty:
+        table = (tables or load_tables())['prices']
+        assets = [str(asset) for asset in table['assets']]
+        series = pd.DataFrame({'timestamp': np.repeat(np.asarray(table['days']) * DAY, len(assets)),
+                               'asset': np.tile(assets, len(table['days'])), 'price': np.asarray(table['values']).ravel()})
+    return series.sort_values('timestamp', kind='stable', ignore_index=True)
+
+# Price store of the merger: the daily index of the log if it exists, otherwise the prices of the table cache
+def load_price_store(price_dir=PRICE_DIR, tables=None):
+    meta = read_meta(price_dir)
+    if meta['first_day'] is None:
+        return PriceStore.from_table((tables or load_tables())['prices'])
+    if meta['records'] < len(read_log(price_dir)):
+        meta = update_index(price_dir)
+    return PriceStore(meta['first_day'], np.load(os.path.join(price_dir, INDEX_FILE), mmap_mode='r'), meta['assets'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingests asset prices into the append-only price log.')
+    parser.add_argument('--price-dir', default=PRICE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help='append prices from CSV/JSON files')
+    ingest_parser.add_argument('files', nargs='+')
+    ingest_parser.add_argument('--allow-gaps', action='store_true', help='accept missing days (they are forward-filled)')
+    commands.add_parser('seed', help='start the log from asset_prices.py')
+    commands.add_parser('rebuild', help='rebuild the whole daily index from the log')
+    commands.add_parser('info', help='print the assets and the covered days')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'ingest':
+            appended, skipped = ingest(args.files, args.price_dir, args.allow_gaps)
+            print(f"{appended} prices appended, {skipped} already logged")
+        elif args.command == 'seed':
+            appended, skipped = seed(args.price_dir)
+            print(f"{appended} prices appended from asset_prices.py, {skipped} already logged")
+        elif args.command == 'rebuild':
+            update_index(args.price_dir, full=True)
+    except ValueError as error:
+        parser.exit(1, f"{error}\n")
+
+    meta = read_meta(args.price_dir)
+    if meta['first_day'] is not None:
+        days = len(np.load(os.path.join(args.price_dir, INDEX_FILE), mmap_mode='r'))
+        print(f"{meta['records']} records, {', '.join(meta['assets'])} from {format_day(meta['first_day'])} to {format_day(meta['first_day'] + days - 1)}")
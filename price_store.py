@@ -0,0 +1,63 @@
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+
+# Dense price table: one row per day between the first and the last known price, one column per asset.
+# Missing days are forward-filled when the store is built, so valuing a whole column is a single gather by day ordinal.
+# Days after the last known price get the last price. Days before the first price of an asset are valued at 0
+# (no market price yet), or at its first known price with backfill=True.
+FIXED_PRICES = { # Assets valued without a price history
+    'USDC': 1.0
+}
+
+class PriceStore:
+
+    # prices is the dense (days x assets) array starting at first_day; NaN only before the first price of an asset
+    def __init__(self, first_day, prices, assets):
+        self.first_day = int(first_day)                         # Day ordinal (days since 1970-01-01) of the first row
+        self.prices = prices
+        self.assets = {asset: column for column, asset in enumerate(assets)}
+        known = ~np.isnan(prices)
+        self.first_valid = np.where(known.any(axis=0), known.argmax(axis=0), len(prices))   # First priced row of every asset
+
+    # Function building the dense table from known prices (day ordinals and a days x assets array), forward-filling missing days
+    @classmethod
+    def from_prices(cls, days, values, assets):
+        days = np.asarray(days, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64).reshape(len(days), len(assets))
+        if len(days) == 0:
+            return cls(0, np.zeros((0, len(assets))), assets)
+
+        order = np.argsort(days, kind='stable')
+        days, values = days[order], values[order]
+        all_days = np.arange(days[0], days[-1] + 1)
+        return cls(days[0], values[np.searchsorted(days, all_days, side='right') - 1], assets)
+
+    # The store is built from the prices table of the compiled cache (see table_cache.py)
+    @classmethod
+    def from_table(cls, table):
+        return cls.from_prices(table['days'], table['values'], [str(asset) for asset in table['assets']])
+
+    def __contains__(self, asset):
+        return asset in self.assets or asset in FIXED_PRICES
+
+    def __len__(self):
+        return len(self.prices)
+
+    # Function returning the price of an asset for every date of a column (datetime64, datetime.date or 'YYYY-MM-DD')
+    def price(self, asset, dates, backfill=False):
+        days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+        if asset in FIXED_PRICES:
+            return np.full(days.shape, FIXED_PRICES[asset])
+        if asset not in self.assets:
+            raise KeyError(f"No prices for {asset}")
+        column = self.assets[asset]
+        first_valid = self.first_valid[column]
+        if first_valid >= len(self.prices):
+            return np.zeros(days.shape)
+        positions = np.clip(days - self.first_day, first_valid, len(self.prices) - 1)
+        prices = self.prices[positions, column]
+        return prices if backfill else np.where(days - self.first_day < first_valid, 0.0, prices)
+
+    def price_on(self, asset, date, backfill=False):
+        return float(self.price(asset, [date], backfill)[0])
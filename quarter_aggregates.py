@@ -0,0 +1,252 @@
+import os
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+from amounts import decimals_of, to_float
+from fiscal_calendar import quarter_labels, calendar_end_of
+
+pd = lazy_import('pandas')
+
+# Materialized quarterly aggregates of every wallet, persisted between runs: the sums behind the quarterly ledgers
+# (quarter, from category, to category, symbol) and the running interquarter balances of every symbol.
+# A new transfer updates one sum and one flow; only a back-dated transfer (a quarter before the last one of the wallet)
+# carries its amount forward into the balances of the later quarters. The merger seeds the state from its full run;
+# update_from_raw_store applies the blocks mined since then and rewrites only the quarterly ledgers they touch.
+AGGREGATES_FILE = 'quarter_aggregates.sqlite'
+
+SCHEMA = [ # Amounts are integer base units stored as text, since wei sums do not fit into 64 bits
+    """CREATE TABLE IF NOT EXISTS sums (
+        wallet TEXT, quarter TEXT, from_category TEXT, to_category TEXT, symbol TEXT,
+        value TEXT NOT NULL, dot_usd REAL NOT NULL,
+        PRIMARY KEY (wallet, quarter, from_category, to_category, symbol)
+    )""",
+    """CREATE TABLE IF NOT EXISTS balances (
+        wallet TEXT, symbol TEXT, quarter TEXT,
+        flow TEXT NOT NULL,                                  -- Sum of the quarter
+        balance TEXT NOT NULL,                               -- Sum of the quarter and every earlier quarter of the wallet
+        PRIMARY KEY (wallet, symbol, quarter)
+    )""",
+    "CREATE INDEX IF NOT EXISTS balances_wallet_quarter ON balances (wallet, quarter)",
+    "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+]
+SUM_KEY = ['Quarter', 'From_category', 'To_category', 'Symbol']
+
+class QuarterAggregates:
+
+    def __init__(self, path=AGGREGATES_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Transactions are explicit, see transaction()
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def get(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, str(value)))
+
+    def wallets(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT wallet FROM balances ORDER BY wallet")]
+
+    def _insert(self, wallet, grouped_df, unspent_df):
+        if grouped_df.empty and unspent_df.empty:            # Quarters without transfers have no sums and no balances
+            return
+        sums = grouped_df[SUM_KEY].astype(str).assign(Value=grouped_df['Value'].to_numpy(), DOT_USD=grouped_df['DOT_USD'].to_numpy())
+        flows = sums.groupby(['Quarter', 'Symbol'])['Value'].sum()
+        self.connection.executemany("INSERT INTO sums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(wallet, *key, str(int(value)), float(dot_usd)) for *key, value, dot_usd in sums.itertuples(index=False)])
+        self.connection.executemany("INSERT INTO balances VALUES (?, ?, ?, ?, ?)", [
+            (wallet, str(symbol), str(quarter).replace(' Unspent', ''), str(int(flows.get((str(quarter).replace(' Unspent', ''), str(symbol)), 0))),
+             str(int(balance)))
+            for quarter, symbol, balance in zip(unspent_df['Quarter'], unspent_df['Symbol'], unspent_df['Value'])])
+
+    # Function replacing the state of a wallet with the grouped and unspent frames of a full merger run
+    def load(self, wallet, grouped_df, unspent_df):
+        with self.transaction():
+            self.connection.execute("DELETE FROM sums WHERE wallet = ?", (wallet,))
+            self.connection.execute("DELETE FROM balances WHERE wallet = ?", (wallet,))
+            self._insert(wallet, grouped_df, unspent_df)
+
+    # Function replacing the state of some quarters of a wallet with the frames of a scoped run (see scoped_merge.py).
+    # The balances of later quarters move by changes, {symbol: change of the closing balance of the last quarter}.
+    def splice(self, wallet, quarters, grouped_df, unspent_df, changes):
+        placeholders = ', '.join('?' * len(quarters))
+        with self.transaction():
+            self.connection.execute(f"DELETE FROM sums WHERE wallet = ? AND quarter IN ({placeholders})", (wallet, *quarters))
+            self.connection.execute(f"DELETE FROM balances WHERE wallet = ? AND quarter IN ({placeholders})", (wallet, *quarters))
+            self._insert(wallet, grouped_df, unspent_df)
+            for symbol, change in changes.items():
+                rows = self.connection.execute("SELECT quarter, balance FROM balances WHERE wallet = ? AND symbol = ? AND quarter > ?",
+                                               (wallet, symbol, quarters[-1])).fetchall()
+                self.connection.executemany("UPDATE balances SET balance = ? WHERE wallet = ? AND symbol = ? AND quarter = ?",
+                                            [(str(int(balance) + change), wallet, symbol, quarter) for quarter, balance in rows])
+
+    # Symbols of a wallet in the order the merger lists their interquarter balances (first appearance in the grouped ledger)
+    def symbols(self, wallet):
+        rows = self.connection.execute("SELECT symbol FROM sums WHERE wallet = ? ORDER BY quarter, from_category, to_category, symbol", (wallet,))
+        symbols = list(dict.fromkeys(row[0] for row in rows))
+        return symbols + [row[0] for row in self.connection.execute("SELECT DISTINCT symbol FROM balances WHERE wallet = ? ORDER BY symbol", (wallet,))
+                          if row[0] not in symbols]
+
+    # Function returning the balance of every symbol of a wallet at the end of a quarter (or, with inclusive=False, of the
+    # last quarter before it). Symbols without a balance by then are 0.
+    def closing_balances(self, wallet, quarter, inclusive=True):
+        balances = {}
+        for symbol in self.symbols(wallet):
+            row = self.connection.execute(f"SELECT balance FROM balances WHERE wallet = ? AND symbol = ? AND quarter {'<=' if inclusive else '<'} ? "
+                                          "ORDER BY quarter DESC LIMIT 1", (wallet, symbol, quarter)).fetchone()
+            balances[symbol] = int(row[0]) if row else 0
+        return balances
+
+    def _quarter_exists(self, wallet, quarter):
+        return self.connection.execute("SELECT 1 FROM balances WHERE wallet = ? AND quarter = ? LIMIT 1", (wallet, quarter)).fetchone() is not None
+
+    def _symbol_exists(self, wallet, symbol):
+        return self.connection.execute("SELECT 1 FROM balances WHERE wallet = ? AND symbol = ? LIMIT 1", (wallet, symbol)).fetchone() is not None
+
+    # A new quarter of a wallet starts every symbol with the balance of the previous quarter, as in merger.add_unspent_balances
+    def _open_quarter(self, wallet, quarter, symbol):
+        symbols = {row[0] for row in self.connection.execute("SELECT DISTINCT symbol FROM balances WHERE wallet = ?", (wallet,))} | {symbol}
+        for symbol in sorted(symbols):
+            previous = self.connection.execute("SELECT balance FROM balances WHERE wallet = ? AND symbol = ? AND quarter < ? "
+                                               "ORDER BY quarter DESC LIMIT 1", (wallet, symbol, quarter)).fetchone()
+            self.connection.execute("INSERT INTO balances VALUES (?, ?, ?, '0', ?)", (wallet, symbol, quarter, previous[0] if previous else '0'))
+
+    def _open_symbol(self, wallet, symbol):
+        quarters = [row[0] for row in self.connection.execute("SELECT DISTINCT quarter FROM balances WHERE wallet = ?", (wallet,))]
+        self.connection.executemany("INSERT INTO balances VALUES (?, ?, ?, '0', '0')", [(wallet, symbol, quarter) for quarter in quarters])
+
+    # Function adding one acquainted transfer of a wallet. Returns the number of later quarters whose balance was carried forward.
+    def add(self, wallet, quarter, from_category, to_category, symbol, value, dot_usd):
+        key = (wallet, quarter, from_category, to_category, symbol)
+        row = self.connection.execute("SELECT value, dot_usd FROM sums WHERE wallet = ? AND quarter = ? AND from_category = ? "
+                                      "AND to_category = ? AND symbol = ?", key).fetchone()
+        if row:
+            self.connection.execute("UPDATE sums SET value = ?, dot_usd = ? WHERE wallet = ? AND quarter = ? AND from_category = ? "
+                                    "AND to_category = ? AND symbol = ?", (str(int(row[0]) + value), row[1] + dot_usd, *key))
+        else:
+            self.connection.execute("INSERT INTO sums VALUES (?, ?, ?, ?, ?, ?, ?)", (*key, str(value), dot_usd))
+
+        if not self._symbol_exists(wallet, symbol):
+            self._open_symbol(wallet, symbol)
+        if not self._quarter_exists(wallet, quarter):
+            self._open_quarter(wallet, quarter, symbol)
+
+        # The quarter itself and, for back-dated transfers, every later quarter of the wallet
+        rows = self.connection.execute("SELECT quarter, flow, balance FROM balances WHERE wallet = ? AND symbol = ? AND quarter >= ?",
+                                       (wallet, symbol, quarter)).fetchall()
+        self.connection.executemany("UPDATE balances SET flow = ?, balance = ? WHERE wallet = ? AND symbol = ? AND quarter = ?", [
+            (str(int(flow) + value) if row_quarter == quarter else flow, str(int(balance) + value), wallet, symbol, row_quarter)
+            for row_quarter, flow, balance in rows])
+        return len(rows) - 1
+
+    # Function adding the acquainted transfers of a wallet (merger.acquainted_transfers). Without a transaction of the caller
+    # they are added in their own one.
+    def add_transfers(self, wallet, df, in_transaction=False):
+        if not in_transaction:
+            with self.transaction():
+                return self.add_transfers(wallet, df, in_transaction=True)
+        carried = 0
+        for quarter, from_category, to_category, symbol, value, dot_usd in zip(
+                quarter_labels(df['Date']), df['From_category'].astype(str), df['To_category'].astype(str), df['Symbol'].astype(str), df['Value'], df['DOT_USD']):
+            carried += self.add(wallet, str(quarter), from_category, to_category, symbol, int(value), float(dot_usd))
+        return carried
+
+    # Function returning the grouped and unspent frames of a wallet, in the layout of merger.group_by_quarter and merger.add_unspent_balances
+    def frames(self, wallet, price_store):
+        sums = self.connection.execute("SELECT quarter, from_category, to_category, symbol, value, dot_usd FROM sums WHERE wallet = ? "
+                                       "ORDER BY quarter, from_category, to_category, symbol", (wallet,)).fetchall()
+        grouped_df = pd.DataFrame(sums, columns=SUM_KEY + ['Value', 'DOT_USD'])
+        grouped_df['Value'] = pd.Series([int(value) for value in grouped_df['Value']], index=grouped_df.index, dtype=object)
+
+        balances = self.connection.execute("SELECT quarter, symbol, balance FROM balances WHERE wallet = ? ORDER BY quarter", (wallet,)).fetchall()
+        symbol_order = {symbol: position for position, symbol in enumerate(grouped_df['Symbol'].unique())}
+        balances.sort(key=lambda row: (row[0], symbol_order.get(row[1], len(symbol_order))))
+        unspent_df = pd.DataFrame([{
+            'Quarter': f"{quarter} Unspent",
+            'From_category': wallet,
+            'To_category': wallet if wallet != "Community WG" else "Community SG",
+            'Symbol': symbol,
+            'Value': int(balance),
+            'DOT_USD': to_float(int(balance), decimals_of(symbol)) * price_store.price_on(symbol, calendar_end_of(quarter), backfill=True)
+        } for quarter, symbol, balance in balances])
+        return grouped_df, unspent_df
+
+# Function rewriting the quarterly ledger of a wallet from the aggregates
+def export_quarterly(aggregates, wallet, price_store, quarter_dir='quarterly_ledgers'):
+    import merger
+    grouped_df, unspent_df = aggregates.frames(wallet, price_store)
+    grouped_with_unspent_df = pd.concat([grouped_df, unspent_df]).sort_values(by='Quarter')
+    final_df = merger.finalize_and_sort_df(grouped_with_unspent_df, wallet)
+    return merger.export_ledger(final_df, os.path.join(quarter_dir, f'{wallet}_q.csv'))
+
+# Main Function of the incremental path. Applies the transfers of the blocks mined since the last run (see raw_store.py)
+# and rewrites the quarterly ledgers of the wallets they touched. Returns {wallet: transfers added}.
+def update_from_raw_store(raw_store_file, aggregates_file=AGGREGATES_FILE, quarter_dir='quarterly_ledgers'):
+    import merger
+    from raw_store import RawStore
+
+    wallets_dict, txs_dict, price_store, interner = merger.build_lookups()
+    added = {}
+    with RawStore(raw_store_file, read_only=True) as raw_store, QuarterAggregates(aggregates_file) as aggregates:
+        last_block = int(aggregates.get('last_block', -1))
+        new_last_block = raw_store.last_block()
+        if new_last_block is None or new_last_block <= last_block:
+            return added
+
+        named = {}
+        for wallet in raw_store.wallets():
+            token_df = raw_store.token_frame(wallet, since_block=last_block)
+            internal_df = raw_store.internal_frame(wallet, price_store, since_block=last_block)
+            if token_df.empty and internal_df.empty:
+                continue
+            named[wallet] = merger.merge_txs(merger.process_erc20_txs(token_df, price_store, interner),
+                                             merger.process_internal_txs(internal_df, interner))
+        label_dtype = merger.build_label_dtype(wallets_dict, txs_dict, raw_store.wallets())
+
+        transfers = {wallet: merger.acquainted_transfers(merger.identify_wallets(merged_df, wallets_dict, txs_dict, wallet, interner, label_dtype))
+                     for wallet, merged_df in named.items()}
+        with aggregates.transaction():                       # All wallets and the last block at once, so a failed run can be repeated
+            for wallet, df in transfers.items():
+                aggregates.add_transfers(wallet, df, in_transaction=True)
+                added[wallet] = len(df)
+            aggregates.set('last_block', new_last_block)
+
+        for wallet in [wallet for wallet, count in added.items() if count]:   # Unknown counterparties only: nothing to export
+            export_quarterly(aggregates, wallet, price_store, quarter_dir)
+    return added
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Applies newly mined transfers to the quarterly aggregates and ledgers.')
+    parser.add_argument('--raw-store', default='raw_txs.sqlite', help='miner store, see raw_store.py')
+    parser.add_argument('--aggregates', default=AGGREGATES_FILE)
+    parser.add_argument('--quarter-dir', default='quarterly_ledgers')
+    args = parser.parse_args()
+
+    added = update_from_raw_store(args.raw_store, args.aggregates, args.quarter_dir)
+    for wallet, count in added.items():
+        print(f"{wallet}: {count} transfers added")
+    if not added:
+        print('No new blocks')
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import argparse
+from urllib.request import pathname2url
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+from amounts import to_base_units
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Transactional store of the transfers found by the miner. Every decoded log is upserted under (tx hash, log index) together
+# with the raw_txs folders of its sender and recipient, and a block is written in one transaction with its blocks row,
+# so a crash never leaves half a block and processing a block twice changes nothing.
+# The merger reads the rows back in the Etherscan layout of token.csv and internal.csv (see merger.process_directories).
+STORE_FILE = 'raw_txs.sqlite'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS transfers (
+        tx_hash TEXT NOT NULL,
+        log_index INTEGER NOT NULL,
+        block_number INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,                          -- Unix timestamp of the block
+        kind TEXT NOT NULL,                                  -- 'token' (Transfer) or 'internal' (ETH)
+        from_address TEXT NOT NULL,
+        to_address TEXT NOT NULL,
+        from_wallet TEXT,                                    -- raw_txs folder without '$', NULL if not an ENS wallet
+        to_wallet TEXT,
+        contract_address TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        value TEXT NOT NULL,                                 -- Exact decimal amount
+        PRIMARY KEY (tx_hash, log_index)
+    )""",
+    "CREATE INDEX IF NOT EXISTS transfers_from_wallet ON transfers (from_wallet, kind)",
+    "CREATE INDEX IF NOT EXISTS transfers_to_wallet ON transfers (to_wallet, kind)",
+    "CREATE INDEX IF NOT EXISTS transfers_block ON transfers (block_number)",
+    "CREATE TABLE IF NOT EXISTS blocks (block_number INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, transfers INTEGER NOT NULL)"
+]
+TRANSFER_FIELDS = ['tx_hash', 'log_index', 'kind', 'from_address', 'to_address', 'from_wallet', 'to_wallet', 'contract_address',
+                   'symbol', 'value']
+
+UPSERT = f"""INSERT INTO transfers (block_number, timestamp, {', '.join(TRANSFER_FIELDS)})
+    VALUES ({', '.join('?' * (len(TRANSFER_FIELDS) + 2))})
+    ON CONFLICT (tx_hash, log_index) DO UPDATE SET
+    {', '.join(f'{field} = excluded.{field}' for field in ['block_number', 'timestamp'] + TRANSFER_FIELDS[2:])}"""
+
+# Columns of the Etherscan exports, as read by merger.process_erc20_txs and merger.process_internal_txs
+TOKEN_COLUMNS = ['Transaction Hash', 'Blockno', 'UnixTimestamp', 'DateTime (UTC)', 'From', 'To', 'TokenValue', 'USDValueDayOfTx',
+                 'ContractAddress', 'TokenName', 'TokenSymbol']
+INTERNAL_COLUMNS = ['Transaction Hash', 'Blockno', 'UnixTimestamp', 'DateTime (UTC)', 'ParentTxFrom', 'ParentTxTo', 'ParentTxETH_Value',
+                    'From', 'TxTo', 'ContractAddress', 'Value_IN(ETH)', 'Value_OUT(ETH)', 'Historical $Price/Eth', 'Status', 'ErrCode',
+                    'Type', 'PrivateNote']
+
+class RawStore:
+
+    # Readers open the store read-only: they never checkpoint or remove its -wal file, whose changes the supervisor watches
+    def __init__(self, path=STORE_FILE, read_only=False):
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True, isolation_level=None)
+            return
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Transactions are explicit, see transaction()
+        self.connection.execute("PRAGMA journal_mode = WAL")  # The merger can read while the miner writes
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    # Function writing the transfers of a block (dicts with TRANSFER_FIELDS) and the block itself in one transaction
+    def upsert_block(self, block_number, timestamp, transfers):
+        with self.transaction():
+            self.connection.executemany(UPSERT, [(block_number, timestamp, *(transfer[field] for field in TRANSFER_FIELDS))
+                                                 for transfer in transfers])
+            self.connection.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)", (block_number, timestamp, len(transfers)))
+
+    def last_block(self):
+        return self.connection.execute("SELECT MAX(block_number) FROM blocks").fetchone()[0]
+
+    # Changes with every block the miner commits, and only then
+    def version(self):
+        return self.connection.execute("SELECT COUNT(*), MAX(block_number), SUM(transfers) FROM blocks").fetchone()
+
+    def wallets(self):
+        rows = self.connection.execute("SELECT from_wallet FROM transfers WHERE from_wallet IS NOT NULL UNION "
+                                       "SELECT to_wallet FROM transfers WHERE to_wallet IS NOT NULL ORDER BY 1").fetchall()
+        return [row[0] for row in rows]
+
+    # since_block limits the rows to the blocks after it, e.g. those mined since the last incremental update
+    def _rows(self, wallet, kind, since_block=None):
+        cursor = self.connection.execute(
+            "SELECT * FROM transfers WHERE kind = ? AND (from_wallet = ? OR to_wallet = ?) AND block_number > ? ORDER BY block_number, log_index",
+            (kind, wallet, wallet, -1 if since_block is None else since_block))
+        return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+    # The token transfers of a wallet as token.csv rows. The USD value is left empty, so the merger takes it from the price store.
+    def token_frame(self, wallet, since_block=None):
+        rows = self._rows(wallet, 'token', since_block)
+        return pd.DataFrame({
+            'Transaction Hash': rows['tx_hash'],
+            'Blockno': rows['block_number'],
+            'UnixTimestamp': rows['timestamp'],
+            'DateTime (UTC)': _datetimes(rows['timestamp']),
+            'From': rows['from_address'],
+            'To': rows['to_address'],
+            'TokenValue': rows['value'],
+            'USDValueDayOfTx': np.nan,
+            'ContractAddress': rows['contract_address'],
+            'TokenName': '',
+            'TokenSymbol': rows['symbol']
+        }, columns=TOKEN_COLUMNS)
+
+    # The ETH transfers of a wallet as internal.csv rows, with the sign given by the side of the wallet
+    def internal_frame(self, wallet, price_store=None, since_block=None):
+        rows = self._rows(wallet, 'internal', since_block)
+        incoming = (rows['to_wallet'] == wallet).to_numpy()
+        dates = _datetimes(rows['timestamp'])
+        return pd.DataFrame({
+            'Transaction Hash': rows['tx_hash'],
+            'Blockno': rows['block_number'],
+            'UnixTimestamp': rows['timestamp'],
+            'DateTime (UTC)': dates,
+            'ParentTxFrom': rows['from_address'],
+            'ParentTxTo': rows['to_address'],
+            'ParentTxETH_Value': '0',
+            'From': rows['from_address'],
+            'TxTo': rows['to_address'],
+            'ContractAddress': '',
+            'Value_IN(ETH)': np.where(incoming, rows['value'], '0'),
+            'Value_OUT(ETH)': np.where(incoming, '0', rows['value']),
+            'Historical $Price/Eth': price_store.price('ETH', dates.str[:10]) if price_store is not None else np.nan,
+            'Status': 0,
+            'ErrCode': '',
+            'Type': 'call',
+            'PrivateNote': ''
+        }, columns=INTERNAL_COLUMNS)
+
+def _datetimes(timestamps):
+    return pd.Series(timestamps.to_numpy(dtype=np.int64).astype('datetime64[s]').astype(str), index=timestamps.index).str.replace('T', ' ')
+
+# Columns identifying a transfer in token.csv and internal.csv. Exports have no log index, and one transaction can hold several
+# transfers (multisends), so a transfer is matched on its hash, sides, amount and token.
+TRANSFER_KEYS = {
+    'token': ['Transaction Hash', 'From', 'To', 'TokenValue', 'ContractAddress'],
+    'internal': ['Transaction Hash', 'From', 'TxTo', 'Value_IN(ETH)', 'Value_OUT(ETH)']
+}
+
+def _amount_key(values):
+    return [str(to_base_units(value, 18)) for value in values]   # "1,000" and "1000.0" are the same amount
+
+# Function returning one key per row, numbered within equal transfers, so n identical transfers in the export match n stored ones
+def _transfer_keys(frame, columns):
+    keys = pd.DataFrame({column: _amount_key(frame[column]) if 'Value' in column else frame[column].fillna('').astype(str).str.lower()
+                         for column in columns})
+    keys['Occurrence'] = keys.groupby(columns, sort=False).cumcount()
+    return pd.MultiIndex.from_frame(keys)
+
+# Function adding the stored rows of a wallet to its Etherscan export. Transfers already in the export are skipped,
+# so a fresh export that overlaps the mined blocks does not double count them.
+def with_export(stored, export_file, dtype):
+    if not os.path.exists(export_file):
+        return stored
+    export = pd.read_csv(export_file, dtype=dtype)
+    columns = TRANSFER_KEYS['token' if 'TokenValue' in stored.columns else 'internal']
+    stored = stored[~_transfer_keys(stored, columns).isin(_transfer_keys(export, columns))]
+    return pd.concat([export, stored], ignore_index=True) if len(stored) else export
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows the contents of the miner store.')
+    parser.add_argument('--store', default=STORE_FILE)
+    args = parser.parse_args()
+
+    with RawStore(args.store, read_only=True) as store:
+        blocks, transfers = store.connection.execute("SELECT COUNT(*), SUM(transfers) FROM blocks").fetchone()
+        print(f"{blocks} blocks, {transfers or 0} transfers, last block {store.last_block()}")
+        for wallet in store.wallets():
+            print(f"  {wallet}: {len(store.token_frame(wallet))} token, {len(store.internal_frame(wallet))} internal")
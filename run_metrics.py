@@ -0,0 +1,139 @@
+import cProfile
+import json
+import os
+import time
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+
+# Stage-level instrumentation for merger runs.
+# Every stage call records wall time, CPU time, rows in and out and, if enabled, the tracemalloc peak.
+# The records are written as a JSON run report; per-stage cProfile dumps are optional.
+# The tracemalloc peak is process-wide, so stages overlapping with a stage of another thread get no peak.
+_running = threading.local()                                 # Records of the stages running on this thread, innermost last
+
+# Function adding the rows a running stage read from its input files, for stages called with paths instead of frames.
+# Returns df, so that it wraps the read.
+def count_rows_in(df):
+    stack = getattr(_running, 'stack', None)
+    if stack:
+        stack[-1]['rows_in'] += len(df)
+    return df
+
+class RunMetrics:
+
+    def __init__(self, trace_memory=False, profile_dir=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.records = []
+        self._local = threading.local()                      # Stages of the pipeline may run on several threads
+        self._lock = threading.Lock()
+        self._open = []                                      # Running records of all threads
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @property
+    def _stack(self):                                        # Currently running stages of this thread, to handle nested calls
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    # Function running one stage and recording its metrics. Rows in are counted on dataframe arguments.
+    def call(self, stage, wallet, function, *args, **kwargs):
+        record = {
+            'stage': stage,
+            'wallet': wallet,
+            'rows_in': sum(len(arg) for arg in args if hasattr(arg, 'columns')),
+            'rows_out': None,
+            'wall_s': None,
+            'cpu_s': None,
+            'peak_mb': None
+        }
+        profiler = cProfile.Profile() if self.profile_dir and not self._stack else None
+        if self.trace_memory:
+            if self._stack:                                  # The peak of the enclosing stage is kept before resetting
+                self._stack[-1]['_peak'] = max(self._stack[-1]['_peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        record['_peak'] = 0
+        with self._lock:
+            if not self._stack and any(other['_thread'] != threading.get_ident() for other in self._open):
+                for other in self._open:                     # Another thread runs a stage: neither peak is this stage's own
+                    other['_shared'] = True
+                record['_shared'] = True
+            record['_thread'] = threading.get_ident()
+            record['_shared'] = record.get('_shared', False) or any(other['_shared'] for other in self._stack)
+            self._open.append(record)
+        self._stack.append(record)
+        if not hasattr(_running, 'stack'):
+            _running.stack = []
+        _running.stack.append(record)
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            if profiler:
+                result = profiler.runcall(function, *args, **kwargs)
+            else:
+                result = function(*args, **kwargs)
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            self._stack.pop()
+            _running.stack.pop()
+            with self._lock:
+                self._open = [other for other in self._open if other is not record]
+                shared = record.pop('_shared')
+                del record['_thread']
+            peak = record.pop('_peak')
+            if self.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                record['peak_mb'] = None if shared else peak / 2 ** 20
+                if self._stack:
+                    self._stack[-1]['_peak'] = max(self._stack[-1]['_peak'], peak)
+            if profiler:
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{wallet or 'all'}.{stage}.prof"))
+            self.records.append(record)
+
+        if hasattr(result, '__len__'):
+            record['rows_out'] = len(result)
+        return result
+
+    # Per-stage totals over all wallets
+    def totals(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rows_in': 0, 'rows_out': 0, 'peak_mb': None})
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['rows_in'] += record['rows_in']
+            total['rows_out'] += record['rows_out'] or 0
+            if record['peak_mb'] is not None:
+                total['peak_mb'] = max(total['peak_mb'] or 0, record['peak_mb'])
+        return totals
+
+    def report(self):
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall_s': time.perf_counter() - self.started,
+            'trace_memory': self.trace_memory,
+            'stages': self.records,
+            'totals': self.totals()
+        }
+
+    def write_report(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def print_summary(self):
+        print(f"{'Stage':<34}{'Calls':>6}{'Wall, s':>10}{'CPU, s':>10}{'Rows in':>10}{'Rows out':>10}{'Peak, MB':>10}")
+        for stage, total in self.totals().items():
+            peak = f"{total['peak_mb']:.1f}" if total['peak_mb'] is not None else '-'
+            print(f"{stage:<34}{total['calls']:>6}{total['wall_s']:>10.3f}{total['cpu_s']:>10.3f}{total['rows_in']:>10}{total['rows_out']:>10}{peak:>10}")
+        print(f"{'Total':<34}{'':>6}{time.perf_counter() - self.started:>10.3f}")
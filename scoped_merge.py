@@ -0,0 +1,164 @@
+import io
+import os
+from glob import glob
+
+from lazy_imports import lazy_import
+from amounts import parse_amounts, format_amounts, to_float, decimals_of
+from fiscal_calendar import quarter_labels, quarter_spans, quarter_end_of, calendar_end_of
+from atomic_files import write_if_changed
+from price_log import DAY, load_price_series
+from raw_store import RawStore, with_export
+from quarter_aggregates import QuarterAggregates, AGGREGATES_FILE
+from balance_checkpoints import BalanceCheckpoints
+import merger
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Scoped merges: the ledgers of some wallets are rebuilt for a range of quarters only. Raw rows outside of the range are
+# dropped before ingestion, the rebuilt quarters are spliced into the existing local and quarterly ledgers, and the
+# interquarter balances start from the balances stored for the previous quarter (see quarter_aggregates.py). Later
+# quarters keep their rows; only their balances move by the change of the closing balance. The ledgers and aggregates of
+# all wallets are computed before any of them is written, so a failing wallet leaves every output as it was. The combined
+# ledger and the exports after it are then rebuilt from the local ledgers.
+DOWNSTREAM_STAGES = ['aggregates', 'combined', 'partitions', 'flows', 'deltas', 'store']
+
+# Function returning the quarters of '2024Q2' or '2024Q1:2024Q3'
+def parse_quarters(spec):
+    first, _, last = spec.partition(':')
+    return [str(label) for label in quarter_spans(quarter_end_of(first), quarter_end_of(last or first))[0]]
+
+# Function returning the quarters overlapping '2024-04-01:2024-06-30'. Quarters are always rebuilt whole.
+def parse_dates(spec):
+    first, _, last = spec.partition(':')
+    return [str(label) for label in quarter_spans(np.datetime64(first, 'D'), np.datetime64(last or first, 'D'))[0]]
+
+# Function returning the quarter of every row of a token.csv / internal.csv frame, from its Unix timestamp if it has one
+def raw_quarters(raw_df):
+    timestamps = pd.to_numeric(raw_df['UnixTimestamp'], errors='coerce')
+    missing = timestamps.isna()
+    if missing.any():
+        timestamps[missing] = merger.unix_timestamps(pd.to_datetime(raw_df.loc[missing, 'DateTime (UTC)']))
+    return quarter_labels((timestamps.to_numpy(dtype=np.int64) // DAY).astype('datetime64[D]')).astype(str)
+
+def in_scope(raw_df, quarters):
+    return raw_df[np.isin(raw_quarters(raw_df), quarters)]
+
+def _strings(csv):
+    return pd.read_csv(io.StringIO(csv), dtype=str, keep_default_na=False)
+
+def _read_strings(file, columns):
+    return pd.read_csv(file, dtype=str, keep_default_na=False) if os.path.exists(file) else pd.DataFrame(columns=columns, dtype=str)
+
+# Function replacing the rows of the quarters in a ledger read as strings. quarters_of gives the quarter of every row.
+def splice(existing, rebuilt, quarters_of, quarters):
+    labels = quarters_of(existing)
+    before, after = existing[labels < quarters[0]], existing[labels > quarters[-1]]
+    return pd.concat([before, rebuilt, after], ignore_index=True)
+
+def _local_quarters(df):
+    return quarter_labels(df['Date'].to_numpy().astype('datetime64[D]')).astype(str)
+
+def _base_quarters(df):
+    return df['Quarter'].str[:6].to_numpy()
+
+# Function rebuilding the local ledger of a wallet for the quarters. Returns the rebuilt rows as named by identify_wallets;
+# the spliced ledger is added to files ({file: text}) instead of being written.
+def rebuild_local(wallet, folder, quarters, lookups, label_dtype, files, local_ledgers_dir='local_ledgers', raw_store_file=None, price_series=None, metrics=None):
+    metrics = metrics or merger.RunMetrics()
+    wallets_dict, txs_dict, price_store, interner = lookups
+    token_file, internal_file = os.path.join(folder, 'token.csv'), os.path.join(folder, 'internal.csv')
+    if raw_store_file:                                       # As in merger.build_pipeline, the mined rows are added to the exports
+        with RawStore(raw_store_file, read_only=True) as raw_store:
+            token_df = with_export(raw_store.token_frame(wallet), token_file, merger.TOKEN_DTYPE)
+            internal_df = with_export(raw_store.internal_frame(wallet, price_store), internal_file, merger.INTERNAL_DTYPE)
+    else:
+        token_df = merger.read_raw(token_file, merger.TOKEN_DTYPE)
+        internal_df = merger.read_raw(internal_file, merger.INTERNAL_DTYPE)
+
+    token_df = metrics.call('process_erc20_txs', wallet, merger.process_erc20_txs, in_scope(token_df, quarters), price_store, interner, price_series).copy()
+    internal_df = metrics.call('process_internal_txs', wallet, merger.process_internal_txs, in_scope(internal_df, quarters), interner, price_series).copy()
+    merged_df = metrics.call('merge_txs', wallet, merger.merge_txs, token_df, internal_df)
+    named_df = metrics.call('identify_wallets', wallet, merger.identify_wallets, merged_df, wallets_dict, txs_dict, wallet, interner, label_dtype).copy()
+
+    local_file = os.path.join(local_ledgers_dir, f'{wallet}.csv')
+    rebuilt = _strings(merger.ledger_csv(named_df, interner))
+    files[local_file] = splice(_read_strings(local_file, rebuilt.columns), rebuilt, _local_quarters, quarters).to_csv(index=False)
+    return named_df
+
+# Function rebuilding the quarterly ledger of a wallet for the quarters from its rebuilt local rows. The balances start from
+# the stored closing balances of the previous quarter; the balances of later quarters move by the change of the closing balance.
+# The spliced ledger is added to files and the arguments of QuarterAggregates.splice to splices, see write_outputs.
+def rebuild_quarterly(wallet, named_df, quarters, price_store, aggregates, files, splices, quarter_dir='quarterly_ledgers', metrics=None):
+    metrics = metrics or merger.RunMetrics()
+    opening = aggregates.closing_balances(wallet, quarters[0], inclusive=False)
+    old_closing = aggregates.closing_balances(wallet, quarters[-1])
+
+    grouped_df = metrics.call('group_by_quarter', wallet, merger.group_by_quarter, merger.acquainted_transfers(named_df))
+    unspent_df = metrics.call('add_unspent_balances', wallet, merger.add_unspent_balances, grouped_df, price_store, wallet, opening)
+    final_df = merger.finalize_and_sort_df(pd.concat([grouped_df, unspent_df]).sort_values(by='Quarter'), wallet)
+
+    closing = dict(opening)
+    for symbol, value in zip(grouped_df['Symbol'].astype(str), grouped_df['Value']):
+        closing[symbol] = closing.get(symbol, 0) + value
+    changes = {symbol: value - old_closing.get(symbol, 0) for symbol, value in closing.items() if value != old_closing.get(symbol, 0)}
+
+    quarterly_file = os.path.join(quarter_dir, f'{wallet}_q.csv')
+    existing = _read_strings(quarterly_file, merger.QUARTERLY_COLUMNS)
+    rebuilt = _strings(merger.ledger_csv(final_df)) if len(final_df) else existing.iloc[:0]
+    later = existing[_base_quarters(existing) > quarters[-1]]
+    if set(changes) - set(later.loc[later['Quarter'].str.endswith(' Unspent'), 'Symbol']) and len(later):
+        raise ValueError(f"{wallet} gets a new symbol before later quarters; merge it without a quarter range")
+
+    spliced = splice(existing, rebuilt, _base_quarters, quarters)
+    carried = spliced['Quarter'].str.endswith(' Unspent') & (_base_quarters(spliced) > quarters[-1]) & spliced['Symbol'].isin(changes)
+    for row in np.flatnonzero(carried.to_numpy()):
+        symbol, quarter = spliced.at[row, 'Symbol'], spliced.at[row, 'Quarter'][:6]
+        balance = parse_amounts([spliced.at[row, 'Value']], [symbol])[0] + changes[symbol]
+        spliced.at[row, 'Value'] = format_amounts(pd.Series([balance], dtype=object), pd.Series([symbol]))[0]
+        spliced.at[row, 'DOT_USD'] = str(float(to_float(balance, decimals_of(symbol)) * price_store.price_on(symbol, calendar_end_of(quarter), backfill=True)))
+    files[quarterly_file] = spliced.to_csv(index=False)
+    splices.append((wallet, quarters, grouped_df, unspent_df, changes))
+    return final_df
+
+def write_outputs(files, splices, aggregates):
+    for splice_args in splices:
+        aggregates.splice(*splice_args)
+    for file, text in files.items():
+        write_if_changed(file, text)
+
+# Main Function. Rebuilds the wallets (all by default) for the quarters (all by default), then the combined ledger and
+# the exports after it. Returns the run metrics.
+def merge_scope(wallets=None, quarters=None, metrics=None, raw_data_dir='raw_txs', local_ledgers_dir='local_ledgers',
+                quarter_dir='quarterly_ledgers', aggregates_file=AGGREGATES_FILE, raw_store_file=None, valuation='daily', **pipeline_kwargs):
+    metrics = metrics or merger.RunMetrics()
+    pipeline = merger.build_pipeline(metrics=metrics, raw_data_dir=raw_data_dir, local_ledgers_dir=local_ledgers_dir, quarter_dir=quarter_dir,
+                                     valuation=valuation, raw_store_file=raw_store_file, aggregates_file=aggregates_file, **pipeline_kwargs)
+    folders = {os.path.basename(folder).strip('$'): folder for folder in glob(os.path.join(raw_data_dir, '$*'))}
+    unknown = set(wallets or []) - set(folders)
+    if unknown:
+        raise ValueError(f"Unknown wallets {sorted(unknown)}, expected some of {sorted(folders)}")
+    wallets = wallets or sorted(folders)
+
+    if not quarters:                                         # Whole wallets are rebuilt by their pipeline stages
+        pipeline.run([f'{stage}:{wallet}' for wallet in wallets for stage in ['local', 'quarterly']], force=True, upstream=False)
+    else:
+        lookups = merger.build_lookups()
+        label_dtype = merger.build_label_dtype(lookups[0], lookups[1], folders)   # As in merger.build_pipeline, one dictionary for all wallets
+        price_series = load_price_series() if valuation == 'asof' else None
+        files, splices = {}, []
+        with QuarterAggregates(aggregates_file) as aggregates:
+            for wallet in wallets:
+                if not aggregates.symbols(wallet) and any(quarter < quarters[0] for quarter in ledger_quarters(wallet, quarter_dir)):
+                    raise ValueError(f"No stored balances for {wallet}; run a full merge first")
+                named_df = rebuild_local(wallet, folders[wallet], quarters, lookups, label_dtype, files, local_ledgers_dir, raw_store_file, price_series, metrics)
+                rebuild_quarterly(wallet, named_df, quarters, lookups[2], aggregates, files, splices, quarter_dir, metrics)
+            write_outputs(files, splices, aggregates)            # Only once every wallet was rebuilt
+        with BalanceCheckpoints(aggregates_file) as checkpoints:   # Rebuilt quarters may keep their row counts
+            for wallet in wallets:
+                checkpoints.invalidate(wallet, quarters[0])
+    pipeline.run(DOWNSTREAM_STAGES, force=True, upstream=False)
+    return metrics
+
+def ledger_quarters(wallet, quarter_dir='quarterly_ledgers'):
+    return set(_base_quarters(_read_strings(os.path.join(quarter_dir, f'{wallet}_q.csv'), merger.QUARTERLY_COLUMNS)))
@@ -1,79 +1,182 @@
-import pandas as pd
 import os
-from datetime import datetime, timedelta
-
-# Adding quarter as in merger
-def add_quarter(date):
-    month = date.month
-    if (month < 4):
-        return f'{date.year} Q1'
-    elif (month < 7):
-        return f'{date.year} Q2'
-    elif (month < 10):
-        return f'{date.year} Q3'
-    else:
-        return f'{date.year} Q4'
+import csv
+import argparse
+from datetime import date
+
+from lazy_imports import lazy_import
+from amounts import decimals_of, to_base_units, to_float, parse_amounts, format_amounts
+from fiscal_calendar import quarter_labels, quarter_spans
+from atomic_files import write_if_changed
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Data is saved directly to local and quarterly ledgers
+RATES_FILE = 'stream_rates.csv'
+LOCAL_FILE = os.path.join('local_ledgers', 'Service Providers.csv')
+QUARTERLY_FILE = os.path.join('quarterly_ledgers', 'Service Providers_q.csv')
+
+SENDER = 'Service Providers'
+SYMBOL = 'USDC'
+LEDGER_COLUMNS = ['Transaction Hash', 'Date', 'From', 'From_name', 'From_category', 'To', 'To_name', 'To_category',
+                  'Value', 'DOT_USD', 'Symbol', 'Acquainted?']
+QUARTERLY_COLUMNS = ['Quarter', 'From', 'To', 'Symbol', 'Value', 'DOT_USD']
+OPEN_END = '2100-01-01'                                      # Streams without an end date run until further notice
+DETAILS = ['quarterly', 'daily']                             # Ledger rows per stream: one per quarter (default) or one per day
+
+# Function reading the rate table. Every row is a stream: a daily USDC reward of a recipient between two dates (inclusive).
+# A rate change is a new row starting the day after the previous one ends, so no code changes are needed.
+def read_rates(rates_file=RATES_FILE):
+    rates = pd.read_csv(rates_file, dtype=str, keep_default_na=False)
+    units = [to_base_units(rate, decimals_of(SYMBOL)) for rate in rates['Daily Rate']]
+    return pd.DataFrame({
+        'Recipient': rates['Recipient'],
+        'Units': pd.Series(units, index=rates.index, dtype=object),   # Daily rate in base units
+        'Start': rates['Effective From'].to_numpy().astype('datetime64[D]'),
+        'End': rates['Effective To'].replace('', OPEN_END).to_numpy().astype('datetime64[D]')
+    })
+
+# Function accruing every stream for every day between first_day and last_day (inclusive) in one shot.
+# The days x streams cross product is built as arrays; rows are ordered by day, then by the order of the rate table.
+def accrue(rates, first_day, last_day):
+    days = np.arange(np.datetime64(first_day, 'D'), np.datetime64(last_day, 'D') + 1)
+    active = (days[:, None] >= rates['Start'].to_numpy()[None, :]) & (days[:, None] <= rates['End'].to_numpy()[None, :])
+    day_index, stream_index = np.nonzero(active)
+    recipients = rates['Recipient'].to_numpy()[stream_index]
+    units = rates['Units'].to_numpy()[stream_index]
+
+    return pd.DataFrame({
+        'Transaction Hash': 'Stream',
+        'Date': days[day_index].astype(str),
+        'From': SENDER,
+        'From_name': SENDER,
+        'From_category': SENDER,
+        'To': recipients,
+        'To_name': recipients,
+        'To_category': recipients,
+        'Value': pd.Series(-units, dtype=object),            # The values and DOT_USD are negative since it is "ENS to Endpoint"
+        'DOT_USD': [-to_float(unit, decimals_of(SYMBOL)) for unit in units],
+        'Symbol': SYMBOL,
+        'Acquainted?': 1
+    }, columns=LEDGER_COLUMNS)
+
+# Streams are linear, so the amount of a stream in a quarter is its daily rate times the number of its days in that quarter.
+# Returns one row per stream and quarter, dated with the last accrued day; the cost does not depend on the number of days.
+def quarter_totals(rates, last_day):
+    last_day = np.datetime64(last_day, 'D')
+    starts = rates['Start'].to_numpy().astype('datetime64[D]')
+    ends = np.minimum(rates['End'].to_numpy().astype('datetime64[D]'), last_day)
+    if not len(rates) or starts.min() > last_day:
+        return pd.DataFrame(columns=LEDGER_COLUMNS + ['Quarter'])
+    labels, quarter_starts, quarter_ends = quarter_spans(starts.min(), last_day)
+
+    first = np.maximum(starts[:, None], quarter_starts[None, :])   # streams x quarters
+    last = np.minimum(ends[:, None], quarter_ends[None, :])
+    days = np.maximum((last - first).astype(np.int64) + 1, 0)
+    stream_index, quarter_index = np.nonzero(days)          # Rows ordered by stream, then by quarter
+    order = np.lexsort((stream_index, quarter_index))        # Quarter first, as in a daily ledger
+    stream_index, quarter_index = stream_index[order], quarter_index[order]
+
+    recipients = rates['Recipient'].to_numpy()[stream_index]
+    units = rates['Units'].to_numpy()[stream_index] * days[stream_index, quarter_index].astype(object)
+    return pd.DataFrame({
+        'Transaction Hash': 'Stream',
+        'Date': last[stream_index, quarter_index].astype(str),
+        'From': SENDER,
+        'From_name': SENDER,
+        'From_category': SENDER,
+        'To': recipients,
+        'To_name': recipients,
+        'To_category': recipients,
+        'Value': pd.Series(-units, dtype=object),
+        'DOT_USD': [-to_float(unit, decimals_of(SYMBOL)) for unit in units],
+        'Symbol': SYMBOL,
+        'Acquainted?': 1,
+        'Quarter': labels[quarter_index]
+    }, columns=LEDGER_COLUMNS + ['Quarter'])
+
+# Function returning the date of the last ledger row without reading the whole file
+def last_ledger_date(local_file):
+    if not os.path.exists(local_file) or os.path.getsize(local_file) == 0:
+        return None
+    with open(local_file, 'rb') as file:
+        header = next(csv.reader([file.readline().decode('utf-8')]))
+        file.seek(max(0, os.path.getsize(local_file) - 4096))
+        last_line = [line for line in file.read().decode('utf-8', errors='ignore').splitlines() if line.strip()][-1]
+    last_row = next(csv.reader([last_line]))
+    return None if last_row == header else np.datetime64(last_row[header.index('Date')], 'D')
+
+def append_rows(rows, local_file):
+    write_header = not os.path.exists(local_file) or os.path.getsize(local_file) == 0
+    export_df = rows.copy()
+    export_df['Value'] = format_amounts(export_df['Value'], export_df['Symbol'])   # Amounts stay in base units until export
+    export_df.to_csv(local_file, mode='a', header=write_header, index=False)
 
 # Grouping data to make it similiar to merger output
 def group_by_quarter(df):
-    df['Quarter'] = df['Date'].apply(add_quarter)
-    grouped = df.groupby(['Quarter', 'From', 'To', 'Symbol'], as_index=False).agg({'Value': 'sum', 'DOT_USD': 'sum'})
-    return grouped
+    df = df.assign(Quarter=quarter_labels(pd.to_datetime(df['Date'])))   # Same fiscal calendar and labels ('2024Q1') as in merger
+    return df.groupby(['Quarter', 'From', 'To', 'Symbol'], as_index=False).agg({'Value': 'sum', 'DOT_USD': 'sum'})
 
-# Data is saved directly to local and quarterly ledgers
-local_file_path = os.path.join('local_ledgers', 'Service Providers.csv')
-quarterly_path = os.path.join('quarterly_ledgers', 'Service Providers_q.csv')
-
-start_date = datetime(2024, 1, 1)
-current_date = datetime.now()
-date_format = '%Y-%m-%d'
-
-new_rows = []
-new_df = pd.DataFrame(new_rows)
-
-# Daily reward. The total for the year is 3,609,863.01, since it is a leap year.
-providers = {
-        'ETHLimo': 1369.8625,
-        'Namehash': 1643.835,
-        'Resolverworks': 1917.8075,
-        'Blockful': 821.9175,
-        'Unruggable': 1095.89,
-        'Wildcard': 547.945,
-        'EFP': 1369.8625,
-        'Namespace': 547.945,
-        'Unicorn': 547.945
-    }
-
-if os.path.exists(local_file_path):
-    existing_df = pd.read_csv(local_file_path)
-    if not existing_df.empty:
-        existing_df['Date'] = pd.to_datetime(existing_df['Date'], format=date_format)
-        existing_df['Symbol'] = 'USDC'
-        last_date = existing_df['Date'].max()
-        start_date = last_date + timedelta(days=1)
-
-while start_date <= current_date:
-    for recipient, value in providers.items():
-        new_rows.append({
-            'Transaction Hash': '',
-            'Date': start_date.strftime(date_format),
-            'From': 'Service Providers',
-            'To': recipient,
-            'Value': -value, # The values and DOT_USD are negative since it is "ENS to Endpoint"
-            'DOT_USD': -value,
-            'Symbol': 'USDC',
-            'Acquainted?': 1
-        })
-    start_date += timedelta(days=1)
-
-local_df = pd.concat([existing_df, new_df]) if 'existing_df' in locals() else new_df
-
-if 'Quarter' in local_df.columns:
-    local_df.drop(columns='Quarter', inplace=True)
-local_df = local_df[['Transaction Hash', 'Date', 'From', 'To', 'Value', 'DOT_USD', 'Symbol', 'Acquainted?']]
-local_df.to_csv(local_file_path, index=False)
-
-grouped_df = group_by_quarter(local_df)
-grouped_df.to_csv(quarterly_path, index=False)
-os.makedirs('local_ledgers', exist_ok=True)
-os.makedirs('quarterly_ledgers', exist_ok=True)
\ No newline at end of file
+# Function adding the totals of new rows to the quarterly ledger. Only the quarters of the new rows change.
+def update_quarterly(new_rows, quarterly_file):
+    totals = group_by_quarter(new_rows)
+    if os.path.exists(quarterly_file):
+        existing = pd.read_csv(quarterly_file, dtype={'Value': str})
+        existing['Quarter'] = existing['Quarter'].str.replace(' ', '')   # Older files used '2024 Q1' labels
+        existing['Value'] = pd.Series(parse_amounts(existing['Value'], existing['Symbol']), index=existing.index, dtype=object)
+        totals = pd.concat([existing[QUARTERLY_COLUMNS], totals]).groupby(['Quarter', 'From', 'To', 'Symbol'], as_index=False).agg({'Value': 'sum', 'DOT_USD': 'sum'})
+    totals['Value'] = format_amounts(totals['Value'], totals['Symbol'])
+    write_if_changed(quarterly_file, totals[QUARTERLY_COLUMNS].to_csv(index=False))   # Replaced atomically, see atomic_files.py
+    return totals
+
+# Function writing both ledgers from the closed-form quarter totals: one local row per stream and quarter.
+# The files are only replaced if their content changed (see atomic_files.py).
+def write_quarter_totals(rates, last_day, local_file, quarterly_file):
+    totals = quarter_totals(rates, last_day)
+    export_df = totals[LEDGER_COLUMNS].copy()
+    export_df['Value'] = format_amounts(export_df['Value'], export_df['Symbol'])
+    write_if_changed(local_file, export_df.to_csv(index=False))
+
+    quarterly = totals.groupby(['Quarter', 'From', 'To', 'Symbol'], as_index=False).agg({'Value': 'sum', 'DOT_USD': 'sum'})
+    quarterly['Value'] = format_amounts(quarterly['Value'], quarterly['Symbol'])
+    write_if_changed(quarterly_file, quarterly[QUARTERLY_COLUMNS].to_csv(index=False))
+    return len(totals)
+
+# Main Function. With the quarterly detail, the ledgers are rewritten from the closed-form totals up to (and including) until.
+# With the daily detail, the days after the last ledger row are accrued and appended.
+def update_streams(until=None, rates_file=RATES_FILE, local_file=LOCAL_FILE, quarterly_file=QUARTERLY_FILE, detail='quarterly'):
+    os.makedirs(os.path.dirname(local_file) or '.', exist_ok=True)
+    os.makedirs(os.path.dirname(quarterly_file) or '.', exist_ok=True)
+
+    rates = read_rates(rates_file)
+    last_day = np.datetime64(until or date.today(), 'D')
+    if detail == 'quarterly':
+        return write_quarter_totals(rates, last_day, local_file, quarterly_file)
+
+    previous_day = last_ledger_date(local_file)
+    first_day = rates['Start'].min() if previous_day is None else previous_day + 1
+    if first_day > last_day:
+        return 0
+
+    new_rows = accrue(rates, first_day, last_day)
+    if new_rows.empty:
+        return 0
+    append_rows(new_rows, local_file)
+    update_quarterly(new_rows, quarterly_file)
+    return len(new_rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Accrues Service Provider streams into local and quarterly ledgers.')
+    parser.add_argument('--until', help='last day to accrue (YYYY-MM-DD), today by default')
+    parser.add_argument('--rates', default=RATES_FILE, help='rate table with Recipient, Daily Rate, Effective From, Effective To')
+    parser.add_argument('--local-file', default=LOCAL_FILE)
+    parser.add_argument('--quarterly-file', default=QUARTERLY_FILE)
+    parser.add_argument('--detail', choices=DETAILS, default='quarterly',
+                        help="'daily' appends one local ledger row per stream and day instead of one per quarter")
+    args = parser.parse_args(argv)
+
+    rows = update_streams(args.until, args.rates, args.local_file, args.quarterly_file, args.detail)
+    print(f"{rows} stream rows {'added to' if args.detail == 'daily' else 'written to'} {args.local_file}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import sqlite3
+import subprocess
+import importlib.util
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from raw_store import RawStore, STORE_FILE as RAW_STORE
+
+# Watch mode chaining the miner, stream_grouper, quarter_aggregates and the merger. Changes of the watched inputs are
+# debounced and start only the stages they affect, plus the stages downstream of them. Stages run as subprocesses on a
+# bounded pool; stages writing the same outputs share a lock, and a stage requested while it is already queued is not queued twice.
+# Mined blocks only start quarter_aggregates, which updates the quarterly ledgers incrementally; the merger rebuilds every
+# wallet of the store on a new block, so it catches up with the mined blocks at most every merge_every seconds (see watch()).
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = { # Stage: (Lock group, Downstream stages)
+    'miner': ('miner', ['aggregates']),
+    'streams': ('streams', ['merger']),
+    'aggregates': ('ledgers', []),
+    'merger': ('ledgers', [])
+}
+ORDER = ['miner', 'streams', 'aggregates', 'merger']         # Upstream stages first
+
+WATCHES = { # Path relative to the repository (a file or a directory): Stages started by its changes
+    'raw_txs': ['merger'],
+    RAW_STORE: ['aggregates'],                              # Only once the miner committed blocks, see store_version()
+    RAW_STORE + '-wal': ['aggregates'],                     # The miner store commits into its write-ahead log first
+    'price_log': ['merger'],
+    'asset_prices.py': ['merger'],
+    'ens_wallets.py': ['merger'],
+    'transactions.py': ['merger'],
+    'stream_rates.csv': ['streams']
+}
+
+# Function returning the command of a stage. The miner store is only passed on once it exists.
+def stage_command(stage):
+    raw_store = ['--raw-store', RAW_STORE] if os.path.exists(os.path.join(ROOT, RAW_STORE)) else []
+    return {
+        'miner': [sys.executable, 'miner.py', '--store', RAW_STORE],
+        'streams': [sys.executable, 'stream_grouper.py'],
+        'aggregates': [sys.executable, 'quarter_aggregates.py', '--raw-store', RAW_STORE] if raw_store else None,
+        'merger': [sys.executable, 'merger.py', '--changed-only'] + raw_store
+    }[stage]
+
+# Function returning the stages and everything downstream of them, upstream first
+def downstream(stages):
+    selected, pending = set(), list(stages)
+    while pending:
+        stage = pending.pop()
+        if stage not in selected:
+            selected.add(stage)
+            pending.extend(STAGES[stage][1])
+    return [stage for stage in ORDER if stage in selected]
+
+def stages_for(path):
+    relative = os.path.relpath(os.path.abspath(path), ROOT)
+    stages = set()
+    for watched, watched_stages in WATCHES.items():
+        if relative == watched or relative.startswith(watched + os.sep):
+            stages.update(watched_stages)
+    return stages
+
+# Blocks committed to the miner store. Readers open and close the store files too, so only a new version is a change.
+def store_version():
+    try:
+        with RawStore(os.path.join(ROOT, RAW_STORE), read_only=True) as store:
+            return store.version()
+    except sqlite3.Error:                                    # Not created yet
+        return None
+
+def is_store(path):
+    return os.path.relpath(os.path.abspath(path), ROOT) in (RAW_STORE, RAW_STORE + '-wal')
+
+def log(message):
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+class Scheduler:
+
+    def __init__(self, workers=2, runner=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.runner = runner or self.run_stage
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.shared = set()                                  # Queued stages that were requested again by another change
+        self.group_locks = {group: threading.Lock() for group, _ in STAGES.values()}
+
+    def run_stage(self, stage):
+        command = stage_command(stage)
+        if command is None:
+            return True
+        started = time.perf_counter()
+        result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+        if result.returncode != 0:
+            log(f"{stage} failed ({result.returncode}): {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}")
+            return False
+        log(f"{stage} done in {time.perf_counter() - started:.1f}s")
+        return True
+
+    # Function queueing the stages and their downstream stages as one chain. Stages already waiting in a chain are skipped,
+    # since they will see the change when they start. Returns the future of the chain, or None if nothing was queued.
+    def request(self, stages):
+        with self.lock:
+            stages = downstream(stages)
+            chain = [stage for stage in stages if stage not in self.queued]
+            self.shared.update(stage for stage in stages if stage in self.queued)
+            self.queued.update(chain)
+        return self.pool.submit(self._run_chain, chain) if chain else None
+
+    def _run_chain(self, chain):
+        for position, stage in enumerate(chain):
+            with self.group_locks[STAGES[stage][0]]:
+                with self.lock:
+                    self.queued.discard(stage)               # Changes from now on queue another run
+                    self.shared.discard(stage)
+                if not self.runner(stage):
+                    rest = chain[position + 1:]
+                    with self.lock:                          # Stages also requested by other changes still run
+                        kept = [stage for stage in rest if stage in self.shared]
+                        self.queued.difference_update(set(rest) - set(kept))
+                        self.shared.difference_update(rest)
+                    skipped = [stage for stage in rest if stage not in kept]
+                    log(f"skipped after {stage}: {', '.join(skipped) or 'nothing'}")
+                    if kept:
+                        self.pool.submit(self._run_chain, kept)
+                    return False
+        return True
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+# Polling watcher: compares the modification time and size of every watched file on every call
+class PollingWatcher:
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for path in self.paths:
+            files = [path] if not os.path.isdir(path) else [os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names]
+            for file in files:
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changed
+
+# inotify (or the native API of the platform) through watchdog, which is optional
+class WatchdogWatcher:
+
+    def __init__(self, paths):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        self.events = queue.Queue()
+        events = self.events
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if not event.is_directory:
+                    events.put(event.src_path)
+                    if getattr(event, 'dest_path', None):
+                        events.put(event.dest_path)
+
+        self.observer = Observer()
+        for directory in {path if os.path.isdir(path) else os.path.dirname(path) for path in paths}:
+            self.observer.schedule(Handler(), directory, recursive=os.path.isdir(directory) and directory != ROOT)
+        self.observer.start()
+
+    def changes(self, timeout):
+        changed = set()
+        try:
+            changed.add(self.events.get(timeout=timeout))
+            while True:
+                changed.add(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return changed
+
+def make_watcher(paths, interval=1.0, use_watchdog=True):
+    if use_watchdog and importlib.util.find_spec('watchdog'):
+        return WatchdogWatcher(paths)
+    return PollingWatcher(paths, interval)
+
+# Main Function. Changes are collected until nothing changed for debounce seconds (or for at most max_delay seconds
+# after the first one), then the affected stages are requested. The stream ledgers are also refreshed once a day,
+# with mine_every the miner runs periodically, and the merger runs at most every merge_every seconds while the store has
+# blocks it has not seen.
+def watch(debounce=2.0, max_delay=30.0, interval=1.0, workers=2, mine_every=None, use_watchdog=True, merge_every=3600.0):
+    paths = [os.path.join(ROOT, path) for path in WATCHES]
+    watcher = make_watcher(paths, interval, use_watchdog)
+    scheduler = Scheduler(workers)
+    log(f"watching {len(WATCHES)} paths with {type(watcher).__name__}, {workers} workers")
+
+    pending, first_change, last_change = set(), None, None
+    today, last_mined, last_merged = date.today(), time.monotonic(), time.monotonic()
+    version, mined = store_version(), False                  # mined: blocks the merger has not seen yet
+    try:
+        while True:
+            for path in watcher.changes(timeout=min(interval, debounce)):
+                stages = stages_for(path)
+                if stages and is_store(path):
+                    current = store_version()
+                    if current == version:                   # Touched by a reader, or by a miner run without new blocks
+                        continue
+                    version, mined = current, True
+                if stages:
+                    pending.update(stages)
+                    now = time.monotonic()
+                    first_change, last_change = first_change or now, now
+
+            now = time.monotonic()
+            if pending and (now - last_change >= debounce or now - first_change >= max_delay):
+                log(f"changes -> {', '.join(downstream(pending))}")
+                if 'merger' in downstream(pending):
+                    mined, last_merged = False, now
+                scheduler.request(pending)
+                pending, first_change, last_change = set(), None, None
+            if mined and now - last_merged >= merge_every:
+                log('mined blocks -> merger')
+                mined, last_merged = False, now
+                scheduler.request(['merger'])
+
+            if date.today() != today:                        # Streams accrue daily
+                today = date.today()
+                scheduler.request(['streams'])
+            if mine_every and now - last_mined >= mine_every:
+                last_mined = now
+                scheduler.request(['miner'])
+    except KeyboardInterrupt:
+        log('stopping')
+    finally:
+        scheduler.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs miner, stream_grouper, quarter_aggregates and merger when their inputs change.')
+    parser.add_argument('--once', nargs='+', choices=ORDER, help='run these stages and their downstream stages once, then exit')
+    parser.add_argument('--debounce', type=float, default=2.0, help='seconds without changes before the stages start')
+    parser.add_argument('--max-delay', type=float, default=30.0, help='longest wait after the first change of a burst')
+    parser.add_argument('--interval', type=float, default=1.0, help='polling interval when watchdog is not installed')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--mine-every', type=float, help='run the miner every this many seconds (12 is one block)')
+    parser.add_argument('--merge-every', type=float, default=3600.0, help='longest wait before the merger sees newly mined blocks')
+    parser.add_argument('--poll', action='store_true', help='poll even if watchdog is installed')
+    args = parser.parse_args()
+
+    if args.once:
+        scheduler = Scheduler(args.workers)
+        ok = scheduler.request(args.once).result()
+        scheduler.shutdown()
+        sys.exit(0 if ok else 1)
+    watch(args.debounce, args.max_delay, args.interval, args.workers, args.mine_every, not args.poll, args.merge_every)
@@ -0,0 +1,130 @@
+import os
+import csv
+import argparse
+import numpy as np
+import pandas as pd
+
+from ens_wallets import ens_wallets
+
+# Generator of Etherscan-shaped raw_txs folders ($Wallet/token.csv and $Wallet/internal.csv) of arbitrary size.
+# It is used by benchmark.py to measure how merger.py scales beyond the bundled ~4,600 rows.
+
+TOKEN_COLUMNS = ['Transaction Hash', 'Blockno', 'UnixTimestamp', 'DateTime (UTC)', 'From', 'To', 'TokenValue',
+                 'USDValueDayOfTx', 'ContractAddress', 'TokenName', 'TokenSymbol']
+INTERNAL_COLUMNS = ['Transaction Hash', 'Blockno', 'UnixTimestamp', 'DateTime (UTC)', 'ParentTxFrom', 'ParentTxTo',
+                    'ParentTxETH_Value', 'From', 'TxTo', 'ContractAddress', 'Value_IN(ETH)', 'Value_OUT(ETH)',
+                    'CurrentValue @ $3000/Eth', 'Historical $Price/Eth', 'Status', 'ErrCode', 'Type', 'PrivateNote']
+
+TOKENS = { # Symbol: (ContractAddress, TokenName, Decimals, Approximate USD price)
+    'USDC': ('0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48', 'USDC', 6, 1),
+    'ENS': ('0xc18360217d8f7ab5e7c516566761ea12ce7f9d72', 'Ethereum Name Service', 18, 20),
+    'WETH': ('0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2', 'Wrapped Ether', 18, 2000)
+}
+
+# Main ENS wallets first, then endpoints, so that every synthetic folder is a wallet known to ens_wallets
+def synthetic_wallets(count):
+    main = [(name, address) for name, type_, address, *_ in ens_wallets if type_ in ['Treasury Consolidator', 'Payment Account']]
+    endpoints = [(name, address) for name, type_, address, *_ in ens_wallets if type_ == 'Endpoint']
+    wallets = list(dict((name, (name, address)) for name, address in main + endpoints).values())
+    if count > len(wallets):
+        raise ValueError(f'At most {len(wallets)} synthetic wallets are supported')
+    return wallets[:count]
+
+def random_hex(rng, count, length):
+    return np.char.add('0x', np.frombuffer(rng.bytes(count * length // 2).hex().encode(), dtype=f'S{length}').astype(str))
+
+def random_amounts(rng, count, decimals, usd_price):
+    whole = np.maximum(1, rng.lognormal(np.log(10_000 / usd_price), 1.5, count)).astype(np.int64).astype(str)
+    if decimals == 0:
+        return whole
+    fraction = np.char.zfill(rng.integers(0, 10 ** min(decimals, 18), count, dtype=np.uint64).astype(str), min(decimals, 18))
+    return np.char.add(np.char.add(whole, '.'), fraction)
+
+# Function generating timestamps, transaction hashes and counterparties shared by both files of a wallet
+def generate_transfers(rng, count, address, known_addresses, start, quarters, multisend_share, fanout, unknown_share):
+    first = pd.Timestamp(start).value // 10 ** 9
+    timestamps = np.sort(rng.integers(first, first + quarters * 91 * 86400, count))
+
+    multisend = rng.random(count) < multisend_share           # Multisends share one hash between fanout recipients
+    groups = np.cumsum(~multisend | (np.arange(count) % fanout == 0)) - 1
+    hashes = random_hex(rng, groups[-1] + 1 if count else 0, 64)[groups]
+
+    unknown_pool = random_hex(rng, max(1, count // 10), 40)
+    counterparties = np.where(rng.random(count) < unknown_share,
+                              unknown_pool[rng.integers(0, len(unknown_pool), count)],
+                              known_addresses[rng.integers(0, len(known_addresses), count)])
+    outgoing = multisend | (rng.random(count) < 0.5)
+    senders = np.where(outgoing, address, counterparties)
+    recipients = np.where(outgoing, counterparties, address)
+
+    datetimes = np.char.replace(np.datetime_as_string(timestamps.astype('datetime64[s]')), 'T', ' ')
+    blocks = 14_000_000 + (timestamps - first) // 12
+    return timestamps, datetimes, blocks, hashes, senders, recipients, multisend
+
+def generate_token_file(rng, path, count, address, known_addresses, symbols, **kwargs):
+    timestamps, datetimes, blocks, hashes, senders, recipients, multisend = generate_transfers(rng, count, address, known_addresses, **kwargs)
+    symbol_of = np.array(symbols)[rng.integers(0, len(symbols), count)]
+    values = np.empty(count, dtype=object)
+    usd = np.empty(count, dtype=object)
+    for symbol in symbols:
+        rows = symbol_of == symbol
+        _, _, decimals, price = TOKENS[symbol]
+        values[rows] = random_amounts(rng, rows.sum(), decimals, price)
+        usd[rows] = np.char.mod('$%.2f', values[rows].astype(float) * price * rng.uniform(0.9, 1.1, rows.sum()))
+    usd[multisend] = 'N/A'                                   # As in Etherscan exports, multisends have no DayOfTx value
+
+    pd.DataFrame({
+        'Transaction Hash': hashes, 'Blockno': blocks, 'UnixTimestamp': timestamps, 'DateTime (UTC)': datetimes,
+        'From': senders, 'To': recipients, 'TokenValue': values, 'USDValueDayOfTx': usd,
+        'ContractAddress': [TOKENS[symbol][0] for symbol in symbol_of],
+        'TokenName': [TOKENS[symbol][1] for symbol in symbol_of], 'TokenSymbol': symbol_of
+    }, columns=TOKEN_COLUMNS).to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+
+def generate_internal_file(rng, path, count, address, known_addresses, **kwargs):
+    timestamps, datetimes, blocks, hashes, senders, recipients, _ = generate_transfers(rng, count, address, known_addresses, **kwargs)
+    values = random_amounts(rng, count, 18, 2000)
+    incoming = recipients == address
+
+    pd.DataFrame({
+        'Transaction Hash': hashes, 'Blockno': blocks, 'UnixTimestamp': timestamps, 'DateTime (UTC)': datetimes,
+        'ParentTxFrom': senders, 'ParentTxTo': recipients, 'ParentTxETH_Value': '0', 'From': senders, 'TxTo': recipients,
+        'ContractAddress': '', 'Value_IN(ETH)': np.where(incoming, values, '0'), 'Value_OUT(ETH)': np.where(incoming, '0', values),
+        'CurrentValue @ $3000/Eth': '0', 'Historical $Price/Eth': np.round(rng.uniform(1000, 4000, count), 2),
+        'Status': (rng.random(count) < 0.01).astype(int), 'ErrCode': '', 'Type': 'call', 'PrivateNote': ''
+    }, columns=INTERNAL_COLUMNS).to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+
+# Main Function. Rows are split evenly between wallets; about a quarter of them are ETH (internal) transfers.
+def generate(raw_data_dir, wallets=7, rows=10_000, quarters=8, symbols=('USDC', 'ENS', 'WETH'), multisend_share=0.1,
+             fanout=5, unknown_share=0.2, start='2022-04-01', seed=0):
+    rng = np.random.default_rng(seed)
+    selected = synthetic_wallets(wallets)
+    known_addresses = np.array(sorted({wallet[2] for wallet in ens_wallets}))
+    options = dict(start=start, quarters=quarters, multisend_share=multisend_share, fanout=max(1, fanout), unknown_share=unknown_share)
+
+    for index, (name, address) in enumerate(selected):
+        wallet_rows = rows // wallets + (1 if index < rows % wallets else 0)
+        internal_rows = wallet_rows // 4
+        folder = os.path.join(raw_data_dir, f'${name}')
+        os.makedirs(folder, exist_ok=True)
+        generate_token_file(rng, os.path.join(folder, 'token.csv'), wallet_rows - internal_rows, address, known_addresses, list(symbols), **options)
+        generate_internal_file(rng, os.path.join(folder, 'internal.csv'), internal_rows, address, known_addresses, **options)
+
+    return [name for name, _ in selected]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates Etherscan-shaped raw_txs folders for benchmarks.')
+    parser.add_argument('output', help='directory to create the $Wallet folders in')
+    parser.add_argument('--wallets', type=int, default=7)
+    parser.add_argument('--rows', type=int, default=10_000, help='total number of rows over all wallets')
+    parser.add_argument('--quarters', type=int, default=8)
+    parser.add_argument('--symbols', nargs='+', default=['USDC', 'ENS', 'WETH'], choices=sorted(TOKENS))
+    parser.add_argument('--multisend-share', type=float, default=0.1, help='share of transfers sent as multisends')
+    parser.add_argument('--fanout', type=int, default=5, help='recipients per multisend')
+    parser.add_argument('--unknown-share', type=float, default=0.2, help='share of counterparties missing from ens_wallets')
+    parser.add_argument('--start', default='2022-04-01')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = generate(args.output, args.wallets, args.rows, args.quarters, args.symbols, args.multisend_share,
+                     args.fanout, args.unknown_share, args.start, args.seed)
+    print(f"{args.rows} rows generated for {len(names)} wallets in {args.output}")
@@ -0,0 +1,142 @@
+import os
+import ast
+import json
+import hashlib
+import argparse
+
+from lazy_imports import lazy_import
+from atomic_files import atomic_write
+
+np = lazy_import('numpy')
+
+# Compiled cache of the hand made databases: asset_prices, ens_wallets and transactions.
+# The Python literals are compiled once into .npy arrays (prices as day ordinals and floats, wallets and transactions
+# as fixed-width string columns) and memory-mapped on every run. A table is rebuilt when the sha256 of its source changes.
+# Array files are named after the sha256 of their source and never rewritten, so a rebuild does not touch arrays another
+# process has mapped; the manifest points to the current files.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.table_cache')
+MANIFEST = 'manifest.json'
+
+SOURCES = { # Table: (Source file, Variable)
+    'prices': ('asset_prices.py', 'prices'),
+    'wallets': ('ens_wallets.py', 'ens_wallets'),
+    'txs': ('transactions.py', 'various_txs')
+}
+
+def source_path(table):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), SOURCES[table][0])
+
+def source_hash(table):
+    with open(source_path(table), 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+# Function reading a literal from its source file without importing (and evaluating) the module
+def read_literal(table, variable=None):
+    path, variable = source_path(table), variable or SOURCES[table][1]
+    with open(path, encoding='utf-8') as file:
+        tree = ast.parse(file.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == variable for target in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError(f"{variable} is not defined in {path}")
+
+# Prices are stored in ascending day order, one column per asset of asset_prices.assets.
+# If a day is listed twice, the later entry wins, as in a dict.
+def compile_prices(rows, assets=None):
+    assets = assets or read_literal('prices', 'assets')
+    by_day = {day: values for day, *values in rows}
+    days = np.array(list(by_day), dtype='datetime64[D]').astype(np.int64)
+    values = np.array(list(by_day.values()), dtype=np.float64).reshape(len(days), len(assets))
+    order = np.argsort(days, kind='stable')
+    return {'days': days[order], 'values': values[order], 'assets': np.array(assets)}
+
+# Wallets keep the order of ens_wallets. The optional fourth element is the category; '' if it is missing.
+def compile_wallets(rows):
+    return {
+        'name': np.array([row[0] for row in rows], dtype=str),
+        'type': np.array([row[1] for row in rows], dtype=str),
+        'address': np.array([row[2] for row in rows], dtype=str),
+        'category': np.array([row[3] if len(row) > 3 else '' for row in rows], dtype=str)
+    }
+
+def compile_txs(rows):
+    return {
+        'category': np.array([row[0] for row in rows], dtype=str),
+        'hash': np.array([row[1] for row in rows], dtype=str)
+    }
+
+COMPILERS = {
+    'prices': compile_prices,
+    'wallets': compile_wallets,
+    'txs': compile_txs
+}
+
+def compile_table(table, rows):
+    return COMPILERS[table](rows)
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(cache_dir, manifest):
+    with atomic_write(os.path.join(cache_dir, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)                  # The manifest is replaced last, so a torn build is never used
+
+# Function removing array files the manifest no longer points to
+def remove_unused(cache_dir, manifest):
+    used = {name for entry in manifest.values() for name in entry.get('files', {}).values()}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy') and name not in used:
+            try:
+                os.remove(os.path.join(cache_dir, name))     # Mapped arrays stay readable until they are closed
+            except OSError:
+                pass
+
+# Function compiling one table from its source and saving its arrays. Returns the manifest entry.
+def build_table(table, cache_dir=CACHE_DIR):
+    digest = source_hash(table)
+    arrays = compile_table(table, read_literal(table))
+    files = {column: f'{table}.{digest[:16]}.{column}.npy' for column in arrays}
+    for column, array in arrays.items():
+        with atomic_write(os.path.join(cache_dir, files[column])) as file:
+            np.save(file, array)
+    return {'source': SOURCES[table][0], 'sha256': digest, 'columns': list(arrays), 'files': files,
+            'rows': int(len(next(iter(arrays.values()))))}
+
+def build_tables(cache_dir=CACHE_DIR, tables=None):
+    manifest = read_manifest(cache_dir)
+    for table in tables or SOURCES:
+        manifest[table] = build_table(table, cache_dir)
+    write_manifest(cache_dir, manifest)
+    remove_unused(cache_dir, manifest)
+    return manifest
+
+# Main Function. Returns {table: {column: array}}; arrays are memory-mapped from the cache and rebuilt if their source changed.
+# If the cache can not be written (e.g. a read-only checkout), the tables are compiled in memory.
+def load_tables(cache_dir=CACHE_DIR):
+    manifest = read_manifest(cache_dir)
+    stale = [table for table in SOURCES if manifest.get(table, {}).get('sha256') != source_hash(table) or 'files' not in manifest[table]]
+    if stale:
+        try:
+            manifest = build_tables(cache_dir, stale)
+        except OSError:
+            return {table: compile_table(table, read_literal(table)) for table in SOURCES}
+
+    return {table: {column: np.load(os.path.join(cache_dir, manifest[table]['files'][column]), mmap_mode='r')
+                    for column in manifest[table]['columns']}
+            for table in SOURCES}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compiles asset_prices, ens_wallets and transactions into the binary table cache.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild all tables even if their sources did not change')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        build_tables(args.cache_dir)
+    load_tables(args.cache_dir)
+    for table, entry in read_manifest(args.cache_dir).items():
+        print(f"{table:<8}{entry['rows']:>6} rows from {entry['source']} ({entry['sha256'][:12]})")